@@ -31,6 +31,7 @@ import sklearn.cluster as skc
 import sklearn.metrics as skm
 import sklearn.preprocessing as skp
 from pygmi.clust.datatypes import Clust
+from pygmi.misc import INSTR
 
 
 class Cluster(QtWidgets.QDialog):
@@ -245,6 +246,7 @@ class Cluster(QtWidgets.QDialog):
         self.bthres = self.doublespinbox_bthres.value()
         self.branchfac = self.spinbox_branchfac.value()
 
+    @INSTR.span('cluster')
     def run(self):
         """ Process data """
         data = copy.copy(self.indata['Raster'])
@@ -260,6 +262,7 @@ class Cluster(QtWidgets.QDialog):
             masktmp += i.data.mask
         for i, _ in enumerate(data):
             data[i].data.mask = masktmp
+            data[i].hist = {}
         X = np.array([i.data.compressed() for i in data]).T
 
         if self.radiobutton_sscale.isChecked():
@@ -274,18 +277,20 @@ class Cluster(QtWidgets.QDialog):
             elif i > no_clust[0]:
                 continue
 
-            if self.cltype == 'k-means':
-#                cfit = skc.KMeans(n_clusters=i, tol=self.tol,
-#                                  max_iter=self.max_iter).fit(X)
-                cfit = skc.MiniBatchKMeans(n_clusters=i, tol=self.tol,
-                                           max_iter=self.max_iter).fit(X)
-            elif self.cltype == 'DBSCAN':
-                cfit = skc.DBSCAN(eps=self.eps,
-                                  min_samples=self.min_samples).fit(X)
-
-            elif self.cltype == 'Birch':
-                cfit = skc.Birch(n_clusters=i, threshold=self.bthres,
-                                 branching_factor=self.branchfac).fit(X)
+            with INSTR.span('cluster fit', method=self.cltype, clusters=i):
+                INSTR.count('samples', X.shape[0])
+                if self.cltype == 'k-means':
+#                    cfit = skc.KMeans(n_clusters=i, tol=self.tol,
+#                                      max_iter=self.max_iter).fit(X)
+                    cfit = skc.MiniBatchKMeans(n_clusters=i, tol=self.tol,
+                                               max_iter=self.max_iter).fit(X)
+                elif self.cltype == 'DBSCAN':
+                    cfit = skc.DBSCAN(eps=self.eps,
+                                      min_samples=self.min_samples).fit(X)
+
+                elif self.cltype == 'Birch':
+                    cfit = skc.Birch(n_clusters=i, threshold=self.bthres,
+                                     branching_factor=self.branchfac).fit(X)
 
             dat_out.append(Clust())
             for k in data:
@@ -26,9 +26,18 @@
 """ Misc is a collection of routines which can be used in PyGMI in general.
 
 ptimer is utility module used to simplify checking how much time has passed
-in a program. It also outputs a message at the point when called. """
+in a program. It also outputs a message at the point when called.
 
+Instrument records named, nested spans of work with counters attached, and
+sends them to one or more sinks. It does not need the GUI. If the environment
+variable PYGMI_TRACE is set to a filename, all spans are written to that file
+as JSON lines. """
+
+import os
+import json
 import time
+import threading
+import contextlib
 from PyQt5 import QtWidgets
 
 
@@ -46,6 +55,251 @@ QProgressBar::chunk {
 """
 
 
+class MemorySink(object):
+    """
+    Instrumentation sink which keeps records in memory.
+
+    Attributes
+    ----------
+    records : list
+        list of record dictionaries
+    """
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        """ Stores a record """
+        self.records.append(record)
+
+    def close(self):
+        """ Nothing to close """
+
+
+class JSONSink(object):
+    """
+    Instrumentation sink which writes one JSON record per line to a file.
+
+    Attributes
+    ----------
+    filename : str
+        output filename
+    """
+    def __init__(self, filename, mode='a'):
+        self.filename = filename
+        self.fno = open(filename, mode)
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        """ Writes a record """
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.fno.write(line+'\n')
+            self.fno.flush()
+
+    def close(self):
+        """ Closes the file """
+        self.fno.close()
+
+
+class LogSink(object):
+    """
+    Instrumentation sink which writes readable lines to a text routine, such
+    as print, showprocesslog or showtext, or to a log file.
+
+    Attributes
+    ----------
+    write : function
+        routine which accepts a string
+    """
+    def __init__(self, write=print):
+        self.fno = None
+        if isinstance(write, str):
+            self.fno = open(write, 'a')
+            write = self._write
+        self.write = write
+
+    def _write(self, text):
+        """ Writes a line to the log file """
+        self.fno.write(text+'\n')
+        self.fno.flush()
+
+    def emit(self, record):
+        """ Writes a record """
+        if record['type'] == 'span':
+            text = '{0}: {1:.3f} s'.format(record['path'],
+                                          record['seconds'])
+        else:
+            text = record['name']
+        for i, j in list(record['fields'].items()) + \
+                list(record.get('counters', {}).items()):
+            text += ', {0}={1}'.format(i, j)
+        self.write('  '*record['depth']+text)
+
+    def close(self):
+        """ Closes the log file, if there is one """
+        if self.fno is not None:
+            self.fno.close()
+
+
+class Instrument(object):
+    """
+    Records nested, named spans of work and counters, and sends them to sinks.
+
+    A span is timed from the start to the end of a with block. Counters are
+    added to the innermost open span of the current thread, and are added to
+    the parent span when a span ends. Work run in other threads should be
+    wrapped with bind, so that its spans and counters reach the span which
+    started it. When there are no sinks, spans and counters do nothing.
+
+    Attributes
+    ----------
+    sinks : list
+        list of sinks. A sink has emit(record) and close() methods.
+    """
+    def __init__(self):
+        self.sinks = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        """ Adds a sink, and returns it """
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink):
+        """ Removes and closes a sink """
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+        sink.close()
+
+    def _stack(self):
+        """ Stack of open spans of the current thread """
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def bind(self, func):
+        """
+        Wraps a function which is run in another thread, for example in a
+        thread pool, so that its spans and counters are added to the spans
+        which are open now, in the calling thread.
+
+        Parameters
+        ----------
+        func : function
+            function to wrap
+
+        Returns
+        -------
+        function
+            wrapped function
+        """
+        if not self.sinks:
+            return func
+        stack = list(self._stack())
+
+        def bound(*args, **kwargs):
+            """ Runs func on a copy of the calling thread's span stack """
+            old = self._stack()
+            self._local.stack = list(stack)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.stack = old
+        return bound
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        """
+        Context manager which times a named span of work.
+
+        Parameters
+        ----------
+        name : str
+            span name
+        **fields
+            extra values stored with the record
+
+        Yields
+        ------
+        record : dictionary
+            the span record, or None if there are no sinks
+        """
+        if not self.sinks:
+            yield None
+            return
+
+        stack = self._stack()
+        path = '/'.join([i['name'] for i in stack]+[name])
+        record = {'type': 'span', 'name': name, 'path': path,
+                  'depth': len(stack),
+                  'thread': threading.current_thread().name,
+                  'start': time.time(), 'fields': fields, 'counters': {}}
+        stack.append(record)
+        tstart = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter()-tstart
+            stack.pop()
+            if stack:
+                with self._lock:
+                    counters = stack[-1]['counters']
+                    for i, j in record['counters'].items():
+                        counters[i] = counters.get(i, 0)+j
+            self.emit(record)
+
+    def count(self, name, value=1):
+        """
+        Adds to a counter of the innermost open span.
+
+        Parameters
+        ----------
+        name : str
+            counter name
+        value : int or float
+            amount to add
+        """
+        if not self.sinks:
+            return
+        stack = self._stack()
+        if not stack:
+            return
+        with self._lock:
+            counters = stack[-1]['counters']
+            counters[name] = counters.get(name, 0)+value
+
+    def event(self, name, **fields):
+        """
+        Records a single event.
+
+        Parameters
+        ----------
+        name : str
+            event name
+        **fields
+            extra values stored with the record
+        """
+        if not self.sinks:
+            return
+        stack = self._stack()
+        path = '/'.join([i['name'] for i in stack]+[name])
+        self.emit({'type': 'event', 'name': name, 'path': path,
+                   'depth': len(stack),
+                   'thread': threading.current_thread().name,
+                   'start': time.time(), 'fields': fields})
+
+    def emit(self, record):
+        """ Sends a record to all sinks """
+        for sink in list(self.sinks):
+            sink.emit(record)
+
+
+INSTR = Instrument()
+if os.environ.get('PYGMI_TRACE'):
+    INSTR.add_sink(JSONSink(os.environ['PYGMI_TRACE']))
+
+
 class PTime(object):
     """ Main class in the ptimer module. Once activated, this class keeps track
     of all time since activation. Times are stored whenever its methods are
@@ -54,10 +308,10 @@ class PTime(object):
     Attributes
     ----------
     tchk : list
-        List of times generated by the time.clock routine.
+        List of times generated by the time.perf_counter routine.
     """
     def __init__(self):
-        self.tchk = [time.clock()]
+        self.tchk = [time.perf_counter()]
 
     def since_first_call(self, msg='since first call', show=True):
         """ This function prints out a message and lets you know the time
@@ -68,8 +322,9 @@ class PTime(object):
         msg : str
             Optional message
         """
-        self.tchk.append(time.clock())
+        self.tchk.append(time.perf_counter())
         tdiff = self.tchk[-1] - self.tchk[0]
+        INSTR.event('timer', msg=msg, seconds=tdiff)
         if show:
             if tdiff < 60:
                 print(msg, 'time (s):', tdiff)
@@ -88,8 +343,9 @@ class PTime(object):
         msg : str
             Optional message"""
 
-        self.tchk.append(time.clock())
+        self.tchk.append(time.perf_counter())
         tdiff = self.tchk[-1] - self.tchk[-2]
+        INSTR.event('timer', msg=msg, seconds=tdiff)
         if show:
             print(msg, 'time(s):', tdiff, 'since last call')
         return tdiff
@@ -122,7 +378,7 @@ class ProgressBar(QtWidgets.QProgressBar):
         self.setMinimum(0)
         self.setValue(0)
 
-        self.otime = time.clock()
+        self.otime = time.perf_counter()
         time1 = self.otime
         time2 = self.otime
 
@@ -131,7 +387,7 @@ class ProgressBar(QtWidgets.QProgressBar):
             yield obj
             i += 1
 
-            time2 = time.clock()
+            time2 = time.perf_counter()
             if time2-time1 > 1:
                 self.setValue(i)
                 tleft = (total-i)*(time2-self.otime)/i
@@ -0,0 +1,458 @@
+# -----------------------------------------------------------------------------
+# Name:        chunkstore.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2018 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+""" Chunked model container for 3D models.
+
+A model is stored as a small JSON header (the .p3d file) and a directory of
+uncompressed .npy chunks next to it. The header holds all the scalar model and
+lithology parameters, so it loads instantly. Every raster in griddata has its
+own file.
+
+The lithology index is stored layer by layer in a base file, in blocks of
+chunkz layers. Blocks which changed after the base was written are stored in
+their own chunk files, which replace the block in the base. On load, the base
+is memory mapped copy on write, so a layer is only read from disk when it is
+used, and edits stay in memory. Rasters are memory mapped in the same way.
+
+Chunk file names contain a digest of their contents. When a model is saved
+over an existing container, only blocks whose digest changed are written. The
+base is written again when more than half of the blocks have changed.
+"""
+
+import os
+import re
+import json
+import hashlib
+import numpy as np
+from pygmi.raster.datatypes import Data
+
+FORMAT = 'pygmi-model3d'
+VERSION = 2
+
+LITHPARAMS = {'hintn': 'hintn', 'finc': 'finc', 'fdec': 'fdec',
+              'zobsm': 'zobsm', 'zobsg': 'zobsg', 'susc': 'susc',
+              'mstrength': 'mstrength', 'qratio': 'qratio', 'minc': 'minc',
+              'mdec': 'mdec', 'density': 'density', 'bdensity': 'bdensity',
+              'lith_index': 'lith_index', 'numx': 'g_cols',
+              'numy': 'g_rows', 'numz': 'numz', 'dxy': 'g_dxy', 'd_z': 'd_z'}
+
+GRIDPARAMS = ['tlx', 'tly', 'xdim', 'ydim', 'nrofbands', 'dataid', 'rows',
+              'cols', 'nullvalue', 'gtr', 'wkt', 'units']
+
+
+def _tojson(obj):
+    """ Converts numpy types for the json encoder """
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+
+def _digest(*arrays):
+    """ Returns a short digest of the contents of one or more arrays """
+    sha = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        sha.update(str(arr.dtype).encode())
+        sha.update(str(arr.shape).encode())
+        sha.update(arr.view(np.uint8))
+    return sha.hexdigest()[:16]
+
+
+def _index_dtype(lith_index):
+    """
+    Smallest integer type which can hold the lithology index. int8 is not
+    used, since the model merge tools temporarily offset lithology numbers by
+    900 and 9000.
+    """
+    if lith_index.size == 0:
+        return np.int16
+    vmin = int(lith_index.min())
+    vmax = int(lith_index.max())
+    for dtype in (np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= vmin and vmax <= info.max:
+            return dtype
+    return np.int64
+
+
+class ModelStore(object):
+    """
+    Chunked, lazily loaded container for a LithModel.
+
+    Attributes
+    ----------
+    filename : str
+        filename of the JSON header (*.p3d)
+    datadir : str
+        directory holding the .npy chunks
+    chunkz : int
+        number of model layers per lithology index chunk
+    header : dictionary
+        parsed header, or None if the container has not been read yet
+    """
+    def __init__(self, filename, chunkz=8):
+        self.filename = filename
+        self.datadir = filename + '_chunks'
+        self.chunkz = chunkz
+        self.header = None
+
+    def read_header(self):
+        """ Reads the header. Only the JSON file is read. """
+        with open(self.filename) as fno:
+            header = json.load(fno)
+
+        if header.get('format') != FORMAT:
+            raise ValueError(self.filename + ' is not a PyGMI 3D model')
+        if header.get('version', 0) > VERSION:
+            raise ValueError(self.filename + ' was written by a newer '
+                             'version of PyGMI')
+
+        self.header = header
+        return header
+
+    def _path(self, fname):
+        """ Full path of a chunk file """
+        return os.path.join(self.datadir, fname)
+
+    def _load(self, fname):
+        """ Memory maps a chunk. Writes go to memory, not to the file. """
+        return np.load(self._path(fname), mmap_mode='c')
+
+    def chunk(self, i):
+        """
+        Returns a block of layers of the lithology index.
+
+        Parameters
+        ----------
+        i : int
+            chunk number
+
+        Returns
+        -------
+        numpy array
+            memory mapped array of shape (numx, numy, layers in chunk)
+        """
+        if self.header is None:
+            self.read_header()
+        hlith = self.header['lith_index']
+        fname = hlith['chunks'][i]['file']
+        if 'base' not in hlith:
+            return self._load(fname)
+        if fname is not None:
+            return self._load(fname).transpose(1, 2, 0)
+        k = i*hlith['chunkz']
+        tmp = self._load(hlith['base'])[k:k+hlith['chunkz']]
+        return tmp.transpose(1, 2, 0)
+
+    def layer(self, k):
+        """
+        Returns a single model layer, reading only that layer from disk.
+
+        Parameters
+        ----------
+        k : int
+            layer number
+
+        Returns
+        -------
+        numpy array
+            array of shape (numx, numy)
+        """
+        if self.header is None:
+            self.read_header()
+        chunkz = self.header['lith_index']['chunkz']
+        tmp = self.chunk(k // chunkz)
+        return np.array(tmp[:, :, k % chunkz],
+                        dtype=np.promote_types(tmp.dtype, np.int16))
+
+    def lith_index(self):
+        """
+        Returns the full lithology index, in the integer type it was stored
+        with. The base is memory mapped copy on write, so layers are read
+        from disk as they are used. Only blocks stored in their own chunk
+        files are read now.
+        """
+        if self.header is None:
+            self.read_header()
+        hlith = self.header['lith_index']
+
+        if 'base' in hlith:
+            lith_index = self._load(hlith['base']).view(np.ndarray)
+            for i, chunk in enumerate(hlith['chunks']):
+                if chunk['file'] is not None:
+                    k = i*hlith['chunkz']
+                    tmp = self._load(chunk['file'])
+                    lith_index[k:k+tmp.shape[0]] = tmp
+            return lith_index.transpose(1, 2, 0)
+
+# Containers written before the base file was used hold only chunk files.
+        numx, numy, numz = hlith['shape']
+        dtype = np.int16
+        if hlith['chunks']:
+            dtype = np.promote_types(self.chunk(0).dtype, np.int16)
+        lith_index = np.empty((numx, numy, numz), dtype=dtype)
+        for i, _ in enumerate(hlith['chunks']):
+            k = i*hlith['chunkz']
+            tmp = self.chunk(i)
+            lith_index[:, :, k:k+tmp.shape[2]] = tmp
+        return lith_index
+
+    def raster(self, key):
+        """
+        Returns a raster from griddata. The data stays on disk until used.
+
+        Parameters
+        ----------
+        key : str
+            griddata key
+
+        Returns
+        -------
+        Data
+            PyGMI raster dataset
+        """
+        if self.header is None:
+            self.read_header()
+        hgrid = self.header['griddata'][key]
+
+        dat = Data()
+        for i in GRIDPARAMS:
+            setattr(dat, i, hgrid['params'][i])
+        dat.gtr = tuple(dat.gtr)
+
+        tmp = self._load(hgrid['file'])
+        if hgrid['mask'] is None:
+            dat.data = np.ma.array(tmp)
+        else:
+            dat.data = np.ma.array(tmp, mask=self._load(hgrid['mask']))
+        return dat
+
+    def to_dict(self, pre=''):
+        """
+        Returns the model as a dictionary in the same layout as the npz
+        files, so that it can be passed to dict2lmod.
+
+        Parameters
+        ----------
+        pre : str
+            key prefix
+
+        Returns
+        -------
+        outdict : dictionary
+            model dictionary
+        """
+        header = self.read_header()
+        outdict = {}
+
+        for i in header['model']:
+            outdict[pre+i] = np.array(header['model'][i])
+
+        mlut = {int(i): j for i, j in header['mlut'].items()}
+        custprofx = {int(i): tuple(j)
+                     for i, j in header['custprofx'].items()}
+        custprofy = {int(i): tuple(j)
+                     for i, j in header['custprofy'].items()}
+        griddata = {i: self.raster(i) for i in header['griddata']}
+
+        outdict[pre+'mlut'] = np.array(mlut)
+        outdict[pre+'custprofx'] = np.array(custprofx)
+        outdict[pre+'custprofy'] = np.array(custprofy)
+        outdict[pre+'griddata'] = np.array(griddata)
+        outdict[pre+'lith_index'] = self.lith_index()
+        outdict[pre+'lithkeys'] = np.array(list(header['lith_list'].keys()))
+
+        for lith, params in header['lith_list'].items():
+            for i in params:
+                outdict[pre+lith+'_'+i] = np.array(params[i])
+
+        return outdict
+
+    def _write(self, fname, arr, written):
+        """ Writes a chunk, unless a chunk with that name already exists """
+        written.add(fname)
+        if os.path.exists(self._path(fname)):
+            return 0
+        np.save(self._path(fname), arr)
+        return arr.nbytes
+
+    def _old_index(self):
+        """ Lithology index header of the container on disk, if any """
+        try:
+            hlith = self.read_header()['lith_index']
+        except (OSError, ValueError, KeyError):
+            return None
+        if 'base' not in hlith:
+            return None
+        return hlith
+
+    def _save_index(self, lith_index, written):
+        """
+        Saves the lithology index. Blocks which match the base on disk are
+        not written, and changed blocks are written to their own files.
+        """
+        lith_index = np.asarray(lith_index)
+        dtype = _index_dtype(lith_index)
+        numz = lith_index.shape[2]
+
+        blocks = []
+        digests = []
+        for k in range(0, numz, self.chunkz):
+            tmp = lith_index[:, :, k:k+self.chunkz].transpose(2, 0, 1)
+            tmp = np.ascontiguousarray(tmp, dtype=dtype)
+            blocks.append(tmp)
+            digests.append(_digest(tmp))
+
+        old = self._old_index()
+        if (old is None or old['shape'] != list(lith_index.shape) or
+                old['chunkz'] != self.chunkz or
+                old['dtype'] != np.dtype(dtype).name):
+            old = None
+        else:
+            changed = [i for i, j in zip(digests, old['basedigests'])
+                       if i != j]
+            if len(changed) > len(digests)//2:
+                old = None
+
+        nbytes = 0
+        if old is None:
+            base = 'lith_base_{0}.npy'.format(_digest(*blocks))
+            if base not in written and not os.path.exists(self._path(base)):
+                tmp = np.concatenate(blocks) if blocks else \
+                    np.zeros((0,)+lith_index.shape[:2], dtype=dtype)
+                np.save(self._path(base), tmp)
+                nbytes += tmp.nbytes
+            written.add(base)
+            basedigests = digests
+        else:
+            base = old['base']
+            written.add(base)
+            basedigests = old['basedigests']
+
+        chunks = []
+        for i, tmp in enumerate(blocks):
+            fname = None
+            if digests[i] != basedigests[i]:
+                fname = 'lith_{0:05d}_{1}.npy'.format(i, digests[i])
+                nbytes += self._write(fname, tmp, written)
+            chunks.append({'file': fname})
+
+        hlith = {'shape': list(lith_index.shape), 'chunkz': self.chunkz,
+                 'dtype': np.dtype(dtype).name, 'base': base,
+                 'basedigests': basedigests, 'chunks': chunks}
+        return hlith, nbytes
+
+    def save(self, lmod):
+        """
+        Saves a model. If the container already exists, only chunks which
+        have changed are written.
+
+        Parameters
+        ----------
+        lmod : LithModel
+            PyGMI lithological model
+
+        Returns
+        -------
+        nbytes : int
+            number of bytes of chunk data written
+        """
+        if not os.path.exists(self.datadir):
+            os.makedirs(self.datadir)
+
+        written = set()
+        nbytes = 0
+
+        header = {'format': FORMAT, 'version': VERSION}
+        header['model'] = {'gregional': lmod.gregional, 'ght': lmod.ght,
+                           'mht': lmod.mht, 'numx': lmod.numx,
+                           'numy': lmod.numy, 'numz': lmod.numz,
+                           'dxy': lmod.dxy, 'd_z': lmod.d_z,
+                           'xrange': list(lmod.xrange),
+                           'yrange': list(lmod.yrange),
+                           'zrange': list(lmod.zrange)}
+        header['mlut'] = {str(i): list(j) for i, j in lmod.mlut.items()}
+        header['custprofx'] = {str(i): list(j)
+                               for i, j in lmod.custprofx.items()}
+        header['custprofy'] = {str(i): list(j)
+                               for i, j in lmod.custprofy.items()}
+
+        header['lith_list'] = {}
+        for lith, ldata in lmod.lith_list.items():
+            header['lith_list'][lith] = {i: getattr(ldata, j)
+                                         for i, j in LITHPARAMS.items()}
+
+# Lithology index, layer by layer, in blocks of layers
+        hlith, nbytes2 = self._save_index(lmod.lith_index, written)
+        header['lith_index'] = hlith
+        nbytes += nbytes2
+
+# Raster data
+        header['griddata'] = {}
+        default = Data()
+        for key, dat in lmod.griddata.items():
+            keyid = re.sub('[^0-9A-Za-z]+', '_', key)
+            keyid += '_'+hashlib.sha1(key.encode()).hexdigest()[:6]
+
+            tmp = np.ma.getdata(dat.data)
+            mask = np.ma.getmask(dat.data)
+            if mask is np.ma.nomask or not mask.any():
+                mask = None
+            else:
+                mask = np.ascontiguousarray(mask)
+
+            digest = _digest(tmp) if mask is None else _digest(tmp, mask)
+            fname = 'grid_{0}_{1}.npy'.format(keyid, digest)
+            nbytes += self._write(fname, tmp, written)
+            mname = None
+            if mask is not None:
+                mname = 'mask_{0}_{1}.npy'.format(keyid, digest)
+                nbytes += self._write(mname, mask, written)
+
+            params = {i: getattr(dat, i, getattr(default, i))
+                      for i in GRIDPARAMS}
+            header['griddata'][key] = {'file': fname, 'mask': mname,
+                                       'params': params}
+
+# The header is replaced in one step, so an interrupted save leaves the
+# previous model intact.
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as fno:
+            json.dump(header, fno, default=_tojson, indent=1)
+        os.replace(tmpname, self.filename)
+        self.header = header
+
+# Remove chunks which are no longer referenced. Files which are still memory
+# mapped cannot be removed on some platforms, and are removed on a later save.
+        for fname in os.listdir(self.datadir):
+            if fname in written or not fname.endswith('.npy'):
+                continue
+            try:
+                os.remove(self._path(fname))
+            except OSError:
+                pass
+
+        return nbytes
@@ -51,7 +51,7 @@ from matplotlib import cm
 from pygmi.raster.dataprep import gdal_to_dat
 from pygmi.raster.dataprep import data_to_gdal_mem
 from pygmi.pfmod.datatypes import LithModel
-from pygmi.misc import PTime
+from pygmi.misc import PTime, INSTR
 
 
 class GravMag(object):
@@ -80,6 +80,7 @@ class GravMag(object):
         self.actioncalculate2 = QtWidgets.QPushButton(self.parent)
         self.actioncalculate3 = QtWidgets.QPushButton(self.parent)
         self.actioncalculate4 = QtWidgets.QPushButton(self.parent)
+        self.actioninvert = QtWidgets.QPushButton(self.parent)
         self.setupui()
 
     def setupui(self):
@@ -89,6 +90,7 @@ class GravMag(object):
         self.actioncalculate2.setText("Calculate Magnetics (All)")
         self.actioncalculate3.setText("Calculate Gravity (Changes Only)")
         self.actioncalculate4.setText("Calculate Magnetics (Changes Only)")
+        self.actioninvert.setText("Lithology Inversion")
         self.parent.toolbar.addWidget(self.actionregionaltest)
         self.parent.toolbar.addSeparator()
         self.parent.toolbar.addWidget(self.actioncalculate)
@@ -96,12 +98,15 @@ class GravMag(object):
         self.parent.toolbar.addWidget(self.actioncalculate3)
         self.parent.toolbar.addWidget(self.actioncalculate4)
         self.parent.toolbar.addSeparator()
+        self.parent.toolbar.addWidget(self.actioninvert)
+        self.parent.toolbar.addSeparator()
 
         self.actionregionaltest.clicked.connect(self.test_pattern)
         self.actioncalculate.clicked.connect(self.calc_field_grav)
         self.actioncalculate2.clicked.connect(self.calc_field_mag)
         self.actioncalculate3.clicked.connect(self.calc_field_grav_changes)
         self.actioncalculate4.clicked.connect(self.calc_field_mag_changes)
+        self.actioninvert.clicked.connect(self.calc_inversion)
         self.actioncalculate3.setEnabled(False)
         self.actioncalculate4.setEnabled(False)
 
@@ -234,6 +239,64 @@ class GravMag(object):
         if tlabel == 'Custom Profile Editor':
             self.parent.pview.update_plot()
 
+    def calc_inversion(self):
+        """ Lithology inversion of the gravity or magnetic dataset """
+        from pygmi.pfmod import inversion
+
+        self.lmod1 = self.parent.lmod1
+        self.lmod2 = self.parent.lmod2
+        self.lmod = self.lmod1
+
+        text, okay = QtWidgets.QInputDialog.getItem(
+            self.parent, 'Lithology Inversion',
+            'Please choose the dataset to invert:',
+            ['Gravity Dataset', 'Magnetic Dataset'], editable=False)
+
+        if not okay:
+            return
+
+        niter, okay = QtWidgets.QInputDialog.getInt(
+            self.parent, 'Lithology Inversion', 'Number of iterations:',
+            20, 1, 1000)
+
+        if not okay:
+            return
+
+        magcalc = (text == 'Magnetic Dataset')
+        self.parent.profile.viewmagnetics = magcalc
+        self.parent.pview.viewmagnetics = magcalc
+
+        # Update the model from the view
+        indx = self.parent.tabwidget.currentIndex()
+        tlabel = self.parent.tabwidget.tabText(indx)
+
+        if tlabel == 'Layer Editor':
+            self.parent.layer.update_model()
+
+        if tlabel == 'Profile Editor':
+            self.parent.profile.update_model()
+
+        if tlabel == 'Custom Profile Editor':
+            self.parent.pview.update_model()
+
+        mvec = inversion.calc_inversion(self.lmod, magcalc, niter,
+                                        showtext=self.showtext)
+        if mvec is None:
+            return
+
+        # Recalculate the field for the new lithologies
+        self.lmod.lith_index_old[:] = -1
+        self.calc_field2(True, magcalc)
+
+        if tlabel == 'Layer Editor':
+            self.parent.layer.combo()
+
+        if tlabel == 'Profile Editor':
+            self.parent.profile.update_plot()
+
+        if tlabel == 'Custom Profile Editor':
+            self.parent.pview.update_plot()
+
     def calc_field2(self, showreports=False, magcalc=False):
         """ Calculate magnetic and gravity field """
 
@@ -847,6 +910,7 @@ def gridmatch(lmod, ctxt, rtxt):
     return dat.data
 
 
+@INSTR.span('calc_field')
 def calc_field(lmod, pbars=None, showtext=None, parent=None,
                showreports=False, magcalc=False):
     """ Calculate magnetic and gravity field
@@ -919,6 +983,7 @@ def calc_field(lmod, pbars=None, showtext=None, parent=None,
     for mlist in lmod.lith_list.items():
         mijk = mlist[1].lith_index
         if mijk not in modind and mijk not in modindcheck:
+            INSTR.count('lithologies unchanged')
             continue
         if mlist[0] != 'Background':
             mlist[1].modified = True
@@ -927,11 +992,15 @@ def calc_field(lmod, pbars=None, showtext=None, parent=None,
                 mlist[1].parent = parent
                 mlist[1].pbars = parent.pbars
                 mlist[1].showtext = parent.showtext
-            if magcalc:
-                mlist[1].calc_origin_mag(hcor)
-            else:
-                mlist[1].calc_origin_grav()
-            tmpfiles[mlist[0]] = save_layer(mlist)
+            with INSTR.span('kernel', lithology=mlist[0]):
+                if magcalc:
+                    mlist[1].calc_origin_mag(hcor)
+                    INSTR.count('kernel bytes', mlist[1].mlayers.nbytes)
+                else:
+                    mlist[1].calc_origin_grav()
+                    INSTR.count('kernel bytes', mlist[1].glayers.nbytes)
+            with INSTR.span('tempfile write', lithology=mlist[0]):
+                tmpfiles[mlist[0]] = save_layer(mlist)
         lmod.tmpfiles = tmpfiles
 
     if showreports is True:
@@ -957,14 +1026,15 @@ def calc_field(lmod, pbars=None, showtext=None, parent=None,
         mijk = mlist[1].lith_index
         if mijk not in modind and mijk not in modindcheck:
             continue
-        lmod.tmpfiles[mlist[0]].seek(0)
+        with INSTR.span('tempfile read', lithology=mlist[0]):
+            lmod.tmpfiles[mlist[0]].seek(0)
 
-        mfile = np.load(lmod.tmpfiles[mlist[0]])
+            mfile = np.load(lmod.tmpfiles[mlist[0]])
 
-        if magcalc:
-            mglayers = mfile['mlayers']
-        else:
-            mglayers = mfile['glayers']*mlist[1].rho()
+            if magcalc:
+                mglayers = mfile['mlayers']
+            else:
+                mglayers = mfile['glayers']*mlist[1].rho()
 
         showtext('Summing '+mlist[0]+' (PyGMI may become non-responsive' +
                  ' during this calculation)')
@@ -978,11 +1048,13 @@ def calc_field(lmod, pbars=None, showtext=None, parent=None,
 
 # This is temporary to try and fix a bug.
 
-            for k in kuni:
-                baba = sum_fields(k, mgval, numx, numy, modind, aaa[0],
-                                  aaa[1], mglayers, hcorflat, mijk, juni,
-                                  iuni)
-                mgvalin += baba
+            with INSTR.span('summation', lithology=mlist[0]):
+                INSTR.count('voxels summed', i.size)
+                for k in kuni:
+                    baba = sum_fields(k, mgval, numx, numy, modind, aaa[0],
+                                      aaa[1], mglayers, hcorflat, mijk, juni,
+                                      iuni)
+                    mgvalin += baba
 
 #
 #            if i.size < 50000:
@@ -1012,6 +1084,7 @@ def calc_field(lmod, pbars=None, showtext=None, parent=None,
             iuni = np.array(np.unique(i), dtype=np.int32)
             juni = np.array(np.unique(j), dtype=np.int32)
             kuni = np.array(np.unique(k), dtype=np.int32)
+            INSTR.count('voxels summed', i.size)
 
             if i.size < 50000:
                 for k in kuni:
@@ -1100,7 +1173,7 @@ def calc_field(lmod, pbars=None, showtext=None, parent=None,
     return lmod.griddata
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True)
 def sum_fields(k, mgval, numx, numy, modind, aaa0, aaa1, mlayers, hcorflat,
                mijk, jj, ii):
     """ Calculate magnetic and gravity field """
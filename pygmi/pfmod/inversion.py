@@ -0,0 +1,416 @@
+# -----------------------------------------------------------------------------
+# Name:        inversion.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2018 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+""" Voxel inversion of gravity and magnetic data.
+
+The field of a model cell only depends on its offset from the observation
+point, so the per layer prism kernels used by calc_field (glayers and mlayers)
+are translation invariant. The sensitivity matrix is built from them once and
+stored sparse, dropping entries which are smaller than a fraction of the
+largest kernel value or further away than a set number of cells. Iterations
+are then only sparse matrix-vector products, which run in parallel.
+
+The inversion solves for density contrast (gravity) or susceptibility
+(magnetics) in every active cell, using damped least squares (CGLS). The
+result can then be classified into the nearest lithology.
+"""
+
+import time
+import numpy as np
+from numba import jit, prange
+from pygmi.misc import INSTR
+from pygmi.pfmod.grvmag3d import GeoData, gridmatch
+
+
+class Sensitivity(object):
+    """
+    Sparse sensitivity matrix for a model.
+
+    Attributes
+    ----------
+    nobs : int
+        number of observation points (numx*numy)
+    vox : numpy array
+        (i, j, k) indices of the active model cells, shape (nvox, 3)
+    gmat : tuple
+        CSR arrays (indptr, indices, data) of the sensitivity matrix
+    gmatt : tuple
+        CSR arrays of the transpose of the sensitivity matrix
+    """
+    def __init__(self, gmatt, nobs, vox):
+        self.nobs = nobs
+        self.vox = vox
+        self.gmatt = gmatt
+        self.gmat = _transpose(gmatt, nobs)
+
+    @property
+    def nbytes(self):
+        """ Memory used by the sensitivity matrix, in bytes """
+        return sum(i.nbytes for i in self.gmat+self.gmatt)
+
+    @property
+    def nnz(self):
+        """ Number of stored entries """
+        return self.gmat[2].size
+
+    def dot(self, mvec):
+        """ Forward calculation, G.m """
+        out = np.zeros(self.nobs)
+        return csr_matvec(self.gmat[0], self.gmat[1], self.gmat[2], mvec,
+                          out)
+
+    def rdot(self, dvec):
+        """ Transpose product, G'.d """
+        out = np.zeros(self.vox.shape[0])
+        return csr_matvec(self.gmatt[0], self.gmatt[1], self.gmatt[2], dvec,
+                          out)
+
+
+def sensitivity(lmod, magcalc=False, tol=1e-3, rad=None, showtext=None):
+    """
+    Builds the sensitivity matrix for the active cells of a model.
+
+    Parameters
+    ----------
+    lmod : LithModel
+        PyGMI lithological model
+    magcalc : bool
+        if true, the sensitivity is for susceptibility and magnetic data,
+        otherwize for density contrast and gravity.
+    tol : float
+        entries smaller than tol times the largest kernel value are dropped
+    rad : int
+        entries further than rad cells horizontally from a cell are dropped.
+        None means no distance limit.
+    showtext : module
+        showtext routine if available. (internal use)
+
+    Returns
+    -------
+    Sensitivity
+        sensitivity matrix
+    """
+    if showtext is None:
+        showtext = print
+
+    numx = int(lmod.numx)
+    numy = int(lmod.numy)
+    numz = int(lmod.numz)
+
+    # Kernel for a unit property contrast
+    lith = GeoData(None, numx, numy, numz, lmod.dxy, lmod.d_z, lmod.mht,
+                   lmod.ght)
+    lith.showtext = showtext
+    if 'Background' in lmod.lith_list:
+        back = lmod.lith_list['Background']
+        lith.hintn = back.hintn
+        lith.finc = back.finc
+        lith.fdec = back.fdec
+    lith.susc = 1.
+    lith.mstrength = 0.
+    lith.density = 1.
+    lith.bdensity = 0.
+
+    if magcalc:
+        lith.calc_origin_mag()
+        layers = lith.mlayers
+    else:
+        lith.calc_origin_grav()
+        layers = lith.glayers
+    layers = np.ascontiguousarray(layers, dtype=np.float64)
+
+    tmp = np.copy(lmod.lith_index)
+    tmp[tmp > -1] = 0
+    hcorflat = numz-np.abs(tmp.sum(2)).flatten()
+    hcorflat = hcorflat.astype(np.int64)
+
+    vox = np.transpose(np.nonzero(lmod.lith_index != -1)).astype(np.int64)
+
+    if rad is None:
+        rad = max(numx, numy)
+    thres = tol*np.abs(layers).max()
+
+    count = sens_count(vox, layers, hcorflat, numx, numy, rad, thres)
+    indptr = np.zeros(vox.shape[0]+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(count)
+    indices = np.zeros(indptr[-1], dtype=np.int64)
+    data = np.zeros(indptr[-1])
+    sens_fill(vox, layers, hcorflat, numx, numy, rad, thres, indptr,
+              indices, data)
+
+    INSTR.count('sensitivity bytes', indices.nbytes+data.nbytes)
+    return Sensitivity((indptr, indices, data), numx*numy, vox)
+
+
+def observed(lmod, magcalc=False):
+    """
+    Gets the observed data on the model grid, in the same order as the rows
+    of the sensitivity matrix.
+
+    Parameters
+    ----------
+    lmod : LithModel
+        PyGMI lithological model
+    magcalc : bool
+        if true, returns the magnetic data, otherwize gravity.
+
+    Returns
+    -------
+    dobs : numpy array
+        observed data
+    dmask : numpy array
+        True where there is observed data
+    """
+    if magcalc:
+        dobs = gridmatch(lmod, 'Calculated Magnetics', 'Magnetic Dataset')
+    else:
+        dobs = gridmatch(lmod, 'Calculated Gravity', 'Gravity Dataset')
+        dobs = dobs - lmod.gregional
+
+    dobs = np.ma.masked_invalid(dobs)
+    dmask = ~np.ma.getmaskarray(dobs)[::-1].T.flatten()
+    dobs = dobs.filled(0.)[::-1].T.flatten()
+
+    return dobs, dmask
+
+
+def invert(sens, dobs, dmask=None, damping=0., niter=20, bounds=None,
+           showtext=None):
+    """
+    Damped least squares inversion (CGLS) using a sparse sensitivity.
+
+    Parameters
+    ----------
+    sens : Sensitivity
+        sensitivity matrix
+    dobs : numpy array
+        observed data
+    dmask : numpy array
+        True where data is to be used. Defaults to all data.
+    damping : float
+        damping (smallness) factor
+    niter : int
+        number of iterations
+    bounds : tuple
+        (lower, upper) bounds for the model values, applied to the result.
+    showtext : module
+        showtext routine if available. (internal use)
+
+    Returns
+    -------
+    mvec : numpy array
+        model values for each active cell
+    """
+    if showtext is None:
+        showtext = print
+    if dmask is None:
+        dmask = np.ones(dobs.size, dtype=bool)
+
+    wdat = dmask.astype(float)
+    nvox = sens.vox.shape[0]
+    showtext('Sensitivity matrix: '+str(nvox)+' cells, ' +
+             str(sens.nnz)+' entries, ' +
+             '{0:.1f}'.format(sens.nbytes/2**20)+' MB')
+
+    mvec = np.zeros(nvox)
+    resid = wdat*dobs
+    svec = sens.rdot(resid)
+    pvec = svec.copy()
+    gamma = svec @ svec
+    dnorm = np.sqrt(resid @ resid)
+
+    time1 = time.perf_counter()
+    for i in range(niter):
+        if gamma == 0.:
+            break
+        qvec = wdat*sens.dot(pvec)
+        alpha = gamma/(qvec @ qvec + damping**2 * (pvec @ pvec))
+        mvec += alpha*pvec
+        resid -= alpha*qvec
+        svec = sens.rdot(wdat*resid) - damping**2 * mvec
+        gamma2 = svec @ svec
+        pvec = svec + (gamma2/gamma)*pvec
+        gamma = gamma2
+
+        time2 = time.perf_counter()
+        tdiff = time2-time1
+        time1 = time2
+        rnorm = np.sqrt(resid @ resid)
+        INSTR.count('iterations')
+        showtext('Iteration '+str(i+1)+': relative misfit ' +
+                 '{0:.4f}'.format(rnorm/dnorm if dnorm > 0 else 0.) +
+                 ', {0:.2f} s'.format(tdiff))
+
+    if bounds is not None:
+        mvec = np.clip(mvec, bounds[0], bounds[1])
+
+    return mvec
+
+
+def prop_to_lith(lmod, sens, mvec, magcalc=False):
+    """
+    Assigns each active cell to the lithology with the nearest property.
+
+    Parameters
+    ----------
+    lmod : LithModel
+        PyGMI lithological model. Its lith_index is updated.
+    sens : Sensitivity
+        sensitivity matrix used for the inversion
+    mvec : numpy array
+        inverted density contrast or susceptibility for each active cell
+    magcalc : bool
+        if true, mvec is susceptibility, otherwize density contrast.
+    """
+    lindex = []
+    lprop = []
+    for lith in lmod.lith_list.values():
+        lindex.append(lith.lith_index)
+        if magcalc:
+            lprop.append(lith.susc)
+        else:
+            lprop.append(lith.rho())
+
+    lindex = np.array(lindex)
+    lprop = np.array(lprop)
+
+    nearest = np.abs(mvec[:, np.newaxis]-lprop[np.newaxis, :]).argmin(1)
+    i, j, k = sens.vox.T
+    lmod.lith_index[i, j, k] = lindex[nearest]
+    lmod.is_modified()
+
+
+def calc_inversion(lmod, magcalc=False, niter=20, damping=0., tol=1e-3,
+                   rad=None, showtext=None):
+    """
+    Lithology inversion of the gravity or magnetic dataset in a model.
+
+    Parameters
+    ----------
+    lmod : LithModel
+        PyGMI lithological model. Its lith_index is updated.
+    magcalc : bool
+        if true, inverts magnetic data, otherwize gravity.
+    niter : int
+        number of iterations
+    damping : float
+        damping (smallness) factor
+    tol : float
+        relative threshold for sensitivity entries
+    rad : int
+        distance threshold for sensitivity entries, in cells
+    showtext : module
+        showtext routine if available. (internal use)
+
+    Returns
+    -------
+    mvec : numpy array
+        inverted density contrast or susceptibility for each active cell
+    """
+    if showtext is None:
+        showtext = print
+
+    if magcalc and 'Magnetic Dataset' not in lmod.griddata:
+        showtext('Error: No magnetic dataset')
+        return None
+    if not magcalc and 'Gravity Dataset' not in lmod.griddata:
+        showtext('Error: No gravity dataset')
+        return None
+
+    if magcalc:
+        lprop = [i.susc for i in lmod.lith_list.values()]
+    else:
+        lprop = [i.rho() for i in lmod.lith_list.values()]
+
+    showtext('Building sensitivity matrix')
+    time1 = time.perf_counter()
+    with INSTR.span('sensitivity', magcalc=magcalc):
+        sens = sensitivity(lmod, magcalc, tol, rad, showtext)
+    showtext('Sensitivity time: {0:.1f} s'.format(time.perf_counter()-time1))
+
+    dobs, dmask = observed(lmod, magcalc)
+    with INSTR.span('invert', niter=niter):
+        mvec = invert(sens, dobs, dmask, damping, niter,
+                      (min(lprop), max(lprop)), showtext)
+    prop_to_lith(lmod, sens, mvec, magcalc)
+
+    return mvec
+
+
+def _transpose(csr, ncols):
+    """ Transpose of a matrix in CSR arrays """
+    indptr, indices, data = csr
+    nrows = indptr.size-1
+    rows = np.repeat(np.arange(nrows), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    tindptr = np.zeros(ncols+1, dtype=np.int64)
+    tindptr[1:] = np.cumsum(np.bincount(indices, minlength=ncols))
+    return tindptr, rows[order], data[order]
+
+
+@jit(nopython=True, parallel=True)
+def csr_matvec(indptr, indices, data, vec, out):
+    """ Parallel sparse matrix-vector product using CSR arrays """
+    for row in prange(out.size):
+        tmp = 0.
+        for jj in range(indptr[row], indptr[row+1]):
+            tmp += data[jj]*vec[indices[jj]]
+        out[row] = tmp
+    return out
+
+
+@jit(nopython=True, parallel=True)
+def sens_count(vox, layers, hcorflat, numx, numy, rad, thres):
+    """ Counts the sensitivity entries kept for each cell """
+    count = np.zeros(vox.shape[0], dtype=np.int64)
+    for ivox in prange(vox.shape[0]):
+        i = vox[ivox, 0]
+        j = vox[ivox, 1]
+        k = vox[ivox, 2]
+        for xobs in range(max(0, i-rad), min(numx, i+rad+1)):
+            for yobs in range(max(0, j-rad), min(numy, j+rad+1)):
+                iobs = xobs*numy+yobs
+                val = layers[hcorflat[iobs]+k, numx-i+xobs, numy-j+yobs]
+                if abs(val) >= thres:
+                    count[ivox] += 1
+    return count
+
+
+@jit(nopython=True, parallel=True)
+def sens_fill(vox, layers, hcorflat, numx, numy, rad, thres, indptr,
+              indices, data):
+    """ Fills the sensitivity entries for each cell """
+    for ivox in prange(vox.shape[0]):
+        i = vox[ivox, 0]
+        j = vox[ivox, 1]
+        k = vox[ivox, 2]
+        pos = indptr[ivox]
+        for xobs in range(max(0, i-rad), min(numx, i+rad+1)):
+            for yobs in range(max(0, j-rad), min(numy, j+rad+1)):
+                iobs = xobs*numy+yobs
+                val = layers[hcorflat[iobs]+k, numx-i+xobs, numy-j+yobs]
+                if abs(val) >= thres:
+                    indices[pos] = iobs
+                    data[pos] = val
+                    pos += 1
@@ -38,6 +38,7 @@ from pygmi.pfmod.datatypes import Data, LithModel
 import pygmi.pfmod.grvmag3d as grvmag3d
 import pygmi.pfmod.tensor3d as tensor3d
 import pygmi.pfmod.cubes as mvis3d
+from pygmi.pfmod.chunkstore import ModelStore
 import pygmi.menu_default as menu_default
 import pygmi.raster.dataprep as dp
 # This is necessary for loading npz files, since I moved the location of
@@ -64,6 +65,7 @@ class ImportMod3D(object):
     def settings(self):
         """ Settings """
         ext = ('npz (*.npz);;'
+               'Chunked model (*.p3d);;'
                'Leapfrog Block Model (*.csv);;'
                'x,y,z,label (*.csv);;'
                'x,y,z,label (*.txt)')
@@ -85,6 +87,9 @@ class ImportMod3D(object):
             self.import_leapfrog_csv(filename)
         elif filt == 'x,y,z,label (*.csv)' or filt == 'x,y,z,label (*.txt)':
             self.import_ascii_xyz_model(filename)
+        elif filt == 'Chunked model (*.p3d)':
+            indict = ModelStore(filename).to_dict()
+            self.dict2lmod(indict)
         else:
             indict = np.load(filename)
             self.dict2lmod(indict)
@@ -395,7 +400,8 @@ class ImportTMod3D(object):
 
     def settings(self):
         """ Settings """
-        ext = ('npz (*.npz)')
+        ext = ('npz (*.npz);;'
+               'Chunked model (*.p3d)')
 
         filename, filt = QtWidgets.QFileDialog.getOpenFileName(
             self.parent, 'Open File', '.', ext)
@@ -410,7 +416,10 @@ class ImportTMod3D(object):
         self.lmod.griddata.clear()
         self.lmod.lith_list.clear()
 
-        indict = np.load(filename)
+        if filt == 'Chunked model (*.p3d)':
+            indict = ModelStore(filename).to_dict()
+        else:
+            indict = np.load(filename)
         self.dict2lmod(indict)
 
         self.outdata['Model3D'] = [self.lmod]
@@ -545,7 +554,7 @@ class ExportMod3D(object):
         for self.lmod in self.indata['Model3D']:
             filename, _ = QtWidgets.QFileDialog.getSaveFileName(
                 self.parent, 'Save File', '.',
-                'npz (*.npz);;shapefile (*.shp);;kmz (*.kmz);;csv (*.csv)')
+                'npz (*.npz);;p3d (*.p3d);;shapefile (*.shp);;kmz (*.kmz);;csv (*.csv)')
 
             if filename == '':
                 return
@@ -559,6 +568,8 @@ class ExportMod3D(object):
         # Pop up save dialog box
             if self.ext == 'npz':
                 self.savemodel()
+            if self.ext == 'p3d':
+                self.savechunked()
             if self.ext == 'kmz':
                 self.mod3dtokmz()
             if self.ext == 'shp':
@@ -582,6 +593,16 @@ class ExportMod3D(object):
         except:
             self.showtext('ERROR! Model save failed!')
 
+    def savechunked(self):
+        """ Save model to a chunked container. Only changes are written if
+        the model has been saved to the same file before. """
+        try:
+            nbytes = ModelStore(self.ifile).save(self.lmod)
+            self.showtext('Model save complete! ('+str(nbytes//1024) +
+                          ' kB of changes written)')
+        except (OSError, TypeError, ValueError):
+            self.showtext('ERROR! Model save failed!')
+
     def lmod2dict(self, outdict, pre=''):
         """ place lmod in dictionary """
 
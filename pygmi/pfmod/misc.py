@@ -28,9 +28,7 @@ import pdb
 import time
 from PyQt5 import QtWidgets, QtCore, QtGui
 import pygmi.menu_default as menu_default
-from pygmi.raster.dataprep import data_to_gdal_mem
-from pygmi.raster.dataprep import gdal_to_dat
-from osgeo import gdal
+from pygmi.raster.dataprep import warp_data
 import numpy as np
 
 
@@ -47,6 +45,40 @@ def update_lith_lw(lmod, lwidget):
         tmp.setBackground(QtGui.QColor(tcol[0], tcol[1], tcol[2], 255))
 
 
+def lith_rgba(dat, mlut):
+    """
+    Converts a section of lithology indices to an RGBA image, using a lookup
+    table instead of a pass per lithology. Cells with an index of -1 (above
+    the DTM) are transparent. The rows are flipped for display.
+
+    Parameters
+    ----------
+    dat : numpy array
+        2D array of lithology indices
+    mlut : dictionary
+        color table for lithologies
+
+    Returns
+    -------
+    numpy array
+        RGBA image with values between 0 and 1
+    """
+    dat = np.asarray(dat, dtype=int)
+    vmax = max(mlut)
+    if dat.size > 0:
+        vmax = max(vmax, dat.max())
+
+    # The last entry is transparent, so that -1 indexes it.
+    lut = np.zeros([vmax+2, 4])
+    for i, col in mlut.items():
+        if i >= 0:
+            lut[i, :3] = col[:3]
+            lut[i, 3] = 255
+    lut /= 255.
+
+    return lut[dat[::-1]]
+
+
 class RangedCopy(QtWidgets.QDialog):
     """ Class to call up a dialog for ranged copying """
     def __init__(self, parent=None):
@@ -216,7 +248,7 @@ class ProgressBar(object):
         self.pbar.setMinimum(0)
         self.pbar.setValue(0)
 
-        self.otime = time.clock()
+        self.otime = time.perf_counter()
         time1 = self.otime
         time2 = self.otime
 
@@ -225,7 +257,7 @@ class ProgressBar(object):
             yield obj
             i += 1
 
-            time2 = time.clock()
+            time2 = time.perf_counter()
             if time2-time1 > 1:
                 self.pbar.setValue(i)
                 tleft = (total-i)*(time2-self.otime)/i
@@ -252,7 +284,7 @@ class ProgressBar(object):
 
         n = self.mvalue
         total = self.mmax
-        tleft = (total-n)*(time.clock()-self.mtime)/n
+        tleft = (total-n)*(time.perf_counter()-self.mtime)/n
         if tleft > 60:
             tleft = int(tleft // 60)
             self.pbarmain.setFormat('%p% '+str(tleft)+'min left')
@@ -275,7 +307,7 @@ class ProgressBar(object):
 
         self.pbar.setFormat('%p%')
         self.pbarmain.setFormat('%p%')
-        self.mtime = time.clock()
+        self.mtime = time.perf_counter()
 
         self.max = maximum
         self.value = 0
@@ -497,32 +529,10 @@ def gmerge(master, slave, xrange=None, yrange=None):
     rows = int((ymax - ymin)//ydim)+1
     gtr = (xmin, xdim, 0.0, ymax, 0.0, -ydim)
 
-    dat = []
-
-    for data in [master, slave]:
-        doffset = 0.0
-        if data.data.min() <= 0:
-            doffset = data.data.min()-1.
-            data.data -= doffset
-        data.data.set_fill_value(0)
-        tmp = data.data.filled()
-        data.data = np.ma.masked_equal(tmp, 0)
-        data.nullvalue = 0
-
-        gtr0 = (data.tlx, data.xdim, 0.0, data.tly, 0.0, -data.ydim)
-        src = data_to_gdal_mem(data, gtr0, orig_wkt, data.cols, data.rows)
-        dest = data_to_gdal_mem(data, gtr, orig_wkt, cols, rows, True)
-
-        gdal.ReprojectImage(src, dest, orig_wkt, orig_wkt, gdal.GRA_Bilinear)
-
-        dat.append(gdal_to_dat(dest, data.dataid))
-        dat[-1].data = np.ma.masked_outside(dat[-1].data, 0.1,
-                                            data.data.max() + 1000)
-        dat[-1].data += doffset
-        dat[-1].data.set_fill_value(1e+20)
-        tmp = dat[-1].data.filled()
-        dat[-1].data = np.ma.masked_equal(tmp, 1e+20)
-        dat[-1].nullvalue = 1e+20
+    dat = warp_data([master, slave], gtr, cols, rows, orig_wkt, orig_wkt)
+    for i in dat:
+        i.data.set_fill_value(1e+20)
+        i.nullvalue = 1e+20
 
     imask = np.logical_and(dat[0].data.mask == True, dat[1].data.mask == False)
     if imask.size > 1:
@@ -0,0 +1,337 @@
+# -----------------------------------------------------------------------------
+# Name:        scenarios.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2018 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+""" Batch forward calculations of many model scenarios.
+
+A scenario is a dictionary which changes the base model. It can have the
+following keys:
+
+ * 'name' : name of the scenario, used as the band name of the output.
+ * 'props' : dictionary of lithology names, each with a dictionary of
+   GeoData properties to change, e.g. {'Granite': {'density': 2.7}}
+ * 'lith_index' : a replacement lithology index (the model geometry).
+
+The calculation is split into kernels and partial fields. Gravity uses one
+kernel for all lithologies. Magnetic kernels are calculated for a unit
+magnetisation, so lithologies sharing a magnetisation direction share a
+kernel. A partial field is the sum of a kernel over the cells of one
+lithology. It only depends on the kernel and the cells, so it is calculated
+once and shared between all scenarios where those are unchanged. Each scenario
+is then a weighted sum of partial fields.
+"""
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pygmi.misc import INSTR
+from pygmi.pfmod.grvmag3d import GeoData, sum_fields, dircos, gridmatch
+
+PROPS = ['hintn', 'finc', 'fdec', 'minc', 'mdec', 'theta', 'susc',
+         'mstrength', 'density', 'bdensity']
+
+
+def _digest(arr):
+    """ Short digest of an array """
+    return hashlib.sha1(np.ascontiguousarray(arr).view(np.uint8)).hexdigest()
+
+
+def magnetisation(props):
+    """
+    Net magnetisation of a lithology, in the same form used by mboxmain.
+
+    Parameters
+    ----------
+    props : dictionary
+        lithology properties
+
+    Returns
+    -------
+    m3 : numpy array
+        net magnetisation vector
+    """
+    ma, mb, mc = dircos(props['minc'], props['mdec'], props['theta'])
+    fa, fb, fc = dircos(props['finc'], props['fdec'], props['theta'])
+
+    mr = props['mstrength'] * np.array([ma, mb, mc]) * 100
+    mi = props['susc']*props['hintn']*np.array([fa, fb, fc]) / (4*np.pi)
+
+    return mr+mi
+
+
+class BatchCalc(object):
+    """
+    Batch forward calculation of scenarios of a model.
+
+    Attributes
+    ----------
+    lmod : LithModel
+        base model
+    magcalc : bool
+        if true, calculates magnetic data, otherwize gravity.
+    kernels : dictionary
+        cached kernels
+    partials : dictionary
+        cached partial fields
+    """
+    def __init__(self, lmod, magcalc=False, nthreads=None, showtext=None):
+        if showtext is None:
+            showtext = print
+
+        self.lmod = lmod
+        self.magcalc = magcalc
+        self.nthreads = nthreads
+        self.showtext = showtext
+        self.kernels = {}
+        self.partials = {}
+
+        self.numx = int(lmod.numx)
+        self.numy = int(lmod.numy)
+        self.numz = int(lmod.numz)
+        self.aaa = np.reshape(np.mgrid[0:self.numx, 0:self.numy],
+                              [2, self.numx*self.numy])
+
+    def lith_props(self, scenario):
+        """
+        Properties of each lithology for a scenario.
+
+        Parameters
+        ----------
+        scenario : dictionary
+            scenario definition
+
+        Returns
+        -------
+        props : dictionary
+            dictionary of lithology properties, keyed by lith_index
+        """
+        sprops = scenario.get('props', {})
+        for i in sprops:
+            if i not in self.lmod.lith_list:
+                raise ValueError('Unknown lithology in scenario: '+i)
+
+        props = {}
+        for lname, lith in self.lmod.lith_list.items():
+            if lname == 'Background':
+                continue
+            tmp = {i: getattr(lith, i) for i in PROPS}
+            tmp.update(sprops.get(lname, {}))
+            props[lith.lith_index] = tmp
+        return props
+
+    def kernel_key(self, props):
+        """
+        Returns the kernel key and the kernel scale factor for a lithology.
+        """
+        if not self.magcalc:
+            return ('grav',), props['density']-props['bdensity']
+
+        m3 = magnetisation(props)
+        mt = np.sqrt(m3 @ m3)
+        if mt == 0.:
+            return None, 0.
+
+        mdir = tuple(np.round(m3/mt, 10))
+        return ('mag', mdir, props['finc'], props['fdec'],
+                props['theta']), mt
+
+    def kernel(self, key):
+        """ Calculates (or gets from the cache) a kernel """
+        if key in self.kernels:
+            INSTR.count('kernel cache hits')
+            return self.kernels[key]
+
+        lmod = self.lmod
+        lith = GeoData(None, self.numx, self.numy, self.numz, lmod.dxy,
+                       lmod.d_z, lmod.mht, lmod.ght)
+        lith.showtext = self.showtext
+
+        if key[0] == 'grav':
+            lith.density = 1.
+            lith.bdensity = 0.
+            lith.calc_origin_grav()
+            layers = lith.glayers
+        else:
+            # Unit magnetisation in direction mdir, as a remanent vector
+            mdir, finc, fdec, theta = key[1:]
+            lith.theta = theta
+            lith.finc = finc
+            lith.fdec = fdec
+            lith.susc = 0.
+            lith.mstrength = 0.01
+            lith.minc = np.rad2deg(np.arcsin(np.clip(mdir[2], -1., 1.)))
+            lith.mdec = np.rad2deg(np.arctan2(mdir[1], mdir[0]))+theta
+            lith.calc_origin_mag()
+            layers = lith.mlayers
+
+        layers = np.ascontiguousarray(layers, dtype=np.float64)
+        INSTR.count('kernel bytes', layers.nbytes)
+        self.kernels[key] = layers
+        return layers
+
+    def partial(self, key, modind, mijk, hcorflat):
+        """ Sum of a kernel over all cells of one lithology """
+        layers = self.kernel(key)
+        numx = self.numx
+        numy = self.numy
+
+        i, j, k = np.nonzero(modind == mijk)
+        iuni = np.array(np.unique(i), dtype=np.int32)
+        juni = np.array(np.unique(j), dtype=np.int32)
+        kuni = np.array(np.unique(k), dtype=np.int32)
+
+        mgval = np.zeros(numx*numy)
+        mgvalin = np.zeros(numx*numy)
+        with INSTR.span('partial field', lith_index=int(mijk)):
+            INSTR.count('voxels summed', i.size)
+            for k in kuni:
+                mgvalin += sum_fields(k, mgval, numx, numy, modind,
+                                      self.aaa[0], self.aaa[1], layers,
+                                      hcorflat, mijk, juni, iuni)
+
+        mgvalin.resize([numx, numy])
+        return mgvalin.T[::-1]
+
+    @INSTR.span('batch_calc')
+    def run(self, scenarios):
+        """
+        Calculates all scenarios.
+
+        Parameters
+        ----------
+        scenarios : list
+            list of scenario dictionaries
+
+        Returns
+        -------
+        output : list
+            list of PyGMI raster Data, one for each scenario
+        """
+        # Work out which partial fields are needed for each scenario
+        tasks = {}
+        recipes = []
+        for scenario in scenarios:
+            modind = scenario.get('lith_index', self.lmod.lith_index)
+            modind = np.asarray(modind)
+            if modind.shape != (self.numx, self.numy, self.numz):
+                raise ValueError('lith_index has the wrong shape for '
+                                 'scenario '+str(scenario.get('name')))
+
+            tmp = np.copy(modind)
+            tmp[tmp > -1] = 0
+            hcorflat = self.numz-np.abs(tmp.sum(2)).flatten()
+            hdigest = _digest(hcorflat)
+
+            recipe = []
+            props = self.lith_props(scenario)
+            for mijk in np.unique(modind):
+                if mijk not in props:
+                    continue
+                key, scale = self.kernel_key(props[mijk])
+                if key is None or scale == 0.:
+                    continue
+                pkey = (key, mijk, _digest(modind == mijk), hdigest)
+                if pkey not in self.partials and pkey not in tasks:
+                    tasks[pkey] = (key, modind, mijk, hcorflat)
+                else:
+                    INSTR.count('partial cache hits')
+                recipe.append((pkey, scale))
+            recipes.append(recipe)
+
+        self.showtext('Scenarios: '+str(len(scenarios))+', partial fields '
+                      'to calculate: '+str(len(tasks))+', cached: ' +
+                      str(len(self.partials)))
+
+        # Kernels are calculated first, so that the threads share them.
+        for key in set(i[0] for i in tasks.values()):
+            self.kernel(key)
+
+        partial = INSTR.bind(self.partial)
+        with ThreadPoolExecutor(self.nthreads) as pool:
+            futures = {pkey: pool.submit(partial, *task)
+                       for pkey, task in tasks.items()}
+            for pkey, future in futures.items():
+                self.partials[pkey] = future.result()
+
+        if self.magcalc:
+            ctxt = 'Calculated Magnetics'
+            units = 'nT'
+        else:
+            ctxt = 'Calculated Gravity'
+            units = 'mgal'
+
+        regional = 0.
+        if not self.magcalc and 'Gravity Regional' in self.lmod.griddata:
+            regional = gridmatch(self.lmod, ctxt, 'Gravity Regional')
+
+        output = []
+        for i, recipe in enumerate(recipes):
+            mgval = np.zeros([self.numy, self.numx])
+            for pkey, scale in recipe:
+                mgval += scale*self.partials[pkey]
+
+            dat = self.lmod.init_grid(np.ma.array(mgval+regional))
+            dat.dataid = scenarios[i].get('name', 'Scenario '+str(i+1))
+            dat.units = units
+            dat.wkt = self.lmod.griddata[ctxt].wkt
+            output.append(dat)
+
+        return output
+
+
+def batch_calc(lmod, scenarios, magcalc=False, nthreads=None,
+               showtext=None, filename=None):
+    """
+    Calculates the gravity or magnetic response of many model scenarios.
+
+    Parameters
+    ----------
+    lmod : LithModel
+        PyGMI lithological model, used as the base for all scenarios
+    scenarios : list
+        list of scenario dictionaries. See the module documentation.
+    magcalc : bool
+        if true, calculates magnetic data, otherwize gravity.
+    nthreads : int
+        number of threads. Defaults to the number of processors.
+    showtext : module
+        showtext routine if available. (internal use)
+    filename : str
+        if given, the stack of calculated grids is saved to this GeoTiff.
+
+    Returns
+    -------
+    output : list
+        list of PyGMI raster Data, one for each scenario
+    """
+    lmod.update_lithlist()
+    bcalc = BatchCalc(lmod, magcalc, nthreads, showtext)
+    output = bcalc.run(scenarios)
+
+    if filename is not None:
+        from pygmi.raster.iodefs import ExportData
+        exp = ExportData(None)
+        exp.ifile = filename
+        exp.export_gdal(output, 'GTiff')
+
+    return output
@@ -727,6 +727,11 @@ class MyMplCanvas(FigureCanvas):
             xdata = col
             ydata = row
 
+            # Nothing to redraw if the pen is still in the same cell
+            if (self.newline is False and xdata == self.xold and
+                    ydata == self.yold):
+                return
+
             if self.newline is True:
                 self.newline = False
                 self.set_mdata(xdata, ydata)
@@ -779,18 +784,7 @@ class MyMplCanvas(FigureCanvas):
 
     def luttodat(self, dat):
         """ lut to dat grid """
-        mlut = self.lmod.mlut
-        tmp = np.zeros([dat.shape[0], dat.shape[1], 4])
-
-        for i in np.unique(dat):
-            if i == -1:
-                ctmp = [0, 0, 0, 0]
-            else:
-                ctmp = np.array(mlut[i]+[255])/255.
-
-            tmp[dat[::-1] == i] = ctmp
-
-        return tmp
+        return misc.lith_rgba(dat, self.lmod.mlut)
 
     def init_grid(self, dat, extent, dat2, opac):
         """ Updates the single color map """
@@ -49,6 +49,7 @@ class ProfileDisplay(object):
         self.curprof = 0
         self.pcntmax = len(self.xnodes)-1
         self.viewmagnetics = True
+        self.pcache = {}
 
         self.userint = QtWidgets.QWidget()
 
@@ -197,19 +198,13 @@ class ProfileDisplay(object):
         top = self.lmod1.zrange[1]
 
         data = self.lmod1.griddata['Calculated Gravity']
-        xxx, yyy, right = self.cp_init(data)
+        right = self.cp_init(data)[2]
+        x, y, crdend = self.cp_index(data)
 
-        tmp = np.transpose([xxx, yyy]).astype(int)
-        self.mmc.crd = tmp
+        self.mmc.crd = np.transpose([x, y])
+        self.mmc.crdend = crdend
 
-        x = np.array(xxx).astype(int)
-        y = np.array(yyy).astype(int)
-
-        gtmp = []
-        for i in range(self.lmod1.numz):
-            gtmp.append(self.lmod1.lith_index[x, y, i])
-
-        gtmp = np.array(gtmp[::-1])
+        gtmp = self.lmod1.lith_index[x, y, :].T[::-1]
     # First we plot the model stuff
         left = 0
 
@@ -229,7 +224,36 @@ class ProfileDisplay(object):
             self.mmc.init_grid(gtmp, extent, gtmpl, opac)
 
     def cp_init(self, data):
-        """ Initializes stuff for custom profile """
+        """ Initializes stuff for custom profile. The sample positions are
+        cached per profile and grid. """
+        key = (tuple(self.xnodes[self.curprof]),
+               tuple(self.ynodes[self.curprof]), data.tlx, data.tly,
+               data.xdim, data.ydim, data.rows)
+        if key not in self.pcache:
+            self.pcache[key] = self.cp_calc(data)
+        return self.pcache[key][:3]
+
+    def cp_index(self, data):
+        """
+        Model cell index map for the current custom profile.
+
+        Returns
+        -------
+        x : numpy array
+            model column of each sample
+        y : numpy array
+            model row of each sample
+        crdend : numpy array
+            index of the last sample in the same model cell, for each sample
+        """
+        self.cp_init(data)
+        key = (tuple(self.xnodes[self.curprof]),
+               tuple(self.ynodes[self.curprof]), data.tlx, data.tly,
+               data.xdim, data.ydim, data.rows)
+        return self.pcache[key][3:]
+
+    def cp_calc(self, data):
+        """ Calculates sample positions and index maps for custom profile """
         x_0, x_1 = self.xnodes[self.curprof]
         y_0, y_1 = self.ynodes[self.curprof]
 
@@ -244,7 +268,16 @@ class ProfileDisplay(object):
         xxx = np.linspace(x_0, x_1, rcell, False)
         yyy = np.linspace(y_0, y_1, rcell, False)
 
-        return xxx, yyy, rdist
+        x = xxx.astype(int)
+        y = yyy.astype(int)
+
+# Samples in the same cell are consecutive, since the profile is straight.
+        newcell = np.ones(x.size, dtype=bool)
+        newcell[1:] = np.logical_or(x[1:] != x[:-1], y[1:] != y[:-1])
+        cellend = np.append(np.nonzero(newcell)[0][1:]-1, x.size-1)
+        crdend = cellend[np.cumsum(newcell)-1]
+
+        return xxx, yyy, rdist, x, y, crdend
 
     def export_csv(self):
         """ Export Profile to csv """
@@ -312,6 +345,7 @@ class ProfileDisplay(object):
         self.xnodes = self.lmod1.custprofx
         self.ynodes = self.lmod1.custprofy
         self.pcntmax = len(self.xnodes)-1
+        self.pcache = {}
 
         misc.update_lith_lw(self.lmod1, self.lw_prof_defs)
 
@@ -341,12 +375,14 @@ class ProfileDisplay(object):
         data = self.lmod1.griddata['Calculated Gravity']
         xxx, yyy = self.cp_init(data)[:2]
 
-        gtmp = self.mmc.mdata[::-1].T.copy()
-        rows, cols = gtmp.shape
+        gtmp = self.mmc.mdata[::-1].T
+        if gtmp.shape[0] != xxx.size:
+            return
 
-        for j in range(cols):
-            for i in range(rows):
-                self.lmod1.lith_index[int(xxx[i]), int(yyy[i]), j] = gtmp[i, j]
+# Where several samples fall in the same model cell, the last one is used.
+        x, y, crdend = self.cp_index(data)
+        last = (crdend == np.arange(crdend.size))
+        self.lmod1.lith_index[x[last], y[last], :gtmp.shape[1]] = gtmp[last]
 
     def update_plot(self, slide=False):
         """ Update the profile on the model view """
@@ -444,6 +480,7 @@ class MyMplCanvas(FigureCanvas):
         self.xlabel = 'Eastings (m)'
         self.plotisinit = False
         self.crd = None
+        self.crdend = None
 
 # Events
         self.figure.canvas.mpl_connect('motion_notify_event', self.move)
@@ -527,6 +564,11 @@ class MyMplCanvas(FigureCanvas):
             xdata = col
             ydata = row
 
+            # Nothing to redraw if the pen is still in the same cell
+            if (self.newline is False and xdata == self.xold and
+                    ydata == self.yold):
+                return
+
             if self.newline is True:
                 self.newline = False
                 self.set_mdata(xdata, ydata)
@@ -574,14 +616,9 @@ class MyMplCanvas(FigureCanvas):
         if yend > gheight:
             yend = gheight
 
-        i = xstart
-        while i < xend:
-            tmp = (self.crd == self.crd[i])
-            tmp = np.logical_and(tmp[:, 0], tmp[:, 1])
-            tmp = tmp.nonzero()[0]
-            if tmp[-1] >= xend:
-                xend = tmp[-1]+1
-            i += 1
+        # Extend the edit to all samples in the same model cell.
+        if xstart < xend:
+            xend = max(xend, self.crdend[xend-1]+1)
 
         if xstart < xend and ystart < yend:
             mtmp = self.mdata[ystart:yend, xstart:xend]
@@ -589,18 +626,7 @@ class MyMplCanvas(FigureCanvas):
 
     def luttodat(self, dat):
         """ lut to dat grid """
-        mlut = self.lmod.mlut
-        tmp = np.zeros([dat.shape[0], dat.shape[1], 4])
-
-        for i in np.unique(dat):
-            if i == -1:
-                ctmp = [0, 0, 0, 0]
-            else:
-                ctmp = np.array(mlut[i]+[255])/255.
-
-            tmp[dat[::-1] == i] = ctmp
-
-        return tmp
+        return misc.lith_rgba(dat, self.lmod.mlut)
 
     def init_grid(self, dat, extent, dat2, opac):
         """ Updates the single color map """
@@ -36,6 +36,7 @@ from matplotlib.figure import Figure
 from matplotlib import collections as mc
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as \
     NavigationToolbar
+from pygmi.raster.ginterp import histcomp_limits
 
 
 class MyMplCanvas(FigureCanvas):
@@ -525,24 +526,7 @@ def histcomp(img, nbr_bins=256, perc=5.):
     tmp = img.compressed()
 
     imhist, bins = np.histogram(tmp, nbr_bins)
-
-    cdf = imhist.cumsum()  # cumulative distribution function
-    cdf = cdf / float(cdf[-1])  # normalize
-
-    perc = perc/100.
-
-    sindx = np.arange(nbr_bins)[cdf > perc][0]
-    eindx = np.arange(nbr_bins)[cdf < (1-perc)][-1]+1
-    svalue = bins[sindx]
-    evalue = bins[eindx]
-
-    scnt = perc*(nbr_bins-1)
-    if scnt > sindx:
-        scnt = sindx
-
-    ecnt = perc*(nbr_bins-1)
-    if ecnt > ((nbr_bins-1)-eindx):
-        ecnt = (nbr_bins-1)-eindx
+    svalue, evalue = histcomp_limits(imhist, bins, perc)
 
     img2 = np.empty_like(img, dtype=np.float32)
     np.copyto(img2, img)
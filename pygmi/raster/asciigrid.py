@@ -0,0 +1,385 @@
+# -----------------------------------------------------------------------------
+# Name:        asciigrid.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2018 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+""" Streaming text grid formats.
+
+Readers and writers for ESRI ASCII grids (*.asc), ASCII grids with a .hdr
+header and XYZ files. Text is read and written in chunks of about
+CHUNKBYTES, and numbers are converted in bulk by numpy, so memory use is
+close to the size of the grid rather than several times the size of the
+file.
+"""
+
+import warnings
+import numpy as np
+from pygmi.raster.datatypes import Data
+from pygmi.misc import INSTR
+import pygmi.raster.tiles as tiles
+
+CHUNKBYTES = 2**24
+
+
+def parse_values(text):
+    """
+    Converts whitespace separated numbers to an array.
+
+    Parameters
+    ----------
+    text : str
+        numbers separated by spaces, tabs or line breaks
+
+    Returns
+    -------
+    numpy array
+        values
+    """
+# numpy only warns, and stops, at the first value it cannot read.
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        try:
+            return np.fromstring(text, sep=' ')
+        except (ValueError, DeprecationWarning):
+            raise ValueError('Could not read values from the file')
+
+
+def read_values(fno, count=None, prefix='', chunkbytes=None, comma=False):
+    """
+    Reads whitespace separated numbers from an open text file, one chunk at
+    a time.
+
+    Parameters
+    ----------
+    fno : file
+        open text file
+    count : int
+        number of values expected. If given, the output is allocated once
+        and reading stops after count values.
+    prefix : str
+        text already read from the file, which comes before the rest
+    chunkbytes : int
+        size of the chunks. Defaults to CHUNKBYTES.
+    comma : bool
+        if True, commas are also separators.
+
+    Returns
+    -------
+    out : numpy array
+        values
+    """
+    if chunkbytes is None:
+        chunkbytes = CHUNKBYTES
+
+    if count is not None:
+        out = np.empty(count)
+    else:
+        out = []
+    npts = 0
+    nbytes = 0
+    rest = prefix
+
+    while True:
+        text = fno.read(chunkbytes)
+        nbytes += len(text)
+        last = not text
+        text = rest+text
+        rest = ''
+
+# A chunk may end part of the way through a number, so that part is kept
+# for the next chunk.
+        if not last:
+            idx = max(text.rfind(i) for i in ' \t\n\r')
+            rest = text[idx+1:]
+            text = text[:idx+1]
+
+        if text and not text.isspace():
+            if comma:
+                text = text.replace(',', ' ')
+            vals = parse_values(text)
+            if count is None:
+                out.append(vals)
+            else:
+                vals = vals[:count-npts]
+                out[npts:npts+vals.size] = vals
+            npts += vals.size
+
+        if last or npts == count:
+            break
+
+    INSTR.count('bytes read', nbytes)
+    if count is None:
+        return np.concatenate(out) if out else np.empty(0)
+    if npts < count:
+        raise ValueError('The file has fewer values than expected')
+    return out
+
+
+def str_rows(block):
+    """
+    Converts a block of rows to text. Each value uses the shortest text
+    which reads back to the same value, which is the same as str() of the
+    numpy value.
+
+    Parameters
+    ----------
+    block : numpy array
+        2D array of values
+
+    Returns
+    -------
+    list
+        list of rows, each an iterable of strings
+    """
+    if block.dtype.kind == 'f' and block.dtype.itemsize < 8:
+        return block.astype(str).tolist()
+# float64 and integers use repr of the Python values. numpy's astype(str) is
+# slower for these, and '%.17g' (as in savetxt) is not the shortest text. All
+# of these are about 1 million values a second, so writing text is bound by
+# number formatting.
+    return [map(repr, i) for i in block.tolist()]
+
+
+def format_rows(block):
+    """
+    Formats a block of rows as lines of text, with str_rows.
+
+    Parameters
+    ----------
+    block : numpy array
+        2D array of values
+
+    Returns
+    -------
+    str
+        lines of text
+    """
+    return ''.join([' '.join(i)+'\n' for i in str_rows(block)])
+
+
+def _grid_data(data, ifile, nval, xdim, ydim, tlx, tly):
+    """ Makes a PyGMI raster dataset from a grid read from a text file """
+    mask = np.isnan(data)
+    if nval is not None:
+        mask |= (data == nval)
+    else:
+        nval = 1e+20
+
+    dat = Data()
+    dat.data = np.ma.array(data, mask=mask, copy=False)
+    dat.nrofbands = 1
+    dat.tlx = tlx
+    dat.tly = tly
+    dat.xdim = xdim
+    dat.ydim = ydim
+    dat.rows, dat.cols = data.shape
+    dat.nullvalue = nval
+    bname = ifile.replace('\\', '/').rpartition('/')[-1]
+    dat.dataid = bname.rpartition('.')[0]
+    dat.gtr = (tlx, xdim, 0.0, tly, 0.0, -ydim)
+    return dat
+
+
+def get_esri_ascii(ifile, chunkbytes=None):
+    """
+    Imports an ESRI ASCII grid.
+
+    Parameters
+    ----------
+    ifile : str
+        filename to import
+    chunkbytes : int
+        size of the chunks read at a time
+
+    Returns
+    -------
+    dat : list
+        list with one PyGMI raster Data
+    """
+    header = {}
+    with open(ifile) as fno:
+        while True:
+            line = fno.readline()
+            tmp = line.split()
+            if line == '':
+                break
+            if not tmp:
+                continue
+            try:
+                float(tmp[0])
+                break
+            except ValueError:
+                header[tmp[0].lower()] = float(tmp[1])
+
+        ncols = int(header['ncols'])
+        nrows = int(header['nrows'])
+        xdim = header.get('dx', header.get('cellsize'))
+        ydim = header.get('dy', header.get('cellsize'))
+        nval = header.get('nodata_value', -9999.)
+
+        data = read_values(fno, nrows*ncols, line, chunkbytes)
+        data.shape = (nrows, ncols)
+
+    if 'xllcenter' in header:
+        tlx = header['xllcenter']-xdim/2
+    else:
+        tlx = header['xllcorner']
+    if 'yllcenter' in header:
+        tly = header['yllcenter']-ydim/2+nrows*ydim
+    else:
+        tly = header['yllcorner']+nrows*ydim
+
+    return [_grid_data(data, ifile, nval, xdim, ydim, tlx, tly)]
+
+
+def _spacing(vals):
+    """ Smallest spacing between distinct coordinates """
+    vals = np.unique(vals)
+    if vals.size < 2:
+        return 1.0
+    diff = np.diff(vals)
+    diff = diff[diff > 1e-6*(vals[-1]-vals[0])]
+    return diff.min()
+
+
+def get_xyz(ifile, nval=None, chunkbytes=None):
+    """
+    Imports a regular grid from an XYZ file. Coordinates are cell centres,
+    and cells which are not in the file are masked.
+
+    Parameters
+    ----------
+    ifile : str
+        filename to import
+    nval : float
+        nodata value, if the file has one
+    chunkbytes : int
+        size of the chunks read at a time
+
+    Returns
+    -------
+    dat : list
+        list with one PyGMI raster Data
+    """
+    with open(ifile) as fno:
+        line = fno.readline()
+        try:
+            float(line.replace(',', ' ').split()[0])
+        except (ValueError, IndexError):
+            line = ''  # column names
+        vals = read_values(fno, None, line, chunkbytes, comma=True)
+
+    if vals.size % 3 != 0:
+        raise ValueError(ifile+' does not have three columns')
+    vals.shape = (-1, 3)
+    xxx = vals[:, 0]
+    yyy = vals[:, 1]
+
+    xdim = _spacing(xxx)
+    ydim = _spacing(yyy)
+    xmin = xxx.min()
+    ymax = yyy.max()
+    cols = int(round((xxx.max()-xmin)/xdim))+1
+    rows = int(round((ymax-yyy.min())/ydim))+1
+
+    data = np.full((rows, cols), np.nan)
+    col = np.rint((xxx-xmin)/xdim).astype(np.intp)
+    row = np.rint((ymax-yyy)/ydim).astype(np.intp)
+    data[row, col] = vals[:, 2]
+
+    return [_grid_data(data, ifile, nval, xdim, ydim, xmin-xdim/2,
+                       ymax+ydim/2)]
+
+
+def _rows_per_chunk(cols, chunkbytes):
+    """ Number of rows of text in a chunk """
+    if chunkbytes is None:
+        chunkbytes = CHUNKBYTES
+    return max(1, chunkbytes//(cols*24))
+
+
+def export_esri_ascii(ofile, dat, chunkbytes=None):
+    """
+    Exports an ESRI ASCII grid. Bands which have not been loaded are read
+    one chunk at a time.
+
+    Parameters
+    ----------
+    ofile : str
+        output filename
+    dat : PyGMI raster Data
+        dataset to export
+    chunkbytes : int
+        approximate size of the chunks written at a time
+    """
+    source = tiles.band_source(dat)
+    rows, cols = source.shape
+
+    with open(ofile, 'w') as fno:
+        fno.write('ncols \t\t\t' + str(cols) + '\n')
+        fno.write('nrows \t\t\t' + str(rows) + '\n')
+        fno.write('xllcorner \t\t\t' + str(dat.tlx) + '\n')
+        fno.write('yllcorner \t\t\t' + str(dat.tly - rows*dat.ydim) + '\n')
+        if dat.xdim == dat.ydim:
+            fno.write('cellsize \t\t\t' + str(dat.xdim) + '\n')
+        else:
+            fno.write('dx \t\t\t' + str(dat.xdim) + '\n')
+            fno.write('dy \t\t\t' + str(dat.ydim) + '\n')
+        fno.write('nodata_value \t\t' + str(dat.nullvalue) + '\n')
+
+        nrows = _rows_per_chunk(cols, chunkbytes)
+        for row0 in range(0, rows, nrows):
+            block = source.read(row0, min(rows, row0+nrows))
+            fno.write(format_rows(block.filled(dat.nullvalue)))
+
+
+def export_xyz(ofile, dat, chunkbytes=None):
+    """
+    Exports an XYZ file, with the coordinates of cell centres. Bands which
+    have not been loaded are read one chunk at a time.
+
+    Parameters
+    ----------
+    ofile : str
+        output filename
+    dat : PyGMI raster Data
+        dataset to export
+    chunkbytes : int
+        approximate size of the chunks written at a time
+    """
+    source = tiles.band_source(dat)
+    rows, cols = source.shape
+
+    xxx = dat.tlx+(np.arange(cols)+0.5)*dat.xdim
+    xxx = [i+' ' for i in map(repr, xxx.tolist())]
+    yyy = dat.tly-(np.arange(rows)+0.5)*dat.ydim
+
+    with open(ofile, 'w') as fno:
+        nrows = _rows_per_chunk(cols, chunkbytes)
+        for row0 in range(0, rows, nrows):
+            block = source.read(row0, min(rows, row0+nrows))
+            block = format_rows(block.filled(dat.nullvalue)).split('\n')
+            text = []
+            for i, line in enumerate(block[:-1]):
+                ystr = repr(float(yyy[row0+i]))+' '
+                text += [j+ystr+k+'\n' for j, k in zip(xxx, line.split())]
+            fno.write(''.join(text))
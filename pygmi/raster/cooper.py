@@ -34,7 +34,10 @@ import copy
 from PyQt5 import QtWidgets, QtCore
 import numpy as np
 import scipy.signal as si
+from numba import jit, prange
 import pygmi.menu_default as menu_default
+import pygmi.raster.spectral as spectral
+import pygmi.raster.tiles as tiles
 
 
 class Gradients(QtWidgets.QDialog):
@@ -112,10 +115,15 @@ class Gradients(QtWidgets.QDialog):
         self.azi = self.sb_azi.value()
         self.order = self.sb_order.value()
 
-        data = copy.deepcopy(self.indata['Raster'])
+        data = [copy.copy(i) for i in self.indata['Raster']]
+
+# np.gradient needs one extra row on each side of a strip.
+        def func(blk):
+            """ Gradients of a strip """
+            return gradients(blk, self.azi, 0., self.order)
 
         for i in self.pbar.iter(range(len(data))):
-            data[i].data = gradients(data[i].data, self.azi, 0., self.order)
+            data[i].data = tiles.run_tiles(func, [data[i]], 1, nthreads=None)
 
         self.outdata['Raster'] = data
 
@@ -367,65 +375,23 @@ def visibility2d(data, wsize, dh, piter=iter):
     """
 
     nr, nc = np.shape(data)
-    wsize = abs(np.real(wsize))
+    wsize = int(abs(np.real(wsize)))
     w2 = int(np.floor(wsize/2))
-    vn = np.zeros([nr, nc])
-    vs = np.zeros([nr, nc])
-    ve = np.zeros([nr, nc])
-    vw = np.zeros([nr, nc])
-    vd1 = np.zeros([nr, nc])
-    vd2 = np.zeros([nr, nc])
-    vd3 = np.zeros([nr, nc])
-    vd4 = np.zeros([nr, nc])
-    vstd = np.zeros([nr, nc])
     mask = np.ma.getmaskarray(data)
     mean = data.mean()
-    data = data.data
+    data = np.ma.getdata(data).copy()
     data[mask] = mean
+    data = data.astype(np.float64)
 
-    for j in piter(range(nc)):    # Columns
-        for i in range(w2, nr-w2):
-            dtmp = data[i-w2:i+w2+1, j]
-            vn[i, j] = __visible1(dtmp, wsize, w2+1, dh)
-            vs[i, j] = __visible2(dtmp, wsize, w2+1, dh)
-
-    for j in piter(range(w2, nc-w2)):    # Rows
-        for i in range(nr):
-            dtmp = data[i, j-w2:j+w2+1]
-            ve[i, j] = __visible1(dtmp, wsize, w2+1, dh)
-            vw[i, j] = __visible2(dtmp, wsize, w2+1, dh)
-
-    for j in piter(range(w2, nc-w2)):
-        for i in range(w2, nr-w2):
-            dtmp = np.zeros(wsize)
-            for k in range(wsize):
-                dtmp[k] = data[i-w2+k, j-w2+k]
-            vd1[i, j] = __visible1(dtmp, wsize, w2+1, dh)
-            vd2[i, j] = __visible2(dtmp, wsize, w2+1, dh)
-            dtmp = np.zeros(wsize)
-            for k in range(wsize):
-                dtmp[k] = data[i+w2-k, j-w2+k]
-            vd3[i, j] = __visible1(dtmp, wsize, w2+1, dh)
-            vd4[i, j] = __visible2(dtmp, wsize, w2+1, dh)
-
-    vtot = vn+vs+ve+vw+vd1+vd2+vd3+vd4
-    vtot = vtot[w2:nr-w2, w2:nc-w2]
-
-    for j in piter(range(nc)):
-        for i in range(nr):
-            vstd[i, j] = np.std([vn[i, j], vs[i, j], ve[i, j], vw[i, j],
-                                 vd1[i, j], vd2[i, j], vd3[i, j],
-                                 vd4[i, j]], ddof=1)
+    vtot = np.zeros([nr-2*w2, nc-2*w2])
+    vstd = np.zeros([nr-2*w2, nc-2*w2])
+    vsum = np.zeros([nr-2*w2, nc-2*w2])
 
-    vstd = vstd[w2:nr-w2, w2:nc-w2]
-
-    dtr = np.pi/180
-    c45 = np.cos(45*dtr)
-    s45 = np.sin(45*dtr)
-    vsumx = ve-vw+vd1*c45-vd2*c45+vd3*c45-vd4*c45
-    vsumy = vn-vs+vd1*s45-vd2*s45-vd3*s45+vd4*s45
-    vsum = np.sqrt(vsumx*vsumx+vsumy*vsumy)
-    vsum = vsum[w2:nr-w2, w2:nc-w2]
+# The rows are done in blocks, so that progress can be shown.
+    rstep = 64
+    for i in piter(range(w2, nr-w2, rstep)):
+        __visibility_rows(data, wsize, dh, i, min(i+rstep, nr-w2), vtot,
+                          vstd, vsum)
 
     vtot = np.ma.array(vtot)
     vstd = np.ma.array(vstd)
@@ -437,6 +403,55 @@ def visibility2d(data, wsize, dh, piter=iter):
     return vtot, vstd, vsum
 
 
+@jit(nopython=True, parallel=True)
+def __visibility_rows(data, wsize, dh, rstart, rend, vtot, vstd, vsum):
+    """
+    Visibility in the eight directions, for rows rstart to rend. Each row is
+    done in parallel. Output rows and columns are offset by wsize//2.
+    """
+    nc = data.shape[1]
+    w2 = wsize//2
+    c45 = np.cos(45*np.pi/180)
+    s45 = np.sin(45*np.pi/180)
+
+    for i in prange(rstart, rend):
+        dtmp = np.zeros(wsize)
+        vis = np.zeros(8)
+        for j in range(w2, nc-w2):
+            for k in range(wsize):
+                dtmp[k] = data[i-w2+k, j]
+            vis[0] = __visible1(dtmp, wsize, w2+1, dh)  # vn
+            vis[1] = __visible2(dtmp, wsize, w2+1, dh)  # vs
+            for k in range(wsize):
+                dtmp[k] = data[i, j-w2+k]
+            vis[2] = __visible1(dtmp, wsize, w2+1, dh)  # ve
+            vis[3] = __visible2(dtmp, wsize, w2+1, dh)  # vw
+            for k in range(wsize):
+                dtmp[k] = data[i-w2+k, j-w2+k]
+            vis[4] = __visible1(dtmp, wsize, w2+1, dh)  # vd1
+            vis[5] = __visible2(dtmp, wsize, w2+1, dh)  # vd2
+            for k in range(wsize):
+                dtmp[k] = data[i+w2-k, j-w2+k]
+            vis[6] = __visible1(dtmp, wsize, w2+1, dh)  # vd3
+            vis[7] = __visible2(dtmp, wsize, w2+1, dh)  # vd4
+
+            total = vis.sum()
+            mean = total/8
+            var = 0.
+            for k in range(8):
+                var += (vis[k]-mean)**2
+
+            vsumx = (vis[2]-vis[3]+vis[4]*c45-vis[5]*c45+vis[6]*c45 -
+                     vis[7]*c45)
+            vsumy = (vis[0]-vis[1]+vis[4]*s45-vis[5]*s45-vis[6]*s45 +
+                     vis[7]*s45)
+
+            vtot[i-w2, j-w2] = total
+            vstd[i-w2, j-w2] = np.sqrt(var/7)
+            vsum[i-w2, j-w2] = np.sqrt(vsumx*vsumx+vsumy*vsumy)
+
+
+@jit(nopython=True)
 def __visible1(dat, nr, cp, dh):
     """ Visible 1 """
     num = 1
@@ -454,6 +469,7 @@ def __visible1(dat, nr, cp, dh):
     return num
 
 
+@jit(nopython=True)
 def __visible2(dat, nr, cp, dh):
     """ Visible 2 """
     num = 0
@@ -621,9 +637,7 @@ def tilt1(data, azi, s):
 #    dx = dx.astype(np.float64)
 #    dy = dy.astype(np.float64)
     dxtot = np.ma.sqrt(dx*dx+dy*dy)
-    nmax = np.max([nr, nc])
-    npts = int(2**__nextpow2(nmax))
-    dz = vertical(data, npts, 1)
+    dz = vertical(data)
     t1 = np.ma.arctan(dz/dxtot)
     th = np.real(np.arctanh(np.nan_to_num(dz/dxtot)+(0+0j)))
     tdx = np.real(np.ma.arctan(dxtot/abs(dz)))
@@ -641,7 +655,7 @@ def tilt1(data, azi, s):
     se = np.ones([s, s])/(s*s)
     ts = si.convolve2d(t1, se, 'same')
     [dxs, dys] = np.gradient(ts)
-    dzs = vertical(ts, npts, 1)
+    dzs = vertical(ts)
     dxtots = np.ma.sqrt(dxs*dxs+dys*dys)
     t2 = np.ma.arctan(dzs/dxtots)
 
@@ -658,112 +672,24 @@ def tilt1(data, azi, s):
     return t1, th, t2, ta, tdx
 
 
-def __nextpow2(n):
-    """ nextpow2 """
-    m_i = np.ceil(np.log2(n))
-    return m_i
-
-
 def vertical(data, npts=None, xint=1):
-    """ Vertical """
+    """
+    Vertical derivative, calculated in the frequency domain.
 
-    nr, nc = data.shape
+    Parameters
+    ----------
+    data : numpy masked array
+        input grid
+    npts : int
+        size of a square padded grid. By default each dimension is padded
+        to a fast FFT length.
+    xint : float
+        grid spacing
 
-    if npts is None:
-        nmax = np.max([nr, nc])
-        npts = int(2**__nextpow2(nmax))
-
-    cdiff = int(np.floor((npts-nc)/2))
-    rdiff = int(np.floor((npts-nr)/2))
-    data1 = __taper2d(data, npts, nc, nr, cdiff, rdiff)
-
-    f = np.fft.fft2(data1)
-    fz = f
-    wn = 2.0*np.pi/(xint*(npts-1))
-    f = np.fft.fftshift(f)
-    cx = npts/2+1
-    cy = cx
-    for i in range(npts):
-        freqx = (i+1-cx)*wn
-        for j in range(npts):
-            freqy = (j+1-cy)*wn
-            freq = np.sqrt(freqx*freqx+freqy*freqy)
-            fz[i, j] = f[i, j]*freq
-    fz = np.fft.fftshift(fz)
-    fzinv = np.fft.ifft2(fz)
-    dz = np.real(fzinv[rdiff:nr+rdiff, cdiff:nc+cdiff])
-
-    return dz
-
-
-def __taper2d(g, npts, n, m, ndiff, mdiff):
-    """ Taper 2D """
-
-# n is cols, m is rows
-
-    npts2 = npts-1
-    gm = g.mean()
-    gf = np.zeros([npts, npts])+np.ma.median(g-gm)
-    gf[mdiff:mdiff+m, ndiff:ndiff+n] = g-gm
-
-    for j in range(mdiff, mdiff+m):
-        for i in range(ndiff):
-            gf[i, j] = gf[i, j]*((1+np.sin(-np.pi/2+i*np.pi/ndiff))*0.5)
-            gf[npts2-i, j] = gf[npts2-i, j]*((1+np.sin(-np.pi/2 +
-                                                       i*np.pi/ndiff))*0.5)
-
-    for j in range(mdiff):
-        tmp = ((1+np.sin(-np.pi/2+j*np.pi/(mdiff)))*0.5)
-        for i in range(ndiff, ndiff+n):
-            gf[i, j] = gf[i, j]*tmp
-            gf[i, npts2-j-1] = gf[i, npts2-j-1]*tmp
-
-    for i in range(ndiff):
-        tmp = ((1+np.sin(-np.pi/2+i*np.pi/(ndiff)))*0.5)
-        for j in range(mdiff):
-            gf[i, j] = gf[i, j]*tmp
-            gf[npts2-i, j] = gf[npts2-i, j]*tmp
-
-    for i in range(ndiff):
-        tmp = ((1+np.sin(-np.pi/2+i*np.pi/(ndiff)))*0.5)
-        for j in range(mdiff+m-1, npts):
-            gf[i, j] = gf[i, j]*tmp
-            gf[npts2-i, j] = gf[npts2-i, j]*tmp
-
-    for j in range(mdiff+m-1, npts):  # Corners
-        for i in range(ndiff+n-1, npts):
-            if ndiff == 0 or mdiff == 0:
-                gf[i, j] = np.nan
-            else:
-                gf[i, j] = (gf[i, j] *
-                            np.cos((i+1-ndiff-n)*np.pi/(2*ndiff)) *
-                            np.cos((j+1-ndiff-m)*np.pi/(2*mdiff)))
-
-    for j in range(mdiff):
-        for i in range(ndiff):
-            if ndiff == 0 or mdiff == 0:
-                gf[i, j] = np.nan
-            else:
-                gf[i, j] = (gf[i, j] *
-                            np.cos((i+1-ndiff)*np.pi/(2*ndiff)) *
-                            np.cos((j+1-ndiff)*np.pi/(2*mdiff)))
-
-    for j in range(mdiff):
-        for i in range(ndiff+n-1, npts):
-            if ndiff == 0 or mdiff == 0:
-                gf[i, j] = np.nan
-            else:
-                gf[i, j] = (gf[i, j] *
-                            np.cos((i+1-ndiff-n)*np.pi/(2*ndiff)) *
-                            np.cos((j+1-ndiff)*np.pi/(2*mdiff)))
-
-    for j in range(mdiff+m, npts):
-        for i in range(ndiff):
-            if ndiff == 0 or mdiff == 0:
-                gf[i, j] = np.nan
-            else:
-                gf[i, j] = (gf[i, j] *
-                            np.cos((i+1-ndiff)*np.pi/(2*ndiff)) *
-                            np.cos((j+1-ndiff-m)*np.pi/(2*mdiff)))
-
-    return gf
+    Returns
+    -------
+    dz : numpy array
+        vertical derivative
+    """
+    spec = spectral.spectrum(data, xint, xint, npts)
+    return spec.calc(spec.vertical())
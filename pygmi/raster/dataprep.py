@@ -32,11 +32,17 @@ from collections import Counter
 from PyQt5 import QtWidgets, QtCore
 import numpy as np
 from osgeo import gdal, osr, ogr
-from PIL import Image, ImageDraw
 import scipy.ndimage as ndimage
 import pygmi.menu_default as menu_default
+from pygmi.misc import INSTR
 from pygmi.raster.datatypes import Data
+import pygmi.raster.tiles as tiles
+import pygmi.raster.spectral as spectral
+import pygmi.raster.gridding as gridding
+import pygmi.raster.mosaic as mosaic
+from pygmi.raster.gridding import quickgrid
 from pygmi.vector.datatypes import PData
+from pygmi.vector.clip import Clipper
 
 gdal.PushErrorHandler('CPLQuietErrorHandler')
 
@@ -114,7 +120,8 @@ class DataGrid(QtWidgets.QDialog):
     """
     Grid Point Data
 
-    This class grids point data using a nearest neighbourhood technique.
+    This class grids point data, using a quick nearest neighbourhood
+    technique, inverse distance weighting or minimum curvature.
 
     Attributes
     ----------
@@ -135,6 +142,8 @@ class DataGrid(QtWidgets.QDialog):
 
         self.dsb_dxy = QtWidgets.QDoubleSpinBox()
         self.dataid = QtWidgets.QComboBox()
+        self.method = QtWidgets.QComboBox()
+        self.sb_bdist = QtWidgets.QSpinBox()
         self.label_rows = QtWidgets.QLabel()
         self.label_cols = QtWidgets.QLabel()
 
@@ -147,10 +156,17 @@ class DataGrid(QtWidgets.QDialog):
         helpdocs = menu_default.HelpButton('pygmi.raster.dataprep.datagrid')
         label_band = QtWidgets.QLabel()
         label_dxy = QtWidgets.QLabel()
+        label_method = QtWidgets.QLabel()
+        label_bdist = QtWidgets.QLabel()
 
         self.dsb_dxy.setMaximum(9999999999.0)
         self.dsb_dxy.setMinimum(0.00001)
         self.dsb_dxy.setDecimals(5)
+        self.method.addItems(['Quick Grid', 'Inverse Distance Weighting',
+                              'Minimum Curvature'])
+        self.sb_bdist.setMinimum(1)
+        self.sb_bdist.setMaximum(1000000)
+        self.sb_bdist.setValue(4)
         buttonbox.setOrientation(QtCore.Qt.Horizontal)
         buttonbox.setCenterButtons(True)
         buttonbox.setStandardButtons(buttonbox.Cancel | buttonbox.Ok)
@@ -160,6 +176,8 @@ class DataGrid(QtWidgets.QDialog):
         self.label_cols.setText("Columns: 0")
         label_dxy.setText("Cell Size:")
         label_band.setText("Column to Grid:")
+        label_method.setText("Gridding Method:")
+        label_bdist.setText("Blanking Distance (cells):")
 
         gridlayout_main.addWidget(label_dxy, 0, 0, 1, 1)
         gridlayout_main.addWidget(self.dsb_dxy, 0, 1, 1, 1)
@@ -167,8 +185,12 @@ class DataGrid(QtWidgets.QDialog):
         gridlayout_main.addWidget(self.label_cols, 2, 0, 1, 2)
         gridlayout_main.addWidget(label_band, 3, 0, 1, 1)
         gridlayout_main.addWidget(self.dataid, 3, 1, 1, 1)
-        gridlayout_main.addWidget(helpdocs, 4, 0, 1, 1)
-        gridlayout_main.addWidget(buttonbox, 4, 1, 1, 3)
+        gridlayout_main.addWidget(label_method, 4, 0, 1, 1)
+        gridlayout_main.addWidget(self.method, 4, 1, 1, 1)
+        gridlayout_main.addWidget(label_bdist, 5, 0, 1, 1)
+        gridlayout_main.addWidget(self.sb_bdist, 5, 1, 1, 1)
+        gridlayout_main.addWidget(helpdocs, 6, 0, 1, 1)
+        gridlayout_main.addWidget(buttonbox, 6, 1, 1, 3)
 
         buttonbox.accepted.connect(self.accept)
         buttonbox.rejected.connect(self.reject)
@@ -181,8 +203,8 @@ class DataGrid(QtWidgets.QDialog):
         x = data.xdata
         y = data.ydata
 
-        cols = int(x.ptp()/dxy)
-        rows = int(y.ptp()/dxy)
+        cols = int(np.ptp(x)/dxy)
+        rows = int(np.ptp(y)/dxy)
 
         self.label_rows.setText("Rows: "+str(rows))
         self.label_cols.setText("Columns: "+str(cols))
@@ -202,8 +224,8 @@ class DataGrid(QtWidgets.QDialog):
         x = data.xdata
         y = data.ydata
 
-        dx = x.ptp()/np.sqrt(x.size)
-        dy = y.ptp()/np.sqrt(y.size)
+        dx = np.ptp(x)/np.sqrt(x.size)
+        dy = np.ptp(y)/np.sqrt(y.size)
         dxy = max(dx, dy)
 
         self.dsb_dxy.setValue(dxy)
@@ -219,7 +241,9 @@ class DataGrid(QtWidgets.QDialog):
     def acceptall(self):
         """ accept """
         dxy = self.dsb_dxy.value()
-        data = self.indata['Point'][0]
+        method = self.method.currentText()
+        bdist = self.sb_bdist.value()*dxy
+        showtext = self.parent.showprocesslog
 
         newdat = []
         for data in self.pbar.iter(self.indata['Point']):
@@ -235,7 +259,14 @@ class DataGrid(QtWidgets.QDialog):
                 y = y[filt]
                 z = z[filt]
 
-            tmp = quickgrid(x, y, z, dxy, showtext=self.parent.showprocesslog)
+            if method == 'Inverse Distance Weighting':
+                tmp = gridding.idw(x, y, z, dxy, maxdist=bdist,
+                                   showtext=showtext)
+            elif method == 'Minimum Curvature':
+                tmp = gridding.mincurv(x, y, z, dxy, maxdist=bdist,
+                                       showtext=showtext)
+            else:
+                tmp = quickgrid(x, y, z, dxy, showtext=showtext)
             mask = np.ma.getmaskarray(tmp)
             gdat = tmp.data
 
@@ -384,22 +415,101 @@ class DataMerge(QtWidgets.QDialog):
                                        "Your input projection may be wrong")
             return
 
-        dat = []
-        for data in self.indata['Raster']:
-            doffset = 0.0
-            if data.data.min() <= 0:
-                doffset = data.data.min()-1.
-                data.data -= doffset
-            gtr0 = (data.tlx, data.xdim, 0.0, data.tly, 0.0, -data.ydim)
-            src = data_to_gdal_mem(data, gtr0, orig_wkt, data.cols, data.rows)
-            dest = data_to_gdal_mem(data, gtr, orig_wkt, cols, rows, True)
+        dat = warp_data(self.indata['Raster'], gtr, cols, rows, orig_wkt,
+                        orig_wkt)
+
+        self.outdata['Raster'] = dat
+
+
+class DataMosaic(QtWidgets.QDialog):
+    """
+    Data Mosaic
+
+    This class makes virtual mosaics of raster tiles, such as adjacent
+    survey blocks. Bands with the same name in different tiles are put in
+    the same mosaic. If all names differ, all bands form one mosaic. The
+    mosaic is only calculated when it is used.
+
+    Attributes
+    ----------
+    parent : parent
+        reference to the parent routine
+    indata : dictionary
+        dictionary of input datasets
+    outdata : dictionary
+        dictionary of output datasets
+    """
+    def __init__(self, parent=None):
+        QtWidgets.QDialog.__init__(self, parent)
+
+        self.indata = {}
+        self.outdata = {}
+        self.parent = parent
+
+        self.dsb_dxy = QtWidgets.QDoubleSpinBox()
+        self.rule = QtWidgets.QComboBox()
+
+        self.setupui()
+
+    def setupui(self):
+        """ Setup UI """
+        gridlayout_main = QtWidgets.QGridLayout(self)
+        buttonbox = QtWidgets.QDialogButtonBox()
+        helpdocs = menu_default.HelpButton('pygmi.raster.dataprep.datamosaic')
+        label_dxy = QtWidgets.QLabel()
+        label_rule = QtWidgets.QLabel()
+
+        self.dsb_dxy.setMaximum(9999999999.0)
+        self.dsb_dxy.setMinimum(0.00001)
+        self.dsb_dxy.setDecimals(5)
+        self.rule.addItems(['First', 'Last', 'Mean', 'Feather'])
+        buttonbox.setOrientation(QtCore.Qt.Horizontal)
+        buttonbox.setCenterButtons(True)
+        buttonbox.setStandardButtons(buttonbox.Cancel | buttonbox.Ok)
+
+        self.setWindowTitle("Dataset Mosaic")
+        label_dxy.setText("Cell Size:")
+        label_rule.setText("Overlap Rule:")
+
+        gridlayout_main.addWidget(label_dxy, 0, 0, 1, 1)
+        gridlayout_main.addWidget(self.dsb_dxy, 0, 1, 1, 1)
+        gridlayout_main.addWidget(label_rule, 1, 0, 1, 1)
+        gridlayout_main.addWidget(self.rule, 1, 1, 1, 1)
+        gridlayout_main.addWidget(helpdocs, 2, 0, 1, 1)
+        gridlayout_main.addWidget(buttonbox, 2, 1, 1, 1)
+
+        buttonbox.accepted.connect(self.accept)
+        buttonbox.rejected.connect(self.reject)
+
+    def settings(self):
+        """ Settings """
+        if 'Raster' not in self.indata:
+            return False
+
+        dxy = min(min(i.xdim, i.ydim) for i in self.indata['Raster'])
+        self.dsb_dxy.setValue(dxy)
+        tmp = self.exec_()
 
-            gdal.ReprojectImage(src, dest, orig_wkt, orig_wkt,
-                                gdal.GRA_Bilinear)
+        if tmp == 1:
+            self.acceptall()
+            tmp = True
 
-            dat.append(gdal_to_dat(dest, data.dataid))
-#            dat[-1].data += doffset
-            dat[-1].data = dat[-1].data + doffset
+        return tmp
+
+    def acceptall(self):
+        """ accept """
+        dxy = self.dsb_dxy.value()
+        rule = self.rule.currentText().lower()
+
+        groups = {}
+        for data in self.indata['Raster']:
+            groups.setdefault(data.dataid, []).append(data)
+        if max(len(i) for i in groups.values()) == 1:
+            groups = {'Mosaic': self.indata['Raster']}
+
+        dat = []
+        for dataid, bands in groups.items():
+            dat.append(mosaic.mosaic(bands, dxy, rule, dataid))
 
         self.outdata['Raster'] = dat
 
@@ -479,12 +589,15 @@ class DataReproj(QtWidgets.QDialog):
 # Set transformation
         ctrans = osr.CoordinateTransformation(orig, targ)
 
-# Now create virtual dataset
-        dat = []
-        for data in self.pbar.iter(self.indata['Raster']):
-            datamin = data.data.min()
-            if datamin <= 0:
-                data.data = data.data-(datamin-1)
+# Bands on the same grid are reprojected together, in one warp.
+        groups = {}
+        for i, data in enumerate(self.indata['Raster']):
+            groups.setdefault(_grid_key(data), []).append(i)
+
+        dat = [None]*len(self.indata['Raster'])
+        for index in self.pbar.iter(list(groups.values())):
+            group = [self.indata['Raster'][i] for i in index]
+            data = group[0]
 
 # Work out the boundaries of the new dataset in the target projection
             u_l = ctrans.TransformPoint(data.tlx, data.tly)
@@ -519,28 +632,10 @@ class DataReproj(QtWidgets.QDialog):
                 return
 
 # top left x, w-e pixel size, rotation, top left y, rotation, n-s pixel size
-            old_geo = (data.tlx, data.xdim, 0, data.tly, 0, -data.ydim)
-            src = data_to_gdal_mem(data, old_geo, orig_wkt, data.cols,
-                                   data.rows)
-
             new_geo = (minx, newdim, 0, maxy, 0, -newdim)
-            dest = data_to_gdal_mem(data, new_geo, targ_wkt, cols, rows, True)
-
-            gdal.ReprojectImage(src, dest, orig_wkt, targ_wkt,
-                                gdal.GRA_Bilinear)
-
-            data2 = gdal_to_dat(dest, data.dataid)
-            if datamin <= 0:
-                data2.data = data2.data+(datamin-1)
-                data.data = data.data+(datamin-1)
-            data2.data = np.ma.masked_equal(data2.data.filled(data.nullvalue),
-                                            data.nullvalue)
-            data2.nullvalue = data.nullvalue
-            data2.data = np.ma.masked_invalid(data2.data)
-            data2.data = np.ma.masked_less(data2.data, data.data.min())
-            data2.data = np.ma.masked_greater(data2.data, data.data.max())
-
-            dat.append(data2)
+            tmp = warp_data(group, new_geo, cols, rows, targ_wkt, orig_wkt)
+            for i, data2 in zip(index, tmp):
+                dat[i] = data2
 
         self.outdata['Raster'] = dat
 
@@ -1049,8 +1144,18 @@ class RTP(QtWidgets.QDialog):
 
         self.dataid.addItems(tmp)
 
-        self.dsb_inc.setValue(-62.5)
-        self.dsb_dec.setValue(-16.75)
+# Default to the IGRF field at the centre of the first band, if it has a
+# projection. igrf imports this module, so it is imported here.
+        from pygmi.raster.igrf import data_field
+        try:
+            igrf = data_field(self.indata['Raster'][0])
+        except (ValueError, RuntimeError):
+            igrf = None
+        if igrf is None:
+            igrf = (None, -62.5, -16.75)
+
+        self.dsb_inc.setValue(igrf[1])
+        self.dsb_dec.setValue(igrf[2])
         tmp = self.exec_()
 
         if tmp == 1:
@@ -1077,29 +1182,8 @@ class RTP(QtWidgets.QDialog):
 def rtp(data, I_deg, D_deg):
     """ Reduction to the Pole """
 
-    datamedian = np.ma.median(data.data)
-    ndat = data.data - datamedian
-    ndat.data[ndat.mask] = 0
-
-    fftmod = np.fft.fft2(ndat)
-
-    ny, nx = fftmod.shape
-    nyqx = 1/(2*data.xdim)
-    nyqy = 1/(2*data.ydim)
-
-    kx = np.linspace(-nyqx, nyqx, nx)
-    ky = np.linspace(-nyqy, nyqy, ny)
-
-    KX, KY = np.meshgrid(kx, ky)
-
-    I = np.deg2rad(I_deg)
-    D = np.deg2rad(D_deg)
-    alpha = np.arctan2(KY, KX)
-
-    filt = 1/(np.sin(I)+1j*np.cos(I)*np.cos(D-alpha))**2
-
-    zrtp = np.fft.ifft2(fftmod*filt)
-    zrtp = zrtp.real + datamedian
+    spec = spectral.spectrum(data.data, data.xdim, data.ydim)
+    zrtp = spec.calc(spec.rtp(I_deg, D_deg))
 
 # Create dataset
     dat = Data()
@@ -1166,7 +1250,8 @@ def cluster_to_raster(indata):
 def cut_raster(data, ifile):
     """Cuts a raster dataset
 
-    Cut a raster dataset using a shapefile
+    Cut a raster dataset using a shapefile. All polygons in the shapefile
+    are used, including holes.
 
     Parameters
     ----------
@@ -1180,58 +1265,15 @@ def cut_raster(data, ifile):
     Data
         PyGMI Dataset
     """
-    shapef = ogr.Open(ifile)
-    if shapef is None:
+    try:
+        clip = Clipper(ifile)
+    except (IOError, ValueError):
         return None
-    lyr = shapef.GetLayer()
-    poly = lyr.GetNextFeature()
-    if lyr.GetGeomType() is not ogr.wkbPolygon or poly is None:
-        return
 
+# Bands on the same grid share one polygon mask
     for idata in data:
-        # Convert the layer extent to image pixel coordinates
-        minX, maxX, minY, maxY = lyr.GetExtent()
-        ulX = max(0, int((minX - idata.tlx) / idata.xdim))
-        ulY = max(0, int((idata.tly - maxY) / idata.ydim))
-        lrX = int((maxX - idata.tlx) / idata.xdim)
-        lrY = int((idata.tly - minY) / idata.ydim)
-
-        # Map points to pixels for drawing the
-        # boundary on a mas image
-        points = []
-        pixels = []
-        geom = poly.GetGeometryRef()
-
-        ifin = 0
-        imax = 0
-        if geom.GetGeometryName() == 'MULTIPOLYGON':
-            for i in range(geom.GetGeometryCount()):
-                geom.GetGeometryRef(i)
-                itmp = geom.GetGeometryRef(i)
-                itmp = itmp.GetGeometryRef(0).GetPointCount()
-                if itmp > imax:
-                    imax = itmp
-                    ifin = i
-            geom = geom.GetGeometryRef(ifin)
-
-        pts = geom.GetGeometryRef(0)
-        for p in range(pts.GetPointCount()):
-            points.append((pts.GetX(p), pts.GetY(p)))
-        for p in points:
-            tmpx = int((p[0] - idata.tlx) / idata.xdim)
-            tmpy = int((idata.tly - p[1]) / idata.ydim)
-            pixels.append((tmpx, tmpy))
-        rasterPoly = Image.new("L", (idata.cols, idata.rows), 1)
-        rasterize = ImageDraw.Draw(rasterPoly)
-        rasterize.polygon(pixels, 0)
-        mask = np.array(rasterPoly)
-
-        idata.data.mask = mask
-        idata.data = idata.data[ulY:lrY, ulX:lrX]
-        idata.cols = idata.data.shape[1]
-        idata.rows = idata.data.shape[0]
-        idata.tlx = ulX*idata.xdim + idata.tlx  # minX
-        idata.tly = idata.tly - ulY*idata.ydim  # maxY
+        clip.cut_raster(idata)
+
     data = trim_raster(data)
     return data
 
@@ -1312,7 +1354,7 @@ def epsgtowkt(epsg):
     return out
 
 
-def gdal_to_dat(dest, bandid='Data'):
+def gdal_to_dat(dest, bandid='Data', band=1):
     """
     GDAL to Data format
 
@@ -1322,11 +1364,13 @@ def gdal_to_dat(dest, bandid='Data'):
         GDAL format
     bandid - str
         band identity
+    band - int
+        band number, starting at 1
     """
     dat = Data()
     gtr = dest.GetGeoTransform()
 
-    rtmp = dest.GetRasterBand(1)
+    rtmp = dest.GetRasterBand(band)
     dat.data = rtmp.ReadAsArray()
     nval = rtmp.GetNoDataValue()
 
@@ -1498,91 +1542,174 @@ def trim_raster(olddata):
     return olddata
 
 
-def quickgrid(x, y, z, dxy, showtext=None, numits=4):
+def _grid_key(data, wkt=None):
+    """ Key which is the same for bands on the same grid """
+    if wkt is None:
+        wkt = data.wkt
+    return (data.tlx, data.tly, data.xdim, data.ydim, data.rows, data.cols,
+            wkt)
+
+
+def _file_bands(bands):
     """
-    Do a quick grid
+    Returns the GDALBand sources of a group of bands, if none of them have
+    been read yet and they are all in one file. Otherwise returns None.
+    """
+    srcs = [i.source for i in bands]
+    if not all(isinstance(i, tiles.GDALBand) for i in srcs):
+        return None
+    if len(set(i.filename for i in srcs)) > 1:
+        return None
+    return srcs
+
+
+def _warp_source(bands, wkt, fbands=None, ofile=''):
+    """
+    GDAL dataset holding a group of bands on the same grid. Bands which are
+    still in a file (fbands) are not read, and the dataset is a VRT of the
+    file, written to ofile. Otherwise the bands are copied to a MEM dataset
+    with NaN as the nodata value.
+    """
+    if fbands is not None:
+        src = gdal.Translate(ofile, fbands[0].open(), format='VRT',
+                             bandList=[i.band for i in fbands],
+                             outputType=gdal.GDT_Float64,
+                             outputSRS=wkt)
+        for i, band in enumerate(fbands):
+            if band.nullvalue is not None:
+                src.GetRasterBand(i+1).SetNoDataValue(band.nullvalue)
+        src.FlushCache()
+        return src
+
+    dtype = np.float64
+    fmt = gdal.GDT_Float64
+    if all(i.data.dtype == np.float32 for i in bands):
+        dtype = np.float32
+        fmt = gdal.GDT_Float32
+
+    data = bands[0]
+    driver = gdal.GetDriverByName('MEM')
+    src = driver.Create('', int(data.cols), int(data.rows), len(bands), fmt)
+    src.SetGeoTransform((data.tlx, data.xdim, 0.0, data.tly, 0.0,
+                         -data.ydim))
+    src.SetProjection(wkt)
+
+    for i, band in enumerate(bands):
+        rtmp = src.GetRasterBand(i+1)
+        rtmp.SetNoDataValue(np.nan)
+        rtmp.WriteArray(np.ma.array(band.data, dtype=dtype).filled(np.nan))
+
+    return src
+
+
+def warp_data(bands, gtr, cols, rows, wkt, src_wkt=None,
+              resample='bilinear', nthreads=None, vrtfile=None):
+    """
+    Warps (resamples and reprojects) bands onto a new grid.
+
+    Bands on the same grid are warped together, in one multithreaded GDAL
+    warp. Masked values are passed to GDAL as nodata, so they do not affect
+    neighbouring values and are masked in the output.
 
     Parameters
     ----------
-    x : numpy array
-        array of x coordinates
-    y : numpy array
-        array of y coordinates
-    z : numpy array
-        array of z values - this is the column being gridded
-    dxy : float
-        cell size for the grid, in both the x and y direction.
-    showtext : module, optional
-        showtext provided an alternative to print
-    numits : int
-        number of iterations. By default its 4. If this is negative, a maximum
-        numits will be calculated and used.
+    bands : list
+        list of PyGMI Data
+    gtr : tuple
+        geotransform of the output grid
+    cols : int
+        columns of the output grid
+    rows : int
+        rows of the output grid
+    wkt : str
+        projection of the output grid, in wkt (well known text) format
+    src_wkt : str
+        projection of all the input bands. By default each band's own
+        projection is used.
+    resample : str
+        GDAL resampling method, e.g. 'near', 'bilinear' or 'cubic'
+    nthreads : int
+        number of warp threads. None uses all processors.
+    vrtfile : str
+        if given, bands which have not been read from their file yet are
+        warped to a VRT with this name (with a number added for each
+        group of bands). The output is only read from the file when it is
+        used, so it is never held in memory all at once.
 
     Returns
     -------
-    newz : numpy array
-        M x N array of z values
+    list
+        list of PyGMI Data, in the same order as bands
     """
+    if nthreads is None:
+        nthreads = 'ALL_CPUS'
+    cols = int(cols)
+    rows = int(rows)
 
-    if showtext is None:
-        showtext = print
-
-    showtext('Creating Grid')
-    x = x.flatten()
-    y = y.flatten()
-    z = z.flatten()
-
-    xmin = x.min()
-    xmax = x.max()
-    ymin = y.min()
-    ymax = y.max()
-    newmask = np.array([1])
-    j = -1
-    rows = int((ymax-ymin)/dxy)+1
-    cols = int((xmax-xmin)/dxy)+1
-
-    if numits < 1:
-        numits = int(max(np.log2(cols), np.log2(rows)))
-
-    while np.max(newmask) > 0 and j < (numits-1):
-        j += 1
-        jj = 2**j
-        dxy2 = dxy*jj
-        rows = int((ymax-ymin)/dxy2)+1
-        cols = int((xmax-xmin)/dxy2)+1
-
-        newz = np.zeros([rows, cols])
-        zdiv = np.zeros([rows, cols])
-
-        xindex = ((x-xmin)/dxy2).astype(int)
-        yindex = ((y-ymin)/dxy2).astype(int)
-
-        for i in range(z.size):
-            newz[yindex[i], xindex[i]] += z[i]
-            zdiv[yindex[i], xindex[i]] += 1
-
-        filt = zdiv > 0
-        newz[filt] = newz[filt]/zdiv[filt]
-
-        if j == 0:
-            newmask = np.ones([rows, cols])
-            for i in range(z.size):
-                newmask[yindex[i], xindex[i]] = 0
-            zfin = newz
-        else:
-            xx, yy = newmask.nonzero()
-            xx2 = xx//jj
-            yy2 = yy//jj
-            zfin[xx, yy] = newz[xx2, yy2]
-            newmask[xx, yy] = np.logical_not(zdiv[xx2, yy2])
-
-        showtext('Iteration done: '+str(j+1)+' of '+str(numits))
+    bounds = (gtr[0], gtr[3]+gtr[5]*rows, gtr[0]+gtr[1]*cols, gtr[3])
+    wopts = ['NUM_THREADS='+str(nthreads), 'INIT_DEST=NO_DATA']
+
+    groups = {}
+    for i, data in enumerate(bands):
+        groups.setdefault(_grid_key(data, src_wkt), []).append(i)
+
+    out = [None]*len(bands)
+    for igroup, index in enumerate(groups.values()):
+        group = [bands[i] for i in index]
+        swkt = group[0].wkt if src_wkt is None else src_wkt
+
+        fbands = None
+        if vrtfile is not None:
+            fbands = _file_bands(group)
+
+        with INSTR.span('warp', bands=len(group), shape=(rows, cols)):
+            if fbands is None:
+                src = _warp_source(group, swkt)
+                dest = gdal.Warp('', src, format='MEM', outputBounds=bounds,
+                                 width=cols, height=rows, srcSRS=swkt,
+                                 dstSRS=wkt, resampleAlg=resample,
+                                 dstNodata=np.nan, multithread=True,
+                                 warpOptions=wopts)
+            else:
+                ofile = os.path.splitext(vrtfile)[0]
+                if len(groups) > 1:
+                    ofile += '_'+str(igroup)
+                src = _warp_source(group, swkt, fbands, ofile+'_src.vrt')
+                dest = gdal.Warp(ofile+'.vrt', src, format='VRT',
+                                 outputBounds=bounds, width=cols,
+                                 height=rows, srcSRS=swkt, dstSRS=wkt,
+                                 resampleAlg=resample, dstNodata=np.nan,
+                                 multithread=True, warpOptions=wopts)
+                dest.FlushCache()
+
+            for j, i in enumerate(index):
+                data = bands[i]
+                if fbands is None:
+                    dat = gdal_to_dat(dest, data.dataid, j+1)
+                    dat.data = np.ma.masked_invalid(dat.data)
+                else:
+                    dat = Data()
+                    dat.source = tiles.GDALBand(ofile+'.vrt', j+1, None,
+                                                dest)
+
+                dat.dataid = data.dataid
+                dat.units = data.units
+                dat.nullvalue = data.nullvalue
+                dat.nrofbands = data.nrofbands
+                dat.tlx = gtr[0]
+                dat.tly = gtr[3]
+                dat.xdim = abs(gtr[1])
+                dat.ydim = abs(gtr[5])
+                dat.rows = rows
+                dat.cols = cols
+                dat.wkt = wkt
+                dat.gtr = tuple(gtr)
+                out[i] = dat
+
+            INSTR.count('pixels warped', rows*cols*len(group))
 
-    showtext('Finished!')
+    return out
 
-    newz = np.ma.array(zfin)
-    newz.mask = newmask
-    return newz
 
 def func(x, y):
     """ Function """
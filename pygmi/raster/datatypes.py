@@ -75,10 +75,20 @@ class Data(object):
     """
     PyGMI Data Object
 
+    Bands imported from files are only read when data is first used. Until
+    then, source holds the band source (see pygmi.raster.tiles) and no
+    pixels or masks are in memory.
+
+    Histograms and display pyramids made from data are cached. Setting data
+    clears them. Code which changes data in place must reset hist
+    (dat.hist = {}) for the change to show.
+
     Attributes
     ----------
     data : numpy masked array
         array to contain raster data
+    source : band source
+        source the data will be read from, or None if it is in memory.
     tlx : float
         Top Left X coordinate of raster grid
     tly : float
@@ -99,6 +109,9 @@ class Data(object):
         grid null or nodata value
     norm : dictionary
         normalized data
+    hist : dictionary
+        cached histograms of the data (see tiles.band_histogram). A new
+        dictionary also marks display pyramids as out of date.
     gtr : tuple
         projection information
     wkt : str
@@ -107,7 +120,8 @@ class Data(object):
         description of units to be used with color bars
     """
     def __init__(self):
-        self.data = np.ma.array([])
+        self._data = np.ma.array([])
+        self.source = None
         self.tlx = 0.0  # Top Left X coordinate
         self.tly = 0.0  # Top Left Y coordinate
         self.xdim = 1.0
@@ -118,6 +132,39 @@ class Data(object):
         self.cols = -1
         self.nullvalue = 1e+20
         self.norm = {}
+        self.hist = {}
         self.gtr = (0.0, 1.0, 0.0, 0.0, -1.0)
         self.wkt = ''
         self.units = ''
+
+    def __getstate__(self):
+        # Copies are often changed in place, so cached histograms are not kept
+        state = self.__dict__.copy()
+        state['hist'] = {}
+        return state
+
+    def __setstate__(self, state):
+        # Data pickled before bands were loaded lazily
+        if 'data' in state:
+            state['_data'] = state.pop('data')
+        state.setdefault('source', None)
+        state.setdefault('hist', {})
+        self.__dict__.update(state)
+
+    @property
+    def data(self):
+        """ Raster data, read from the source when first used """
+        if self.source is not None:
+            self._data = self.source.read(0, self.source.shape[0])
+            self.source = None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self.source = None
+        self.hist = {}
+
+    def isloaded(self):
+        """ Returns True if the data is in memory """
+        return self.source is None
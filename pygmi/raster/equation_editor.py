@@ -25,10 +25,12 @@
 """ This is the function which calls the equation editor """
 
 import copy
+import re
 from PyQt5 import QtWidgets, QtCore
 import numpy as np
 import numexpr as ne
 import pygmi.raster.dataprep as dataprep
+import pygmi.raster.tiles as tiles
 
 
 class EquationEditor(QtWidgets.QDialog):
@@ -154,8 +156,6 @@ class EquationEditor(QtWidgets.QDialog):
 
     def settings(self):
         """ Settings """
-        localdict = {}
-        bandsall = []
         self.bands = {}
         self.bands['all data'] = 'iall'
 
@@ -175,9 +175,6 @@ class EquationEditor(QtWidgets.QDialog):
         for j, i in enumerate(indata):
             self.combobox.addItem(i.dataid)
             self.bands[i.dataid] = 'i'+str(j)
-            bandsall.append(i.data)
-            localdict['i'+str(j)] = i.data
-        localdict['iall'] = np.ma.array(bandsall)
 
         temp = self.exec_()
 
@@ -191,8 +188,21 @@ class EquationEditor(QtWidgets.QDialog):
 
         neweq = self.eq_fix(indata, equation)
 
+# Only the bands named in the equation are read.
+        used, useall = eq_bands(neweq, len(indata))
+        sources = [tiles.band_source(indata[i]) for i in used]
+        names = ['i'+str(i) for i in used]
+
+        def evaluate(*blocks):
+            """ Evaluates the equation on a strip of rows """
+            localdict = dict(zip(names, blocks))
+            if useall:
+                localdict['iall'] = np.ma.array(blocks)
+            return ne.evaluate(neweq, localdict)
+
+# The first row is used to check the equation and find the output size.
         try:
-            findat = ne.evaluate(neweq, localdict)
+            findat = evaluate(*[i.read(0, 1) for i in sources])
         except Exception:
             QtWidgets.QMessageBox.warning(
                 self.parent, 'Error',
@@ -209,20 +219,49 @@ class EquationEditor(QtWidgets.QDialog):
                 'value instead of a minimum of one band.',
                 QtWidgets.QMessageBox.Ok, QtWidgets.QMessageBox.Ok)
             return
-        elif len(findat.shape) == 2:
-            findat.shape = (1, findat.shape[0], findat.shape[1])
 
-        for i, findati in enumerate(findat):
-            mask = np.ma.getmaskarray(indata[i].data)
-            findati[mask] = indata[i].nullvalue
+        nbands = 1
+        if findat.ndim == 3:
+            nbands = findat.shape[0]
+
+# The rest is evaluated one strip of rows at a time (see pygmi.raster.tiles).
+# Large outputs are written to a temporary file instead of memory.
+# Reductions may combine rows, so then the raster is done in one strip.
+        nbytes = None
+        if 'sum(' in neweq or 'prod(' in neweq:
+            nbytes = 2**62
+
+        def func(*blocks):
+            """ Evaluates a strip and masks bad values """
+            findat = evaluate(*blocks)
+            findat.shape = (nbands,)+blocks[0].shape
+
+# Outputs are masked where any band they use is masked. Multiband outputs
+# come from iall, so band i of the output uses band i of iall.
+            masks = [np.ma.getmaskarray(i) for i in blocks]
+            perband = useall and nbands > 1
+            mask = np.zeros(blocks[0].shape, dtype=bool)
+            if not perband:
+                for bmask in masks:
+                    mask |= bmask
+
+            out = np.ma.array(findat, mask=np.zeros(findat.shape, dtype=bool))
+            for i, findati in enumerate(findat):
+                nval = indata[i].nullvalue
+                bmask = mask | ~np.isfinite(findati) | (findati == nval)
+                if perband:
+                    bmask |= masks[i]
+                findati[bmask] = nval
+                out.mask[i] = bmask
+            return out
+
+        findat = tiles.run_tiles(func, sources, dtype=findat.dtype,
+                                 nthreads=None, nbytes=nbytes, bands=nbands)
 
+        for i, findati in enumerate(findat):
             outdata.append(copy.copy(indata[i]))
-            outdata[-1].data = np.ma.masked_equal(findati, indata[i].nullvalue)
-
-        # This is needed to get rid of bad, unmasked values etc.
-        for i, outdatai in enumerate(outdata):
-            outdatai.data.set_fill_value(indata[i].nullvalue)
-            outdatai.data = np.ma.fix_invalid(outdatai.data)
+            outdata[-1].data = findati
+            outdata[-1].data.set_fill_value(indata[i].nullvalue)
 
         if len(outdata) == 1:
             outdata[0].dataid = equation
@@ -232,6 +271,34 @@ class EquationEditor(QtWidgets.QDialog):
         return True
 
 
+def eq_bands(equation, nbands):
+    """
+    Finds the bands used in an equation.
+
+    Parameters
+    ----------
+    equation : str
+        equation, using the variables iall, i0, i1 etc.
+    nbands : int
+        number of bands
+
+    Returns
+    -------
+    used : list
+        indices of the bands used. If iall is used, this is all bands.
+    useall : bool
+        True if iall is used
+    """
+    names = set(re.findall(r'\b(iall|i\d+)\b', equation))
+    useall = 'iall' in names
+    if useall:
+        return list(range(nbands)), True
+
+    used = sorted(int(i[1:]) for i in names)
+    used = [i for i in used if i < nbands]
+    return used, False
+
+
 def hmode(data):
     """
     Mode - this uses a histogram to generate a fast mode estimate
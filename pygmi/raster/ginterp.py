@@ -65,6 +65,9 @@ supports GeoTiff files.
 import pdb
 import os
 import copy
+import itertools
+import threading
+from collections import OrderedDict
 from math import cos, sin, tan
 import numpy as np
 import numexpr as ne
@@ -83,7 +86,279 @@ from matplotlib.path import Path
 from matplotlib.patches import PathPatch
 import pygmi.raster.iodefs as iodefs
 import pygmi.raster.dataprep as dataprep
+import pygmi.raster.tiles as tiles
 import pygmi.menu_default as menu_default
+from pygmi.misc import INSTR
+
+# Display pyramids are made down to levels of about MINLEVEL cells across, and
+# each image keeps the pyramids of up to MAXPYRAMIDS recently shown bands.
+# Rendered tiles are TILESIZE cells square, and the tile cache holds about
+# TILECACHE bytes. Stretches are calculated on an overview of the band with
+# about OVERVIEWCELLS cells.
+MINLEVEL = 256
+TILESIZE = 256
+TILECACHE = 2**27
+OVERVIEWCELLS = 2**20
+MAXPYRAMIDS = 8
+_TILES = OrderedDict()
+_UIDS = itertools.count()
+
+
+class Pyramid(object):
+    """
+    Display pyramid of a band.
+
+    Level n has every 2**n th row and column of the band. Level 0 is the
+    band itself. The other levels are made once, in a background thread.
+    Until a level is made, its cells are read from the band with a stride,
+    which gives the same values.
+
+    The levels are copies, so a pyramid does not see changes made to the
+    band in place. When the band's Data is known, the pyramid is out of date
+    once Data.data is set or Data.hist is reset (see Data).
+
+    Attributes
+    ----------
+    data : numpy array
+        band the pyramid was made from
+    uid : int
+        unique number of the pyramid, used in tile cache keys
+    shape : tuple
+        rows and columns of the band
+    levels : list
+        levels made so far
+    nlevels : int
+        number of levels when all are made
+    overview : numpy masked array
+        sample of the band, used to calculate stretches
+    band : Data
+        PyGMI raster dataset of the band, if known. Its cached histogram is
+        used for stretches.
+    """
+    def __init__(self, data, band=None):
+        self.data = data
+        data = np.ma.asarray(data)
+        self.uid = next(_UIDS)
+        self.shape = data.shape
+        self.levels = [data]
+        self.nlevels = 1
+        while max(self.shape)/2**self.nlevels > MINLEVEL:
+            self.nlevels += 1
+
+        step = int(np.ceil(np.sqrt(data.size/OVERVIEWCELLS)))
+        self.overview = data[::max(step, 1), ::max(step, 1)]
+        self.band = band
+        self._hist = None if band is None else band.hist
+        self._stretches = {}
+
+        if self.nlevels > 1:
+            self.thread = threading.Thread(target=self._build, daemon=True)
+            self.thread.start()
+
+    def _build(self):
+        """ Makes the levels """
+        with INSTR.span('display pyramid', shape=self.shape):
+            for _ in range(1, self.nlevels):
+                self.levels.append(self.levels[-1][::2, ::2].copy())
+
+    def level_shape(self, level):
+        """
+        Rows and columns of a level.
+
+        Parameters
+        ----------
+        level : int
+            level number
+
+        Returns
+        -------
+        tuple
+            rows and columns
+        """
+        fac = 2**level
+        return (-(-self.shape[0]//fac), -(-self.shape[1]//fac))
+
+    def window(self, level, row0, row1, col0, col1):
+        """
+        Part of a level.
+
+        Parameters
+        ----------
+        level : int
+            level number
+        row0 : int
+            first row of the level
+        row1 : int
+            last row (exclusive)
+        col0 : int
+            first column
+        col1 : int
+            last column (exclusive)
+
+        Returns
+        -------
+        numpy masked array
+            data
+        """
+        if level < len(self.levels):
+            return self.levels[level][row0:row1, col0:col1]
+
+        INSTR.count('pyramid level not ready')
+        fac = 2**level
+        return self.levels[0][row0*fac:row1*fac:fac, col0*fac:col1*fac:fac]
+
+    def stretch(self, htype):
+        """
+        Returns the Stretch of the band for a histogram stretch type.
+
+        Parameters
+        ----------
+        htype : str
+            'Linear', '95% Linear, 5% Compact' or 'Histogram Equalization'
+
+        Returns
+        -------
+        Stretch
+            stretch
+        """
+        if htype not in self._stretches:
+            hist = None
+            if self.band is not None and self.band.isloaded():
+                hist = tiles.band_histogram(self.band)
+            self._stretches[htype] = Stretch(self.overview, htype, hist)
+        return self._stretches[htype]
+
+    def clear_stretches(self):
+        """ Removes the cached stretches """
+        self._stretches = {}
+
+    def current(self, data, band=None):
+        """
+        Checks whether the pyramid is still valid for a band.
+
+        Parameters
+        ----------
+        data : numpy masked array
+            band
+        band : Data
+            PyGMI raster dataset the band comes from, if known
+
+        Returns
+        -------
+        bool
+            True if the pyramid can be used for the band
+        """
+        if data is not self.data:
+            return False
+        if self.band is not None and self.band.hist is not self._hist:
+            return False
+        if band is not None and band is not self.band:
+            self.band = band
+            self._hist = band.hist
+            self.clear_stretches()
+        return True
+
+
+class Stretch(object):
+    """
+    Histogram stretch of a band. The stretch is calculated once, from the
+    histogram of the full band if it is given, or else from an overview of
+    the band. Every part of the band is displayed with the same colours at
+    every zoom level.
+
+    Attributes
+    ----------
+    htype : str
+        'Linear', '95% Linear, 5% Compact' or 'Histogram Equalization'
+    vmin : float
+        stretched value displayed as 0
+    vptp : float
+        range of stretched values displayed
+    """
+    def __init__(self, sample, htype, hist=None):
+        self.htype = htype
+        self.lims = None
+        self.table = None
+
+        if hist is not None:
+            self._from_hist(htype, *hist)
+            return
+
+        if htype == '95% Linear, 5% Compact':
+            tmp = histcomp(sample)
+            self.lims = (float(tmp.min()), float(tmp.max()))
+        elif htype == 'Histogram Equalization':
+            self.table = histeq_table(sample)
+
+        tmp = self.transform(sample)
+        self.vmin = float(tmp.min())
+        self.vptp = float(np.ma.ptp(tmp))
+        if self.vptp == 0.:
+            self.vptp = 1.
+
+    def _from_hist(self, htype, imhist, bins):
+        """ Looks up the stretch in a histogram of the band """
+        dmin, dmax = float(bins[0]), float(bins[-1])
+
+        if htype == '95% Linear, 5% Compact':
+# histcomp uses 256 bins. Their edges are every nth edge of the histogram.
+            nfine = imhist.size//256
+            if nfine*256 == imhist.size:
+                svalue, evalue = histcomp_limits(
+                    imhist.reshape(256, nfine).sum(1), bins[::nfine])
+            else:
+                svalue, evalue = histcomp_limits(imhist, bins)
+            self.lims = (max(float(svalue), dmin), min(float(evalue), dmax))
+            self.vmin = self.lims[0]
+            self.vptp = self.lims[1]-self.lims[0]
+        elif htype == 'Histogram Equalization':
+            self.table = cdf_table(imhist, bins)
+            self.vmin = float(self.table[1][0])
+            self.vptp = float(self.table[1][-1])-self.vmin
+        else:
+            self.vmin = dmin
+            self.vptp = dmax-dmin
+
+        if self.vptp == 0.:
+            self.vptp = 1.
+
+    def transform(self, dat):
+        """
+        Applies the stretch, in the same units as histcomp and histeq.
+
+        Parameters
+        ----------
+        dat : numpy masked array
+            data
+
+        Returns
+        -------
+        numpy masked array
+            stretched data
+        """
+        if self.lims is not None:
+            return np.ma.clip(dat, *self.lims).astype(np.float32)
+        if self.table is not None:
+            return np.ma.array(np.interp(dat, *self.table),
+                               mask=np.ma.getmaskarray(dat))
+        return dat
+
+    def __call__(self, dat):
+        """
+        Applies the stretch and normalises it between 0 and 1.
+
+        Parameters
+        ----------
+        dat : numpy masked array
+            data
+
+        Returns
+        -------
+        numpy masked array
+            normalised data
+        """
+        out = (self.transform(dat)-self.vmin)/self.vptp
+        return np.ma.clip(out, 0., 1.)
 
 
 class ModestImage2(mi.AxesImage):
@@ -129,8 +404,11 @@ class ModestImage2(mi.AxesImage):
             raise NotImplementedError("ModestImage does not support extents")
 
         self._full_res = None
-        self._sx, self._sy = None, None
-        self._bounds = (None, None, None, None)
+        self._pyramids = []
+        self._pyrcache = OrderedDict()
+        self._view = None
+        self._newdata = True
+        self._shadenorm = {}
         super(ModestImage2, self).__init__(*args, **kwargs)
 
         self.smallres = None
@@ -143,28 +421,79 @@ class ModestImage2(mi.AxesImage):
         self.theta = np.pi/4.
         self.alpha = .0
         self.kval = 0.01
-        self._rgbacache = None
-        self._oldxslice = None
-        self._oldyslice = None
 
-    def set_data(self, A):
+    def set_data(self, A, bands=None):
         """
         Set the image array
 
         ACCEPTS: numpy/PIL Image A
+
+        bands is an optional list of the PyGMI Data of each band in A. Their
+        cached histograms are used for stretches.
         """
         self._full_res = A
         self._A = A
         self.smallres = A
 
+        arrays = A
+        if not isinstance(A, list):
+            arrays = [A]
+        if bands is None:
+            bands = [None]*len(arrays)
+        self._pyramids = [self._get_pyramid(i, j)
+                          for i, j in zip(arrays, bands)]
+
         self._imcache = None
-        self._rgbacache = None
-        self._oldxslice = None
-        self._oldyslice = None
-        self._sx, self._sy = None, None
+        self._view = None
+        self._newdata = True
         if self.axes.dataLim.x0 != np.inf:
             self._scale_to_res()
 
+    def _get_pyramid(self, data, band=None):
+        """
+        Returns the display pyramid of a band. The pyramids of recently shown
+        bands are kept with the image.
+
+        Parameters
+        ----------
+        data : numpy masked array
+            band
+        band : Data
+            PyGMI raster dataset the band comes from, if known
+
+        Returns
+        -------
+        Pyramid
+            pyramid
+        """
+# Pyramids of bands whose Data has changed are removed first.
+        for i, pyr in list(self._pyrcache.items()):
+            if not pyr.current(pyr.data):
+                del self._pyrcache[i]
+
+        key = id(data)
+        if key in self._pyrcache and self._pyrcache[key].current(data, band):
+            self._pyrcache.move_to_end(key)
+            return self._pyrcache[key]
+
+        pyr = Pyramid(data, band)
+        self._pyrcache[key] = pyr
+        while len(self._pyrcache) > MAXPYRAMIDS:
+            self._pyrcache.popitem(last=False)
+        return pyr
+
+    def _render_key(self):
+        """ Settings which change the rendered tiles """
+        key = (self.dtype, tuple(i.uid for i in self._pyramids), self.htype)
+        if self.dtype == 'Single Color Map':
+            key += (self.cbar.name,)
+        elif self.dtype == 'Sunshade':
+            key += (self.cbar.name, self.hstype, self.cell, self.theta,
+                    self.phi, self.alpha)
+        elif 'CMY' in self.dtype:
+            key += (self.kval,)
+        return key
+
     def _scale_to_res(self):
         """ Change self._A and _extent to render an image whose
         resolution is matched to the eventual rendering."""
@@ -172,14 +501,7 @@ class ModestImage2(mi.AxesImage):
         ax = self.axes
 
         fx0, fy0, fx1, fy1 = ax.dataLim.extents
-        try:
-            tmp = self._full_res.shape
-            rows = tmp[0]
-            cols = tmp[1]
-        except AttributeError:
-            tmp = self._full_res[0].shape
-            rows = tmp[0]
-            cols = tmp[1]
+        rows, cols = self._pyramids[0].shape
 
         ddx = (fx1-fx0)/cols
         ddy = (fy1-fy0)/rows
@@ -210,114 +532,146 @@ class ModestImage2(mi.AxesImage):
         sy = max(int(np.ceil(dy/(ddy*ext[1]))/divtmp), 1)
         sx = max(int(np.ceil(dx/(ddx*ext[0]))/divtmp), 1)
 
-        if self._sx is None:
-            pass
-        elif (sx >= self._sx and sy >= self._sy and
-              x0 >= self._bounds[0] and x1 <= self._bounds[1] and
-              y0 >= self._bounds[2] and y1 <= self._bounds[3]):
-            return
-
-        if self.dtype == 'Single Color Map':
-            pseudo = self._full_res[(rows-y1):(rows-y0):sy, x0:x1:sx]
-            mask = np.ma.getmaskarray(pseudo)
-
-            if self.htype == '95% Linear, 5% Compact':
-                pseudo = histcomp(pseudo)
-
-            if self.htype == 'Histogram Equalization':
-                pseudo = histeq(pseudo)
-
-            self.smallres = pseudo.copy()
-
-            pnorm = norm2(pseudo)
-
-            colormap = self.cbar(pnorm)
-            colormap[:, :, 3] = np.logical_not(mask)
-
-            self._A = colormap
-
-        elif self.dtype == 'Sunshade':
-            pseudo = self._full_res[0][(rows-y1):(rows-y0):sy, x0:x1:sx]
-            sun = self._full_res[1][(rows-y1):(rows-y0):sy, x0:x1:sx]
-            mask = np.logical_or(pseudo.mask, sun.mask)
-
-            if self.htype == '95% Linear, 5% Compact':
-                pseudo = histcomp(pseudo)
-
-            if self.htype == 'Histogram Equalization':
-                pseudo = histeq(pseudo)
-
-            if self.hstype == '95% Linear, 5% Compact':
-                sun = histcomp(sun)
-
-            if self.hstype == 'Histogram Equalization':
-                sun = histeq(sun)
-
-
-            self.smallres = np.ma.ones((sun.shape[0], sun.shape[1], 2))
-            self.smallres[:, :, 0] = pseudo
-            self.smallres[:, :, 1] = sun
+# The pyramid level is the coarsest with at least the screen resolution.
+        level = min(int(np.log2(min(sx, sy))), self._pyramids[0].nlevels-1)
+        fac = 2**level
+        lrows, lcols = self._pyramids[0].level_shape(level)
+        lr0 = (rows-y1)//fac
+        lr1 = min(-(-(rows-y0)//fac), lrows)
+        lc0 = x0//fac
+        lc1 = min(-(-x1//fac), lcols)
+        key = self._render_key()
+
+        if self._view is not None:
+            vkey, vlevel, vr0, vr1, vc0, vc1 = self._view
+            if (vkey == key and vlevel == level and lr0 >= vr0 and
+                    lr1 <= vr1 and lc0 >= vc0 and lc1 <= vc1):
+                return
 
-            sunshader = currentshader(sun.data, self.cell, self.theta,
-                                      self.phi, self.alpha)
+        if self._newdata:
+            self._set_smallres(level, lr0, lr1, lc0, lc1)
+            self._newdata = False
+
+# The image is made from whole tiles, so that they can be cached.
+        tsize = TILESIZE
+        tr0, tr1 = lr0//tsize, -(-lr1//tsize)
+        tc0, tc1 = lc0//tsize, -(-lc1//tsize)
+        lr0, lr1 = tr0*tsize, min(tr1*tsize, lrows)
+        lc0, lc1 = tc0*tsize, min(tc1*tsize, lcols)
+
+        rgba = np.zeros((lr1-lr0, lc1-lc0, 4), dtype=np.uint8)
+        with INSTR.span('display tiles', level=level):
+            for trow in range(tr0, tr1):
+                for tcol in range(tc0, tc1):
+                    tile = self._tile(key, level, trow, tcol)
+                    row = trow*tsize-lr0
+                    col = tcol*tsize-lc0
+                    rgba[row:row+tile.shape[0], col:col+tile.shape[1]] = tile
+
+        self._A = rgba
+
+        self.set_extent([fx0+lc0*fac*ddx, fx0+min(lc1*fac, cols)*ddx,
+                         fy1-min(lr1*fac, rows)*ddy, fy1-lr0*fac*ddy])
+        self._view = (key, level, lr0, lr1, lc0, lc1)
+        self.changed()
 
-            snorm = norm2(sunshader)
-            pnorm = norm2(pseudo)
+    def _set_smallres(self, level, row0, row1, col0, col1):
+        """ Stretched data of the view, used for the histograms """
+        bands = []
+        for i, pyr in enumerate(self._pyramids):
+            htype = self.htype
+            if self.dtype == 'Sunshade' and i == 1:
+                htype = self.hstype
+            dat = pyr.window(level, row0, row1, col0, col1)
+            bands.append(pyr.stretch(htype).transform(dat))
+
+        if len(bands) == 1:
+            self.smallres = bands[0]
+            return
 
-            colormap = self.cbar(pnorm)
+        self.smallres = np.ma.ones(bands[0].shape+(len(bands),))
+        for i, band in enumerate(bands):
+            self.smallres[:, :, i] = band
 
-            colormap[:, :, 0] *= snorm  # red
-            colormap[:, :, 1] *= snorm  # green
-            colormap[:, :, 2] *= snorm  # blue
-            colormap[:, :, 3] = np.logical_not(mask)
+    def _tile(self, key, level, trow, tcol):
+        """ Returns a rendered RGBA tile, from the cache if possible """
+        tkey = (key, level, trow, tcol)
+        if tkey in _TILES:
+            INSTR.count('display tile cache hits')
+            _TILES.move_to_end(tkey)
+            return _TILES[tkey]
 
-            self._A = colormap
+        lrows, lcols = self._pyramids[0].level_shape(level)
+        row0 = trow*TILESIZE
+        row1 = min(row0+TILESIZE, lrows)
+        col0 = tcol*TILESIZE
+        col1 = min(col0+TILESIZE, lcols)
 
+        if self.dtype == 'Sunshade':
+            colormap = self._shade_tile(key, level, row0, row1, col0, col1)
         elif 'Ternary' in self.dtype:
-            red = self._full_res[0][(rows-y1):(rows-y0):sy, x0:x1:sx]
-            green = self._full_res[1][(rows-y1):(rows-y0):sy, x0:x1:sx]
-            blue = self._full_res[2][(rows-y1):(rows-y0):sy, x0:x1:sx]
-            mask = np.logical_or(red.mask, green.mask)
-            mask = np.logical_or(mask, blue.mask)
-
-            if self.htype == '95% Linear, 5% Compact':
-                red = histcomp(red)
-                green = histcomp(green)
-                blue = histcomp(blue)
-
-            if self.htype == 'Histogram Equalization':
-                red = histeq(red)
-                green = histeq(green)
-                blue = histeq(blue)
-
-            self.smallres = np.ma.ones((red.shape[0], red.shape[1], 3))
-            self.smallres[:, :, 0] = red
-            self.smallres[:, :, 1] = green
-            self.smallres[:, :, 2] = blue
-
-            colormap = np.ma.ones((red.shape[0], red.shape[1], 4))
-            colormap[:, :, 0] = norm2(red)
-            colormap[:, :, 1] = norm2(green)
-            colormap[:, :, 2] = norm2(blue)
+            bands = [i.window(level, row0, row1, col0, col1)
+                     for i in self._pyramids]
+            mask = np.zeros(bands[0].shape, dtype=bool)
+            colormap = np.ones(bands[0].shape+(4,))
+            for i, band in enumerate(bands):
+                mask |= np.ma.getmaskarray(band)
+                colormap[:, :, i] = self._pyramids[i].stretch(
+                    self.htype)(band).filled(0.)
             colormap[:, :, 3] = np.logical_not(mask)
 
             if 'CMY' in self.dtype:
-                colormap[:, :, 0] = (1-colormap[:, :, 0])*(1-self.kval)
-                colormap[:, :, 1] = (1-colormap[:, :, 1])*(1-self.kval)
-                colormap[:, :, 2] = (1-colormap[:, :, 2])*(1-self.kval)
-
-            self._A = colormap
-
-        y0 = ylim[0]
-        y1 = ylim[1]
-        x0 = xlim[0]
-        x1 = xlim[1]
-
-        self.set_extent([x0, x1, y0, y1])
-        self._sx = sx
-        self._sy = sy
-        self._bounds = (x0, x1, y0, y1)
-        self.changed()
+                colormap[:, :, :3] = (1-colormap[:, :, :3])*(1-self.kval)
+        else:
+            pseudo = self._pyramids[0].window(level, row0, row1, col0, col1)
+            pnorm = self._pyramids[0].stretch(self.htype)(pseudo)
+            colormap = self.cbar(pnorm.filled(0.))
+            colormap[:, :, 3] = np.logical_not(np.ma.getmaskarray(pseudo))
+
+        tile = (colormap*255).round().astype(np.uint8)
+
+        _TILES[tkey] = tile
+        while len(_TILES)*TILESIZE*TILESIZE*4 > TILECACHE:
+            _TILES.popitem(last=False)
+        return tile
+
+    def _shade_tile(self, key, level, row0, row1, col0, col1):
+        """ Sunshaded colours of a tile """
+        ppyr, spyr = self._pyramids
+        lrows, lcols = ppyr.level_shape(level)
+        sstretch = spyr.stretch(self.hstype)
+
+# The shader uses a 3x3 neighbourhood, so one extra row and column is read
+# on each side.
+        hrow0, hrow1 = max(row0-1, 0), min(row1+1, lrows)
+        hcol0, hcol1 = max(col0-1, 0), min(col1+1, lcols)
+        sun = sstretch.transform(spyr.window(level, hrow0, hrow1, hcol0,
+                                             hcol1))
+        sunshader = currentshader(np.ma.getdata(sun), self.cell, self.theta,
+                                  self.phi, self.alpha)
+        sunshader = sunshader[row0-hrow0:row1-hrow0, col0-hcol0:col1-hcol0]
+        sun = sun[row0-hrow0:row1-hrow0, col0-hcol0:col1-hcol0]
+
+# The shading is normalised with its range on the overview.
+        if key not in self._shadenorm:
+            tmp = currentshader(np.ma.getdata(sstretch.transform(
+                spyr.overview)), self.cell, self.theta, self.phi, self.alpha)
+            self._shadenorm[key] = (float(tmp.min()),
+                                    float(np.ma.ptp(tmp)) or 1.)
+        smin, sptp = self._shadenorm[key]
+        snorm = np.ma.clip((sunshader-smin)/sptp, 0., 1.).filled(0.)
+
+        pseudo = ppyr.window(level, row0, row1, col0, col1)
+        pnorm = ppyr.stretch(self.htype)(pseudo)
+        mask = np.logical_or(np.ma.getmaskarray(pseudo),
+                             np.ma.getmaskarray(sun))
+
+        colormap = self.cbar(pnorm.filled(0.))
+        colormap[:, :, 0] *= snorm  # red
+        colormap[:, :, 1] *= snorm  # green
+        colormap[:, :, 2] *= snorm  # blue
+        colormap[:, :, 3] = np.logical_not(mask)
+        return colormap
 
     def draw(self, renderer, *args, **kwargs):
         """ Draw """
@@ -331,6 +685,10 @@ class ModestImage2(mi.AxesImage):
             argb.set_xlim(argb.dataLim.x0, argb.dataLim.x1)
             argb.set_ylim(argb.dataLim.y0, argb.dataLim.y1*1.2)
 
+        # The image is rendered again if the view has changed.
+        if self._pyramids and self.axes.dataLim.x0 != np.inf:
+            self._scale_to_res()
+
         # The next command runs the original draw for this class.
         super().draw(renderer, *args, **kwargs)
 
@@ -606,9 +964,9 @@ class MyMplCanvas(FigureCanvas):
 
         for i in self.data:
             if i.dataid == self.hband[0]:
-                dat = i.data
+                band = i
 
-        self.image.set_data(dat)
+        self.image.set_data(band.data, [band])
         dat = norm2(self.image.smallres)
 
         xdim = (x2-x1)/dat.data.shape[1]/2
@@ -728,12 +1086,14 @@ class MyMplCanvas(FigureCanvas):
         """ Updates the RGB Ternary Map """
         self.image.dtype = self.gmode
         dat = [None, None, None]
+        bands = [None, None, None]
         for i in self.data:
             for j in range(3):
                 if i.dataid == self.hband[j]:
                     dat[j] = i.data
+                    bands[j] = i
 
-        self.image.set_data(dat)
+        self.image.set_data(dat, bands)
         hdata = self.image.smallres
 
         for i in range(3):
@@ -778,9 +1138,9 @@ class MyMplCanvas(FigureCanvas):
         self.image.dtype = 'Single Color Map'
         for i in self.data:
             if i.dataid == self.hband[0]:
-                dat = i.data
+                band = i
 
-        self.image.set_data(dat)
+        self.image.set_data(band.data, [band])
         dat = self.image.smallres
 
         self.hhist[0] = self.argb[0].hist(dat.compressed(), 50, ec='none')
@@ -809,16 +1169,19 @@ class MyMplCanvas(FigureCanvas):
         """ Updates sun shade plot """
         self.image.dtype = 'Sunshade'
         data = [None, None]
+        bands = [None, None]
 
         for i in self.data:
             if i.dataid == self.hband[0]:
                 data[0] = i.data
+                bands[0] = i
 
         for i in self.sdata:
             if i.dataid == self.hband[1]:
                 data[1] = i.data
+                bands[1] = i
 
-        self.image.set_data(data)
+        self.image.set_data(data, bands)
 
         hdata = self.image.smallres
 
@@ -1713,28 +2076,7 @@ def histcomp(img, nbr_bins=256):
     imask = np.ma.getmaskarray(img)
     tmp = img.compressed()
     imhist, bins = np.histogram(tmp, nbr_bins)
-
-    cdf = imhist.cumsum()  # cumulative distribution function
-    cdf = cdf / float(cdf[-1])  # normalize
-
-    perc = 5.
-    perc = perc/100.
-
-    sindx = np.arange(nbr_bins)[cdf > perc][0]
-    if cdf[0] > (1-perc):
-        eindx = 1
-    else:
-        eindx = np.arange(nbr_bins)[cdf < (1-perc)][-1]+1
-    svalue = bins[sindx]
-    evalue = bins[eindx]
-
-    scnt = perc*(nbr_bins-1)
-    if scnt > sindx:
-        scnt = sindx
-
-    ecnt = perc*(nbr_bins-1)
-    if ecnt > ((nbr_bins-1)-eindx):
-        ecnt = (nbr_bins-1)-eindx
+    svalue, evalue = histcomp_limits(imhist, bins)
 
     img2 = np.empty_like(img, dtype=np.float32)
     np.copyto(img2, img)
@@ -1750,6 +2092,41 @@ def histcomp(img, nbr_bins=256):
     return img2
 
 
+def histcomp_limits(imhist, bins, perc=5.):
+    """
+    Limits used by histogram compaction.
+
+    Parameters
+    ----------
+    imhist : numpy array
+        histogram counts
+    bins : numpy array
+        histogram bin edges
+    perc : float
+        percentage of values to compact at each end
+
+    Returns
+    -------
+    svalue : float
+        values below this are set to it
+    evalue : float
+        values above this are set to it
+    """
+    nbr_bins = imhist.size
+    cdf = imhist.cumsum()  # cumulative distribution function
+    cdf = cdf / float(cdf[-1])  # normalize
+
+    perc = perc/100.
+
+    sindx = np.arange(nbr_bins)[cdf > perc][0]
+    if cdf[0] > (1-perc):
+        eindx = 1
+    else:
+        eindx = np.arange(nbr_bins)[cdf < (1-perc)][-1]+1
+
+    return bins[sindx], bins[eindx]
+
+
 def histeq(img, nbr_bins=32768):
     """
     Histogram Equalization - equalizes the histogram to colors. This allows for
@@ -1769,8 +2146,60 @@ def histeq(img, nbr_bins=32768):
     im2 : numpy array
         output data
     """
+    bins, cdf = histeq_table(img, nbr_bins)
+
+# use linear interpolation of cdf to find new pixel values
+    im2 = np.interp(img, bins, cdf)
+    im2 = np.ma.array(im2, mask=img.mask)
+
+    return im2
+
+
+def histeq_table(img, nbr_bins=32768):
+    """
+    Histogram equalization table. Values are equalized by interpolating
+    the cdf at the bin centres.
+
+    Parameters
+    ----------
+    img : numpy array
+        input data
+    nbr_bins : integer
+        number of bins to be used in the calculation
+
+    Returns
+    -------
+    bins : numpy array
+        bin centres
+    cdf : numpy array
+        cumulative distribution function at the bin centres, normalised to
+        nbr_bins
+    """
 # get image histogram
     imhist, bins = np.histogram(img.compressed(), nbr_bins)
+    return cdf_table(imhist, bins)
+
+
+def cdf_table(imhist, bins):
+    """
+    Histogram equalization table from a histogram.
+
+    Parameters
+    ----------
+    imhist : numpy array
+        histogram counts
+    bins : numpy array
+        histogram bin edges
+
+    Returns
+    -------
+    bins : numpy array
+        bin centres
+    cdf : numpy array
+        cumulative distribution function at the bin centres, normalised to
+        the number of bins
+    """
+    nbr_bins = imhist.size
     bins = (bins[1:]-bins[:-1])/2+bins[:-1]
 
     cdf = imhist.cumsum()  # cumulative distribution function
@@ -1778,11 +2207,7 @@ def histeq(img, nbr_bins=32768):
     cdf = cdf.astype(np.int64)
     cdf = nbr_bins * cdf / cdf[-1]  # norm to nbr_bins
 
-# use linear interpolation of cdf to find new pixel values
-    im2 = np.interp(img, bins, cdf)
-    im2 = np.ma.array(im2, mask=img.mask)
-
-    return im2
+    return bins, cdf
 
 
 def img2rgb(img, cbar):
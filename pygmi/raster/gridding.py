@@ -0,0 +1,477 @@
+# -----------------------------------------------------------------------------
+# Name:        gridding.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2018 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+""" Gridding of point data.
+
+All routines grid onto the same cells. Cell (i, j) covers x from
+xmin+j*dxy to xmin+(j+1)*dxy and y from ymin+i*dxy to ymin+(i+1)*dxy, so
+row 0 is the southern edge of the grid.
+
+ * quickgrid bins points into cells and fills empty cells from a pyramid of
+   coarser grids.
+ * idw uses inverse distance weighting of the nearest points, found with a
+   KD-tree. The grid is calculated one strip of rows at a time.
+ * mincurv is a minimum curvature (optionally with tension) surface. It is
+   solved from coarse to fine grids, with each iteration run in parallel
+   over strips of rows.
+
+Points are binned in chunks, so apart from the input arrays (and the KD-tree
+for idw), memory use depends on the grid size and not the number of points.
+"""
+
+import numpy as np
+from numba import jit, prange
+from scipy.spatial import cKDTree
+import scipy.ndimage as ndimage
+from pygmi.misc import INSTR
+from pygmi.raster.tiles import TileOutput, strips
+
+# Number of points binned at a time
+CHUNKPOINTS = 2**22
+
+
+def grid_extent(x, y, dxy):
+    """
+    Grid extent for a set of points.
+
+    Parameters
+    ----------
+    x : numpy array
+        array of x coordinates
+    y : numpy array
+        array of y coordinates
+    dxy : float
+        cell size
+
+    Returns
+    -------
+    xmin : float
+        western edge of the grid
+    ymin : float
+        southern edge of the grid
+    rows : int
+        number of rows
+    cols : int
+        number of columns
+    """
+    xmin = x.min()
+    ymin = y.min()
+    rows = int((y.max()-ymin)/dxy)+1
+    cols = int((x.max()-xmin)/dxy)+1
+    return xmin, ymin, rows, cols
+
+
+def bin_points(x, y, z, xmin, ymin, dxy, rows, cols, chunk=CHUNKPOINTS):
+    """
+    Sums and counts the points in each cell of a grid. Points outside the
+    grid are ignored.
+
+    Parameters
+    ----------
+    x : numpy array
+        array of x coordinates
+    y : numpy array
+        array of y coordinates
+    z : numpy array
+        array of z values
+    xmin : float
+        western edge of the grid
+    ymin : float
+        southern edge of the grid
+    dxy : float
+        cell size
+    rows : int
+        number of rows
+    cols : int
+        number of columns
+    chunk : int
+        number of points binned at a time
+
+    Returns
+    -------
+    zsum : numpy array
+        sum of the z values in each cell
+    zcnt : numpy array
+        number of points in each cell
+    """
+    zsum = np.zeros(rows*cols)
+    zcnt = np.zeros(rows*cols, dtype=np.int64)
+
+    with INSTR.span('bin points', points=z.size):
+        for i in range(0, z.size, chunk):
+            xindex = ((x[i:i+chunk]-xmin)/dxy).astype(int)
+            yindex = ((y[i:i+chunk]-ymin)/dxy).astype(int)
+            ztmp = z[i:i+chunk]
+
+            filt = ((xindex >= 0) & (xindex < cols) & (yindex >= 0) &
+                    (yindex < rows))
+            index = yindex[filt]*cols+xindex[filt]
+
+            zsum += np.bincount(index, ztmp[filt], rows*cols)
+            zcnt += np.bincount(index, minlength=rows*cols)
+
+    return zsum.reshape(rows, cols), zcnt.reshape(rows, cols)
+
+
+def coarsen(arr, fact):
+    """
+    Sums blocks of fact x fact cells. The grid is padded with zeros to a
+    multiple of fact.
+
+    Parameters
+    ----------
+    arr : numpy array
+        input grid
+    fact : int
+        block size
+
+    Returns
+    -------
+    numpy array
+        grid of block sums
+    """
+    rows, cols = arr.shape
+    rows2 = -(-rows//fact)
+    cols2 = -(-cols//fact)
+    tmp = np.zeros((rows2*fact, cols2*fact), dtype=arr.dtype)
+    tmp[:rows, :cols] = arr
+    return tmp.reshape(rows2, fact, cols2, fact).sum(axis=(1, 3))
+
+
+def quickgrid(x, y, z, dxy, showtext=None, numits=4):
+    """
+    Do a quick grid
+
+    Points are averaged in each cell. Empty cells are filled from
+    successively coarser grids, each with cells twice the size of the
+    previous one.
+
+    Parameters
+    ----------
+    x : numpy array
+        array of x coordinates
+    y : numpy array
+        array of y coordinates
+    z : numpy array
+        array of z values - this is the column being gridded
+    dxy : float
+        cell size for the grid, in both the x and y direction.
+    showtext : module, optional
+        showtext provided an alternative to print
+    numits : int
+        number of iterations. By default its 4. If this is negative, a maximum
+        numits will be calculated and used.
+
+    Returns
+    -------
+    newz : numpy array
+        M x N array of z values
+    """
+    if showtext is None:
+        showtext = print
+
+    showtext('Creating Grid')
+    x = x.flatten()
+    y = y.flatten()
+    z = z.flatten()
+
+    xmin, ymin, rows, cols = grid_extent(x, y, dxy)
+
+    if numits < 1:
+        numits = int(max(np.log2(cols), np.log2(rows)))
+
+    zsum, zcnt = bin_points(x, y, z, xmin, ymin, dxy, rows, cols)
+    filt = zcnt > 0
+    zfin = np.zeros([rows, cols])
+    zfin[filt] = zsum[filt]/zcnt[filt]
+    newmask = np.logical_not(filt)
+    showtext('Iteration done: 1 of '+str(numits))
+
+# Coarser grids are block sums of the finest grid, so the points are only
+# binned once.
+    for j in range(1, numits):
+        if not newmask.any():
+            break
+        jj = 2**j
+        csum = coarsen(zsum, jj)
+        ccnt = coarsen(zcnt, jj)
+
+        xx, yy = newmask.nonzero()
+        xx2 = xx//jj
+        yy2 = yy//jj
+        cnt = ccnt[xx2, yy2]
+        filt = cnt > 0
+        zfin[xx[filt], yy[filt]] = csum[xx2[filt], yy2[filt]]/cnt[filt]
+        newmask[xx[filt], yy[filt]] = False
+
+        showtext('Iteration done: '+str(j+1)+' of '+str(numits))
+
+    showtext('Finished!')
+
+    newz = np.ma.array(zfin)
+    newz.mask = newmask
+    return newz
+
+
+def idw(x, y, z, dxy, nnear=8, power=2., maxdist=None, nthreads=None,
+        showtext=None):
+    """
+    Inverse distance weighted grid.
+
+    Each cell centre is the weighted mean of its nearest points. Cells
+    further than maxdist from all points are masked.
+
+    Parameters
+    ----------
+    x : numpy array
+        array of x coordinates
+    y : numpy array
+        array of y coordinates
+    z : numpy array
+        array of z values - this is the column being gridded
+    dxy : float
+        cell size for the grid, in both the x and y direction.
+    nnear : int
+        number of nearest points used for each cell
+    power : float
+        power of the inverse distance weights
+    maxdist : float
+        maximum distance of points used. Defaults to no limit.
+    nthreads : int
+        number of threads used to search the KD-tree. None uses all
+        processors.
+    showtext : module, optional
+        showtext provided an alternative to print
+
+    Returns
+    -------
+    newz : numpy masked array
+        M x N array of z values
+    """
+    if showtext is None:
+        showtext = print
+    if maxdist is None:
+        maxdist = np.inf
+    if nthreads is None:
+        nthreads = -1
+
+    x = x.flatten()
+    y = y.flatten()
+    z = z.flatten()
+    nnear = min(nnear, z.size)
+    xmin, ymin, rows, cols = grid_extent(x, y, dxy)
+
+    showtext('Creating KD-tree')
+    with INSTR.span('kd-tree', points=z.size):
+        tree = cKDTree(np.column_stack([x, y]))
+
+    xcen = xmin+(np.arange(cols)+0.5)*dxy
+    out = TileOutput((rows, cols))
+    windows = strips(rows, cols, itemsize=24*nnear)
+
+    showtext('Creating Grid')
+    for row0, row1, _, _ in windows:
+        with INSTR.span('idw strip', rows=(row0, row1)):
+            ycen = ymin+(np.arange(row0, row1)+0.5)*dxy
+            xx, yy = np.meshgrid(xcen, ycen)
+            dist, idx = tree.query(np.column_stack([xx.ravel(), yy.ravel()]),
+                                   nnear, distance_upper_bound=maxdist,
+                                   workers=nthreads)
+            dist = dist.reshape(xx.size, nnear)
+            idx = idx.reshape(xx.size, nnear)
+
+            out.write(row0, _idw_weights(dist, idx, z, power).reshape(
+                xx.shape))
+
+    showtext('Finished!')
+    return out.result()
+
+
+def _idw_weights(dist, idx, z, power):
+    """ Weighted means from the distances and indices of nearest points """
+    valid = np.isfinite(dist)
+    zval = np.zeros(dist.shape)
+    zval[valid] = z[idx[valid]]
+
+    wgt = np.zeros(dist.shape)
+    wgt[valid] = 1./np.maximum(dist[valid], np.finfo(float).tiny)**power
+
+# A point on a cell centre gets all the weight
+    exact = dist == 0.
+    rexact = exact.any(1)
+    wgt[rexact] = exact[rexact]
+
+    wsum = wgt.sum(1)
+    mask = wsum == 0.
+    wsum[mask] = 1.
+    return np.ma.array((wgt*zval).sum(1)/wsum, mask=mask)
+
+
+def mincurv(x, y, z, dxy, tension=0., maxdist=None, maxiter=200, tol=1e-4,
+            showtext=None):
+    """
+    Minimum curvature grid.
+
+    Points are averaged into cells, and these cells are held fixed while
+    the rest of the grid is relaxed towards a surface of minimum curvature
+    ((1-tension)*biharmonic + tension*laplacian = 0). The surface is first
+    solved on coarse grids, and each solution is the starting surface of
+    the next finer grid.
+
+    Parameters
+    ----------
+    x : numpy array
+        array of x coordinates
+    y : numpy array
+        array of y coordinates
+    z : numpy array
+        array of z values - this is the column being gridded
+    dxy : float
+        cell size for the grid, in both the x and y direction.
+    tension : float
+        tension, from 0 (minimum curvature) to 1 (harmonic surface)
+    maxdist : float
+        cells further than this from all points are masked. Defaults to no
+        limit.
+    maxiter : int
+        maximum number of iterations on each grid
+    tol : float
+        iterations stop when the largest change is less than tol times the
+        range of the data
+    showtext : module, optional
+        showtext provided an alternative to print
+
+    Returns
+    -------
+    newz : numpy masked array
+        M x N array of z values
+    """
+    if showtext is None:
+        showtext = print
+    if not 0. <= tension <= 1.:
+        raise ValueError('Tension must be between 0 and 1')
+
+    x = x.flatten()
+    y = y.flatten()
+    z = z.flatten()
+    xmin, ymin, rows, cols = grid_extent(x, y, dxy)
+
+    showtext('Creating Grid')
+    zsum, zcnt = bin_points(x, y, z, xmin, ymin, dxy, rows, cols)
+    ztol = tol*max(np.ptp(z), np.finfo(float).tiny)
+
+# Coarsest grid has at least 8 cells in each direction
+    nlevels = max(0, int(np.log2(max(min(rows, cols), 1)/8.)))
+
+    zgrid = None
+    for level in range(nlevels, -1, -1):
+        fact = 2**level
+        csum = coarsen(zsum, fact)
+        ccnt = coarsen(zcnt, fact)
+        fixed = ccnt > 0
+        fval = np.zeros(csum.shape)
+        fval[fixed] = csum[fixed]/ccnt[fixed]
+
+        if zgrid is None:
+            zgrid = np.full(csum.shape, fval[fixed].mean())
+        else:
+            zgrid = np.repeat(np.repeat(zgrid, 2, 0), 2, 1)
+            zgrid = np.ascontiguousarray(zgrid[:csum.shape[0],
+                                               :csum.shape[1]])
+        zgrid[fixed] = fval[fixed]
+
+        with INSTR.span('mincurv level', shape=csum.shape):
+            zgrid, nits = _mc_solve(zgrid, fixed, tension, maxiter, ztol)
+            INSTR.count('iterations', nits)
+
+        showtext('Grid '+str(nlevels-level+1)+' of '+str(nlevels+1) +
+                 ', iterations: '+str(nits))
+
+    newmask = np.zeros((rows, cols), dtype=bool)
+    if maxdist is not None:
+        dist = ndimage.distance_transform_edt(zcnt == 0)*dxy
+        newmask = dist > maxdist
+
+    showtext('Finished!')
+    return np.ma.array(zgrid, mask=newmask)
+
+
+def _mc_solve(zgrid, fixed, tension, maxiter, ztol):
+    """ Iterates a minimum curvature grid until it converges """
+    znew = np.empty_like(zgrid)
+    nits = 0
+    for nits in range(1, maxiter+1):
+        change = _mc_sweep(zgrid, fixed, znew, tension).max()
+        zgrid, znew = znew, zgrid
+        if change < ztol:
+            break
+    return zgrid, nits
+
+
+@jit(nopython=True, parallel=True)
+def _mc_sweep(zgrid, fixed, znew, tension, strip=16):
+    """
+    One damped Jacobi iteration of the minimum curvature equation,
+    calculated in parallel over strips of rows. Edges are extended by
+    repeating the outer cells. Returns the largest change in each strip.
+    """
+    rows, cols = zgrid.shape
+    nstrips = (rows+strip-1)//strip
+    change = np.zeros(nstrips)
+
+# The damping keeps the highest frequencies from growing.
+    omega = 0.5
+    denom = (1.-tension)*20.+tension*4.
+
+    for istrip in prange(nstrips):
+        cmax = 0.
+        for i in range(istrip*strip, min(rows, (istrip+1)*strip)):
+            im1 = max(i-1, 0)
+            im2 = max(i-2, 0)
+            ip1 = min(i+1, rows-1)
+            ip2 = min(i+2, rows-1)
+            for j in range(cols):
+                if fixed[i, j]:
+                    znew[i, j] = zgrid[i, j]
+                    continue
+                jm1 = max(j-1, 0)
+                jm2 = max(j-2, 0)
+                jp1 = min(j+1, cols-1)
+                jp2 = min(j+2, cols-1)
+
+                sn4 = (zgrid[im1, j]+zgrid[ip1, j]+zgrid[i, jm1] +
+                       zgrid[i, jp1])
+                sdiag = (zgrid[im1, jm1]+zgrid[im1, jp1]+zgrid[ip1, jm1] +
+                         zgrid[ip1, jp1])
+                sn2 = (zgrid[im2, j]+zgrid[ip2, j]+zgrid[i, jm2] +
+                       zgrid[i, jp2])
+
+                target = ((1.-tension)*(8.*sn4-2.*sdiag-sn2) +
+                          tension*sn4)/denom
+                dz = omega*(target-zgrid[i, j])
+                znew[i, j] = zgrid[i, j]+dz
+                cmax = max(cmax, abs(dz))
+        change[istrip] = cmax
+
+    return change
@@ -0,0 +1,378 @@
+# -----------------------------------------------------------------------------
+# Name:        gxf.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2018 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+""" Geosoft GXF grid exchange files.
+
+Uncompressed and compressed (base 90) grids are read and written a block of
+rows at a time.
+
+In a compressed grid every value is GTYPE characters from '%' to '~', each
+a base 90 digit. GTYPE '!' characters are a dummy value, and '"' followed by
+a count and a value repeats the value count times. Values are scaled by
+#TRANSFORM after decoding.
+"""
+
+import numpy as np
+from numba import jit
+from pygmi.raster.datatypes import Data
+import pygmi.raster.asciigrid as asciigrid
+import pygmi.raster.tiles as tiles
+
+CHAR0 = 37
+DUMMYCHAR = 33
+REPEATCHAR = 34
+LINELENGTH = 80
+
+# Row order and orientation for each #SENSE value, as (transpose, flip rows,
+# flip columns) to give rows from north to south and columns from west to
+# east.
+SENSES = {1: (False, True, False), -1: (True, True, False),
+          -2: (False, False, False), 2: (True, False, False),
+          -3: (True, False, True), 3: (False, False, True),
+          -4: (False, True, True), 4: (True, True, True)}
+
+
+def read_header(fno):
+    """
+    Reads GXF keywords up to #GRID.
+
+    Parameters
+    ----------
+    fno : file
+        open GXF file
+
+    Returns
+    -------
+    header : dictionary
+        keywords (upper case, without #) and their lines of text
+    """
+    header = {}
+    key = None
+    for line in iter(fno.readline, ''):
+        line = line.strip()
+        if line.startswith('#'):
+            key = line[1:].split()[0].upper() if line[1:].split() else ''
+            if key == 'GRID':
+                return header
+            header[key] = []
+        elif key is not None and line:
+            header[key].append(line)
+    raise ValueError('The file has no #GRID section')
+
+
+def _value(header, key, default):
+    """ First number of a keyword """
+    if key not in header or not header[key]:
+        return default
+    return float(header[key][0].split()[0])
+
+
+@jit(nopython=True)
+def _base90(buf, start, gtype):
+    """ Value of gtype base 90 digits """
+    val = 0.
+    for i in range(start, start+gtype):
+        val = val*90. + (buf[i]-CHAR0)
+    return val
+
+
+@jit(nopython=True)
+def decode_base90(buf, gtype, out, npts):
+    """
+    Decodes compressed GXF values.
+
+    Parameters
+    ----------
+    buf : numpy array
+        uint8 array of characters. Values do not continue over line ends,
+        so buf must end at the end of a line.
+    gtype : int
+        characters per value
+    out : numpy array
+        output values, before #TRANSFORM is applied. Dummies are NaN.
+    npts : int
+        number of values already in out
+
+    Returns
+    -------
+    npts : int
+        number of values in out
+    """
+    i = 0
+    nbuf = buf.size
+    size = out.size
+    while i < nbuf and npts < size:
+        char = buf[i]
+        if char == 10 or char == 13 or char == 32 or char == 9:
+            i += 1
+        elif char == REPEATCHAR:
+            count = int(_base90(buf, i+1, gtype))
+            i += 1+gtype
+            if buf[i] == DUMMYCHAR:
+                val = np.nan
+            else:
+                val = _base90(buf, i, gtype)
+            i += gtype
+            for _ in range(min(count, size-npts)):
+                out[npts] = val
+                npts += 1
+        elif char == DUMMYCHAR:
+            out[npts] = np.nan
+            npts += 1
+            i += gtype
+        else:
+            out[npts] = _base90(buf, i, gtype)
+            npts += 1
+            i += gtype
+    return npts
+
+
+def encode_base90(vals, gtype):
+    """
+    Encodes integers as base 90 GXF characters.
+
+    Parameters
+    ----------
+    vals : numpy array
+        integers from 0 to 90**gtype-1. Negative values are dummies.
+    gtype : int
+        characters per value
+
+    Returns
+    -------
+    chars : numpy array
+        uint8 array of shape (vals.size, gtype)
+    """
+    vals = np.asarray(vals, dtype=np.int64).ravel()
+    chars = np.empty((vals.size, gtype), dtype=np.uint8)
+    tmp = np.maximum(vals, 0)
+    for i in range(gtype-1, -1, -1):
+        chars[:, i] = tmp % 90 + CHAR0
+        tmp //= 90
+    chars[vals < 0] = DUMMYCHAR
+    return chars
+
+
+def _read_compressed(fno, count, gtype, chunkbytes):
+    """ Reads compressed values, a chunk of lines at a time """
+    if chunkbytes is None:
+        chunkbytes = asciigrid.CHUNKBYTES
+
+    out = np.empty(count)
+    npts = 0
+    rest = ''
+    while npts < count:
+        text = fno.read(chunkbytes)
+        last = not text
+        text = rest+text
+        rest = ''
+        if not last:
+            idx = text.rfind('\n')
+            rest = text[idx+1:]
+            text = text[:idx+1]
+        buf = np.frombuffer(text.encode('latin-1'), dtype=np.uint8)
+        npts = decode_base90(buf, gtype, out, npts)
+        if last:
+            break
+
+    if npts < count:
+        raise ValueError('The file has fewer values than expected')
+    return out
+
+
+def get_gxf(ifile, chunkbytes=None):
+    """
+    Imports a GXF grid, compressed or uncompressed.
+
+    Parameters
+    ----------
+    ifile : str
+        filename to import
+    chunkbytes : int
+        size of the chunks read at a time
+
+    Returns
+    -------
+    dat : list
+        list with one PyGMI raster Data
+    """
+    with open(ifile, encoding='latin-1') as fno:
+        header = read_header(fno)
+
+        npts = int(_value(header, 'POINTS', 0))
+        nrows = int(_value(header, 'ROWS', 0))
+        gtype = int(_value(header, 'GTYPE', 0))
+        sense = int(_value(header, 'SENSE', 1))
+        dummy = _value(header, 'DUMMY', None)
+
+        if sense not in SENSES:
+            raise ValueError('Unknown #SENSE in '+ifile)
+        if gtype == 0:
+            data = asciigrid.read_values(fno, npts*nrows, '', chunkbytes)
+        else:
+            data = _read_compressed(fno, npts*nrows, gtype, chunkbytes)
+
+    if dummy is not None and gtype == 0:
+        data[data == dummy] = np.nan
+
+    scale, offset = 1., 0.
+    if header.get('TRANSFORM'):
+        scale, offset = [float(i) for i in header['TRANSFORM'][0].split()[:2]]
+    if scale != 1. or offset != 0.:
+        data *= scale
+        data += offset
+
+    data.shape = (nrows, npts)
+    transpose, fliprows, flipcols = SENSES[sense]
+    ptsep = _value(header, 'PTSEPARATION', 1.)
+    rwsep = _value(header, 'RWSEPARATION', ptsep)
+    xdim, ydim = ptsep, rwsep
+    if transpose:
+        data = data.T
+        xdim, ydim = rwsep, ptsep
+    if fliprows:
+        data = data[::-1]
+    if flipcols:
+        data = data[:, ::-1]
+    data = np.ascontiguousarray(data)
+    rows, cols = data.shape
+
+# The origin is the first point, so the corner is half a cell further out.
+    xorigin = _value(header, 'XORIGIN', 0.)
+    yorigin = _value(header, 'YORIGIN', 0.)
+    if flipcols:
+        tlx = xorigin-(cols-0.5)*xdim
+    else:
+        tlx = xorigin-xdim/2
+    if fliprows:
+        tly = yorigin+(rows-0.5)*ydim
+    else:
+        tly = yorigin+ydim/2
+
+    dat = Data()
+    dat.data = np.ma.masked_invalid(data, copy=False)
+    dat.nrofbands = 1
+    dat.tlx = tlx
+    dat.tly = tly
+    dat.xdim = xdim
+    dat.ydim = ydim
+    dat.rows = rows
+    dat.cols = cols
+    dat.nullvalue = dummy if dummy is not None else 1e+20
+    dat.gtr = (tlx, xdim, 0.0, tly, 0.0, -ydim)
+    bname = ifile.replace('\\', '/').rpartition('/')[-1]
+    dat.dataid = bname.rpartition('.')[0]
+    if header.get('TITLE'):
+        dat.dataid = header['TITLE'][0]
+
+    return [dat]
+
+
+def export_gxf(ofile, dat, title='', gtype=0, chunkbytes=None):
+    """
+    Exports a GXF grid. Rows are written from the bottom (#SENSE 1), a
+    block at a time.
+
+    Parameters
+    ----------
+    ofile : str
+        output filename
+    dat : PyGMI raster Data
+        dataset to export
+    title : str
+        grid title
+    gtype : int
+        characters per value for a compressed grid, or 0 for an uncompressed
+        grid. Compressed values are rounded to 90**gtype-1 levels between
+        the minimum and maximum.
+    chunkbytes : int
+        approximate size of the chunks written at a time
+    """
+    if chunkbytes is None:
+        chunkbytes = asciigrid.CHUNKBYTES
+    source = tiles.band_source(dat)
+    rows, cols = source.shape
+
+# GXF origins are grid nodes, so the centre of the bottom left cell is used.
+    xorigin = dat.tlx + dat.xdim/2
+    yorigin = dat.tly - dat.rows*dat.ydim + dat.ydim/2
+
+    with open(ofile, 'w') as fno:
+        fno.write('#TITLE\n' + title)
+        fno.write('\n#POINTS\n' + str(dat.cols))
+        fno.write('\n#ROWS\n' + str(dat.rows))
+        fno.write('\n#PTSEPARATION\n' + str(dat.xdim))
+        fno.write('\n#RWSEPARATION\n' + str(dat.ydim))
+        fno.write('\n#XORIGIN\n' + str(xorigin))
+        fno.write('\n#YORIGIN\n' + str(yorigin))
+        fno.write('\n#SENSE\n1')
+        fno.write('\n#DUMMY\n' + str(dat.nullvalue))
+
+        if gtype > 0:
+            stats = tiles.tile_stats(source)
+            offset = stats['min']
+            scale = (stats['max']-stats['min'])/(90**gtype-1)
+            if not scale > 0:
+                scale = 1.
+            if stats['count'] == 0:
+                offset = 0.
+            fno.write('\n#GTYPE\n' + str(gtype))
+            fno.write('\n#TRANSFORM\n' + repr(float(scale)) + ' ' +
+                      repr(float(offset)))
+        fno.write('\n#GRID\n')
+
+        nrows = max(1, chunkbytes//(cols*24))
+        for row1 in range(rows, 0, -nrows):
+            row0 = max(0, row1-nrows)
+            block = source.read(row0, row1)[::-1]
+            if gtype == 0:
+                fno.write(_format_gxf(block.filled(dat.nullvalue)))
+            else:
+                fno.write(_format_base90(block, gtype, scale, offset))
+
+
+def _format_gxf(block):
+    """ Uncompressed rows, five values per line, each row on a new line """
+    text = []
+    for row in asciigrid.str_rows(block):
+        row = [i+'  ' for i in row]
+        for i in range(0, len(row), 5):
+            text.append('\n' + ''.join(row[i:i+5]))
+    return ''.join(text)
+
+
+def _format_base90(block, gtype, scale, offset):
+    """ Compressed rows, each row starting on a new line """
+    vals = np.rint((np.ma.getdata(block)-offset)/scale)
+    vals = np.clip(vals, 0, 90**gtype-1)
+    vals[np.ma.getmaskarray(block) | ~np.isfinite(vals)] = -1
+
+    nchars = (LINELENGTH//gtype)*gtype
+    chars = encode_base90(vals, gtype).reshape(block.shape[0], -1)
+    text = []
+    for row in chars:
+        row = row.tobytes().decode('ascii')
+        for i in range(0, len(row), nchars):
+            text.append(row[i:i+nchars] + '\n')
+    return ''.join(text)
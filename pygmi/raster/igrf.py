@@ -52,12 +52,20 @@ from math import sin
 from math import cos
 from math import sqrt
 from math import atan2
+import os
 import copy
+import datetime
 from PyQt5 import QtWidgets, QtCore
 import numpy as np
+from numba import jit, prange
 from osgeo import osr
 import pygmi.raster.dataprep as dp
 import pygmi.menu_default as menu_default
+from pygmi.misc import INSTR
+
+MAXDEG = 13
+MAXCOEFF = (MAXDEG*(MAXDEG+2)+1)
+_MODELS = {}
 
 
 class IGRF(QtWidgets.QDialog):
@@ -142,9 +150,6 @@ class IGRF(QtWidgets.QDialog):
         self.reportback = self.parent.showprocesslog
         self.pbar = self.parent.pbar
 
-        MAXDEG = 13
-        MAXCOEFF = (MAXDEG*(MAXDEG+2)+1)
-
         self.gh = np.zeros([4, MAXCOEFF])
         self.d = 0
         self.f = 0
@@ -169,6 +174,7 @@ class IGRF(QtWidgets.QDialog):
         self.ddot = 0
 
         self.dsb_alt = QtWidgets.QDoubleSpinBox()
+        self.sb_step = QtWidgets.QSpinBox()
         self.dateedit = QtWidgets.QDateEdit()
         self.combobox_dtm = QtWidgets.QComboBox()
         self.combobox_mag = QtWidgets.QComboBox()
@@ -189,17 +195,22 @@ class IGRF(QtWidgets.QDialog):
         label_1 = QtWidgets.QLabel()
         label_2 = QtWidgets.QLabel()
         label_3 = QtWidgets.QLabel()
+        label_4 = QtWidgets.QLabel()
 
         buttonbox.setOrientation(QtCore.Qt.Horizontal)
         buttonbox.setStandardButtons(buttonbox.Cancel | buttonbox.Ok)
 
         self.dsb_alt.setMaximum(99999.9)
+        self.sb_step.setMinimum(1)
+        self.sb_step.setMaximum(10000)
+        self.sb_step.setValue(1)
 
         self.setWindowTitle("IGRF")
         label_0.setText("Sensor clearance above ground")
         label_1.setText("Date")
         label_2.setText("Digital Elevation Model")
         label_3.setText("Magnetic Data")
+        label_4.setText("Calculate every n cells and interpolate")
 
         gridlayout.addWidget(self.proj, 0, 0, 1, 2)
         gridlayout.addWidget(label_0, 2, 0, 1, 1)
@@ -210,8 +221,10 @@ class IGRF(QtWidgets.QDialog):
         gridlayout.addWidget(self.combobox_dtm, 4, 1, 1, 1)
         gridlayout.addWidget(label_3, 5, 0, 1, 1)
         gridlayout.addWidget(self.combobox_mag, 5, 1, 1, 1)
-        gridlayout.addWidget(buttonbox, 6, 1, 1, 1)
-        gridlayout.addWidget(helpdocs, 6, 0, 1, 1)
+        gridlayout.addWidget(label_4, 6, 0, 1, 1)
+        gridlayout.addWidget(self.sb_step, 6, 1, 1, 1)
+        gridlayout.addWidget(buttonbox, 7, 1, 1, 1)
+        gridlayout.addWidget(helpdocs, 7, 0, 1, 1)
 
         buttonbox.accepted.connect(self.accept)
         buttonbox.rejected.connect(self.reject)
@@ -226,6 +239,8 @@ class IGRF(QtWidgets.QDialog):
 
         targ = osr.SpatialReference()
         targ.SetWellKnownGeogCS('WGS84')
+        if hasattr(targ, 'SetAxisMappingStrategy'):
+            targ.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
 
         self.ctrans = osr.CoordinateTransformation(orig, targ)
 
@@ -253,56 +268,18 @@ class IGRF(QtWidgets.QDialog):
         else:
             return False
 
-        mdf = open(__file__.rpartition('\\')[0]+'\\IGRF12.cof')
-        modbuff = mdf.readlines()
-        fileline = -1                            # First line will be 1
-        model = []
-        epoch = []
-        max1 = []
-        max2 = []
-        max3 = []
-        yrmin = []
-        yrmax = []
-        altmin = []
-        altmax = []
-        irec_pos = []
-# First model will be 0
-        for i in modbuff:
-            fileline += 1  # On new line
-            if i[:3] == '   ':
-                i2 = i.split()
-                model.append(i2[0])
-                epoch.append(float(i2[1]))
-                max1.append(int(i2[2]))
-                max2.append(int(i2[3]))
-                max3.append(int(i2[4]))
-                yrmin.append(float(i2[5]))
-                yrmax.append(float(i2[6]))
-                altmin.append(float(i2[7]))
-                altmax.append(float(i2[8]))
-                irec_pos.append(fileline)
-
         i = self.combobox_mag.currentIndex()
         maggrid = data[i]
 
         i = self.combobox_dtm.currentIndex()
         data = data[i]
-        altgrid = data.data.flatten() * 0.001  # in km
 
-        maxyr = max(yrmax)
+        model = get_model()
+        maxyr = model.yrmax[-1]
         sdate = self.dateedit.date()
         sdate = sdate.year()+sdate.dayOfYear()/sdate.daysInYear()
         alt = self.dsb_alt.value()
-        xrange = data.tlx+data.xdim/2.+np.arange(data.cols)*data.xdim
-        yrange = data.tly-data.ydim/2.-np.arange(data.rows)*data.ydim
-        xdat, ydat = np.meshgrid(xrange, yrange)
-        xdat = xdat.flatten()
-        ydat = ydat.flatten()
-
-        igrf_F = altgrid * 0
-        # Pick model
-        yrmax = np.array(yrmax)
-        modelI = sum(yrmax < sdate)
+        altgrid = (data.data + alt) * 0.001  # in km
         igdgc = 1
 
         if (sdate > maxyr) and (sdate < maxyr+1):
@@ -313,42 +290,31 @@ class IGRF(QtWidgets.QDialog):
             self.reportback("An updated model file is available before 1.1." +
                             str(maxyr))
 
-        if max2[modelI] == 0:
-            self.getshc(modbuff, 1, irec_pos[modelI], max1[modelI], 0)
-            self.getshc(modbuff, 1, irec_pos[modelI+1], max1[modelI+1], 1)
-            nmax = self.interpsh(sdate, yrmin[modelI], max1[modelI],
-                                 yrmin[modelI+1], max1[modelI+1], 2)
-            nmax = self.interpsh(sdate+1, yrmin[modelI], max1[modelI],
-                                 yrmin[modelI+1], max1[modelI+1], 3)
-        else:
-            self.getshc(modbuff, 1, irec_pos[modelI], max1[modelI], 0)
-            self.getshc(modbuff, 0, irec_pos[modelI], max2[modelI], 1)
-            nmax = self.extrapsh(sdate, epoch[modelI], max1[modelI],
-                                 max2[modelI], 2)
-            nmax = self.extrapsh(sdate+1, epoch[modelI], max1[modelI],
-                                 max2[modelI], 3)
-
-        progress = 0
-        maxlen = xdat.size
-
-        for i in self.pbar.iter(range(maxlen)):
-            if igrf_F.mask[i] == True:
-                continue
-
-            tmp = int(i*100/maxlen)
-            if tmp > progress:
-                progress = tmp
-
-            longitude, latitude, _ = self.ctrans.TransformPoint(xdat[i],
-                                                                ydat[i])
-            alt = altgrid[i]
-
-# Do the first calculations
-            self.shval3(igdgc, latitude, longitude, alt, nmax, 3)
+        try:
+            ghv, nmax = model.coeffs(sdate)
+        except ValueError as err:
+            self.reportback(str(err))
+            return False
+        self.gh[2][:ghv.size] = ghv
+
+        step = self.sb_step.value()
+        igrf_F, errmax = igrf_grid(self.ctrans, data, altgrid, self.gh[2],
+                                   nmax, step)
+        if step > 1:
+            self.reportback('Largest interpolation error found: ' +
+                            str(errmax)+' nT')
+
+# Values at the last cell, for the report
+        valid = np.flatnonzero(~np.ma.getmaskarray(altgrid))
+        if valid.size > 0:
+            row, col = divmod(valid[-1], data.cols)
+            longitude, latitude, _ = self.ctrans.TransformPoint(
+                data.tlx+data.xdim/2.+col*data.xdim,
+                data.tly-data.ydim/2.-row*data.ydim)
+            self.shval3(igdgc, latitude, longitude, altgrid[row, col], nmax,
+                        3)
             self.dihf(3)
 
-            igrf_F[i] = self.f
-
         self.outdata['Raster'] = copy.deepcopy(self.indata['Raster'])
         igrf_F = np.ma.array(igrf_F)
         igrf_F.shape = data.data.shape
@@ -802,3 +768,582 @@ class IGRF(QtWidgets.QDialog):
             self.ftemp = f
             self.itemp = i
             self.dtemp = d
+
+
+def transform_points(ctrans, xdat, ydat, chunk=2**20):
+    """
+    Transforms arrays of coordinates to longitude and latitude, in chunks.
+
+    Parameters
+    ----------
+    ctrans : osr.CoordinateTransformation
+        transformation to geographic coordinates
+    xdat : numpy array
+        x coordinates
+    ydat : numpy array
+        y coordinates
+    chunk : int
+        number of points transformed at a time
+
+    Returns
+    -------
+    lon : numpy array
+        longitudes in degrees
+    lat : numpy array
+        latitudes in degrees
+    """
+    lon = np.empty(xdat.size)
+    lat = np.empty(xdat.size)
+    for i in range(0, xdat.size, chunk):
+        pts = np.column_stack([xdat[i:i+chunk], ydat[i:i+chunk]])
+        tmp = np.array(ctrans.TransformPoints(pts))
+        lon[i:i+chunk] = tmp[:, 0]
+        lat[i:i+chunk] = tmp[:, 1]
+    return lon, lat
+
+
+@jit(nopython=True, nogil=True)
+def _shval3(igdgc, flat, flon, elev, nmax, ghv, p, q, sl, cl):
+    """
+    Field components at one point. This is the same calculation as
+    IGRF.shval3, with the coefficients and work arrays passed in.
+    """
+    earths_radius = 6371.2
+    dtr = np.pi/180.0
+    a2 = 40680631.59            # WGS84
+    b2 = 40408299.98            # WGS84
+    r = elev
+    slat = np.sin(flat*dtr)
+    if (90.0 - flat) < 0.001:
+        aa = 89.999
+    elif (90.0 + flat) < 0.001:
+        aa = -89.999
+    else:
+        aa = flat
+
+    clat = np.cos(aa*dtr)
+    sl[1] = np.sin(flon*dtr)
+    cl[1] = np.cos(flon*dtr)
+
+    x = 0.
+    y = 0.
+    z = 0.
+    sd = 0.0
+    cd = 1.0
+    l = 0
+    n = 0
+    m = 1
+    npq = (nmax*(nmax+3))//2
+    if igdgc == 1:
+        aa = a2*clat*clat
+        bb = b2*slat*slat
+        cc = aa+bb
+        dd = np.sqrt(cc)
+        r = np.sqrt(elev*(elev+2.0*dd)+(a2*aa+b2*bb)/cc)
+        cd = (elev+dd)/r
+        sd = (a2-b2)/dd*slat*clat/r
+        aa = slat
+        slat = slat*cd-clat*sd
+        clat = clat*cd+aa*sd
+
+    ratio = earths_radius/r
+    aa = np.sqrt(3.0)
+    p[1] = 2.0*slat
+    p[2] = 2.0*clat
+    p[3] = 4.5*slat*slat-1.5
+    p[4] = 3.0*aa*clat*slat
+    q[1] = -clat
+    q[2] = slat
+    q[3] = -3.0*clat*slat
+    q[4] = aa*(slat*slat-clat*clat)
+
+    rr = 0.
+    fn = 0.
+    for k in range(1, npq+1):
+        if n < m:
+            m = 0
+            n = n+1
+            rr = ratio**(n+2)
+            fn = float(n)
+
+        fm = float(m)
+        if k >= 5:
+            if m == n:
+                aa = np.sqrt(1.0-0.5/fm)
+                j = k-n-1
+                p[k] = (1.0+1.0/fm)*aa*clat*p[j]
+                q[k] = aa*(clat*q[j]+slat/fm*p[j])
+                sl[m] = sl[m-1]*cl[1]+cl[m-1]*sl[1]
+                cl[m] = cl[m-1]*cl[1]-sl[m-1]*sl[1]
+            else:
+                aa = np.sqrt(fn*fn-fm*fm)
+                bb = np.sqrt((fn-1.0)*(fn-1.0)-fm*fm)/aa
+                cc = (2.0*fn-1.0)/aa
+                ii = k-n
+                j = k-2*n+1
+                p[k] = (fn+1.0)*(cc*slat/fn*p[ii]-bb/(fn-1.0)*p[j])
+                q[k] = cc*(slat*q[ii]-clat/fn*p[ii])-bb*q[j]
+
+        aa = rr*ghv[l]
+        if m == 0:
+            x = x+aa*q[k]
+            z = z-aa*p[k]
+            l = l+1
+        else:
+            bb = rr*ghv[l+1]
+            cc = aa*cl[m]+bb*sl[m]
+            x = x+cc*q[k]
+            z = z-cc*p[k]
+            if clat > 0:
+                y = y+(aa*sl[m]-bb*cl[m])*fm*p[k]/((fn+1.0)*clat)
+            else:
+                y = y+(aa*sl[m]-bb*cl[m])*q[k]*slat
+            l = l+2
+
+        m = m+1
+
+    aa = x
+    x = x*cd+z*sd
+    z = z*cd-aa*sd
+
+    return x, y, z
+
+
+@jit(nopython=True, parallel=True)
+def shval3_grid(igdgc, lat, lon, elev, nmax, ghv, chunk=1024):
+    """
+    Calculates field components at many points, in parallel.
+
+    Parameters
+    ----------
+    igdgc : int
+        1 if geodetic, 2 if geocentric coordinates
+    lat : numpy array
+        north latitudes, in degrees
+    lon : numpy array
+        east longitudes, in degrees
+    elev : numpy array
+        WGS84 altitude above ellipsoid in km (igdgc=1), or radial distance
+        from earth's center (igdgc=2)
+    nmax : int
+        maximum degree and order of coefficients
+    ghv : numpy array
+        Schmidt quasi-normal internal spherical harmonic coefficients
+    chunk : int
+        number of points given to a thread at a time
+
+    Returns
+    -------
+    x : numpy array
+        northward component
+    y : numpy array
+        eastward component
+    z : numpy array
+        vertically-downward component
+    """
+    npts = lat.size
+    x = np.empty(npts)
+    y = np.empty(npts)
+    z = np.empty(npts)
+    nchunks = (npts+chunk-1)//chunk
+
+    for ichunk in prange(nchunks):
+        sl = np.zeros(14)
+        cl = np.zeros(14)
+        p = np.zeros(119)
+        q = np.zeros(119)
+        for i in range(ichunk*chunk, min(npts, (ichunk+1)*chunk)):
+            x[i], y[i], z[i] = _shval3(igdgc, lat[i], lon[i], elev[i], nmax,
+                                       ghv, p, q, sl, cl)
+
+    return x, y, z
+
+
+def _bilinear(coarse, rpos, cpos, rows, cols):
+    """
+    Interpolates a lattice onto a grid. rpos and cpos are the grid rows and
+    columns of the lattice nodes.
+    """
+    tmp = np.empty((coarse.shape[0], cols))
+    for k in range(coarse.shape[0]):
+        tmp[k] = np.interp(np.arange(cols), cpos, coarse[k])
+
+    rfrac = np.interp(np.arange(rows), rpos, np.arange(rpos.size))
+    i0 = np.minimum(rfrac.astype(int), rpos.size-2)
+    wgt = (rfrac-i0)[:, np.newaxis]
+    return tmp[i0]*(1.-wgt)+tmp[i0+1]*wgt
+
+
+def igrf_grid(ctrans, data, alt, ghv, nmax, step=1, nchk=1000):
+    """
+    Total IGRF field for every cell of a raster.
+
+    Parameters
+    ----------
+    ctrans : osr.CoordinateTransformation
+        transformation from the raster projection to geographic
+        coordinates
+    data : Data
+        PyGMI raster dataset, which gives the grid
+    alt : numpy masked array
+        altitude of each cell, in km. Masked cells are calculated at the
+        lowest altitude.
+    ghv : numpy array
+        Schmidt quasi-normal internal spherical harmonic coefficients
+    nmax : int
+        maximum degree and order of coefficients
+    step : int
+        if more than 1, the field is only calculated on a lattice with
+        nodes every step cells (at the lowest and highest altitude) and
+        interpolated to the other cells.
+    nchk : int
+        number of cells where the interpolated field is checked against
+        the full calculation, when step is more than 1.
+
+    Returns
+    -------
+    igrf_f : numpy array
+        total field
+    errmax : float
+        largest difference between the interpolated and the fully
+        calculated field at the checked cells. It is 0 if step is 1.
+    """
+    rows, cols = alt.shape
+    alt = np.ma.array(alt, dtype=np.float64)
+    alt = alt.filled(alt.min() if alt.count() > 0 else 0.)
+
+    def field(rr, cc, elev):
+        """ Total field at rows and columns of the grid """
+        xdat = data.tlx+data.xdim/2.+cc*data.xdim
+        ydat = data.tly-data.ydim/2.-rr*data.ydim
+        lon, lat = transform_points(ctrans, xdat, ydat)
+        x, y, z = shval3_grid(1, lat, lon, elev, nmax, ghv)
+        return np.sqrt(x*x+y*y+z*z)
+
+    if step <= 1:
+        with INSTR.span('igrf grid', cells=alt.size):
+            rr, cc = np.mgrid[0:rows, 0:cols]
+            igrf_f = field(rr.ravel(), cc.ravel(), alt.ravel())
+        return igrf_f.reshape(rows, cols), 0.
+
+    with INSTR.span('igrf lattice', step=step):
+        rpos = np.unique(np.append(np.arange(0, rows, step), rows-1))
+        cpos = np.unique(np.append(np.arange(0, cols, step), cols-1))
+        if rpos.size < 2:
+            rpos = np.array([0, max(rows-1, 1)])
+        if cpos.size < 2:
+            cpos = np.array([0, max(cols-1, 1)])
+        rr, cc = np.meshgrid(rpos, cpos, indexing='ij')
+
+# The field changes almost linearly with altitude over a survey, so the
+# lattice is calculated at the lowest and highest altitude.
+        altmin = alt.min()
+        altmax = alt.max()
+        flo = field(rr.ravel(), cc.ravel(), np.full(rr.size, altmin))
+        fhi = field(rr.ravel(), cc.ravel(), np.full(rr.size, altmax))
+        flo = _bilinear(flo.reshape(rr.shape), rpos, cpos, rows, cols)
+        fhi = _bilinear(fhi.reshape(rr.shape), rpos, cpos, rows, cols)
+
+        awgt = 0.
+        if altmax > altmin:
+            awgt = (alt-altmin)/(altmax-altmin)
+        igrf_f = flo+(fhi-flo)*awgt
+
+# Check the interpolation at lattice cell centres (where it is worst) and
+# at random cells.
+        nmid = nchk//2
+        rchk = np.append(np.random.choice((rpos[:-1]+rpos[1:])//2, nmid),
+                         np.random.randint(0, rows, nchk-nmid))
+        cchk = np.append(np.random.choice((cpos[:-1]+cpos[1:])//2, nmid),
+                         np.random.randint(0, cols, nchk-nmid))
+        fchk = field(rchk, cchk, alt[rchk, cchk])
+        errmax = np.abs(fchk-igrf_f[rchk, cchk]).max()
+
+    return igrf_f, errmax
+
+
+def cofiles():
+    """
+    Returns the coefficient files supplied with PyGMI, oldest first. Newer
+    files (e.g. IGRF13.COF) placed in the same directory are found too.
+    """
+    cdir = os.path.dirname(os.path.abspath(__file__))
+    files = [i for i in os.listdir(cdir)
+             if i.upper().startswith('IGRF') and i.upper().endswith('.COF')]
+    files.sort(key=lambda i: (len(i), i.upper()))
+    return [os.path.join(cdir, i) for i in files]
+
+
+def decimal_year(date):
+    """
+    Date as a decimal year, in the same way as the IGRF dialog.
+
+    Parameters
+    ----------
+    date : datetime.date or float
+        date. Floats are returned unchanged.
+
+    Returns
+    -------
+    float
+        decimal year
+    """
+    if isinstance(date, (datetime.date, datetime.datetime)):
+        ndays = datetime.date(date.year, 12, 31).timetuple().tm_yday
+        return date.year+date.timetuple().tm_yday/ndays
+    return float(date)
+
+
+class FieldModel(object):
+    """
+    Spherical harmonic field model, read from a coefficient (.COF) file.
+
+    The file is parsed once into arrays. Use get_model to share models
+    between callers.
+
+    Attributes
+    ----------
+    cofile : str
+        coefficient file name
+    names : list
+        model names, e.g. 'IGRF2015'
+    epoch : numpy array
+        epoch of each model
+    max1 : numpy array
+        main field maximum degree of each model
+    max2 : numpy array
+        secular variation maximum degree of each model
+    yrmin : numpy array
+        first year of each model
+    yrmax : numpy array
+        last year of each model
+    main : numpy array
+        main field coefficients of each model
+    svar : numpy array
+        secular variation coefficients of each model
+    """
+    def __init__(self, cofile=None):
+        if cofile is None:
+            cofile = cofiles()[-1]
+        self.cofile = cofile
+        self._coeffs = {}
+
+        with open(cofile) as mdf:
+            modbuff = mdf.readlines()
+
+        headers = [i for i, line in enumerate(modbuff) if line[:3] == '   ']
+        if not headers:
+            raise ValueError(cofile+' is not a coefficient file')
+
+        nmod = len(headers)
+        self.names = []
+        self.epoch = np.zeros(nmod)
+        self.max1 = np.zeros(nmod, dtype=int)
+        self.max2 = np.zeros(nmod, dtype=int)
+        self.yrmin = np.zeros(nmod)
+        self.yrmax = np.zeros(nmod)
+        self.main = np.zeros((nmod, MAXCOEFF))
+        self.svar = np.zeros((nmod, MAXCOEFF))
+
+        for imod, irec in enumerate(headers):
+            i2 = modbuff[irec].split()
+            self.names.append(i2[0])
+            self.epoch[imod] = float(i2[1])
+            self.max1[imod] = int(i2[2])
+            self.max2[imod] = int(i2[3])
+            self.yrmin[imod] = float(i2[5])
+            self.yrmax[imod] = float(i2[6])
+
+            nrec = self.max1[imod]*(self.max1[imod]+3)//2
+            tmp = np.array([i.split()[:6] for i in
+                            modbuff[irec+1:irec+1+nrec]], dtype=float)
+
+# Coefficients are ordered g(n, 0), g(n, 1), h(n, 1), g(n, 2), ...
+            keep = np.ones((nrec, 2), dtype=bool)
+            keep[:, 1] = tmp[:, 1] != 0
+            keep = keep.ravel()
+            main = tmp[:, 2:4].ravel()[keep]
+            svar = tmp[:, 4:6].ravel()[keep]
+            nsv = self.max2[imod]*(self.max2[imod]+2)
+            self.main[imod, :main.size] = main
+            self.svar[imod, :nsv] = svar[:nsv]
+
+    def coeffs(self, date):
+        """
+        Coefficients of the model for a date. These are interpolated between
+        models, or extrapolated with the secular variation, as in
+        IGRF.interpsh and IGRF.extrapsh.
+
+        Parameters
+        ----------
+        date : float
+            date in decimal years
+
+        Returns
+        -------
+        ghv : numpy array
+            Schmidt quasi-normal internal spherical harmonic coefficients
+        nmax : int
+            maximum degree and order of the coefficients
+        """
+        date = float(date)
+        if date in self._coeffs:
+            return self._coeffs[date]
+
+        if date < self.yrmin[0] or date > self.yrmax[-1]+1:
+            raise ValueError('The date '+str(date)+' is outside the range '
+                             'of '+os.path.basename(self.cofile))
+
+        imod = min(int(np.sum(self.yrmax < date)), len(self.names)-1)
+
+# Coefficients above the maximum degree of a model are zero, so the terms
+# which only one model has follow from the same expressions.
+        if self.max2[imod] == 0:
+            nmax = int(max(self.max1[imod], self.max1[imod+1]))
+            factor = ((date-self.yrmin[imod]) /
+                      (self.yrmin[imod+1]-self.yrmin[imod]))
+            ghv = self.main[imod]+factor*(self.main[imod+1]-self.main[imod])
+        else:
+            nmax = int(max(self.max1[imod], self.max2[imod]))
+            factor = date-self.epoch[imod]
+            ghv = self.main[imod]+factor*self.svar[imod]
+
+        self._coeffs[date] = (ghv, nmax)
+        return ghv, nmax
+
+    def field(self, lat, lon, alt, date, igdgc=1):
+        """
+        Magnetic field at points.
+
+        Parameters
+        ----------
+        lat : float or numpy array
+            north latitude, in degrees
+        lon : float or numpy array
+            east longitude, in degrees
+        alt : float or numpy array
+            WGS84 altitude above the ellipsoid in km (igdgc=1), or radial
+            distance from the earth's center (igdgc=2)
+        date : float or datetime.date
+            date, as a decimal year or a date
+        igdgc : int
+            1 if geodetic, 2 if geocentric coordinates
+
+        Returns
+        -------
+        f : numpy array
+            total intensity in nT
+        inc : numpy array
+            inclination in degrees
+        dec : numpy array
+            declination in degrees
+        """
+        ghv, nmax = self.coeffs(decimal_year(date))
+        lat, lon, alt = np.broadcast_arrays(np.asarray(lat, dtype=float),
+                                            np.asarray(lon, dtype=float),
+                                            np.asarray(alt, dtype=float))
+        shape = lat.shape
+
+        x, y, z = shval3_grid(igdgc, lat.ravel(), lon.ravel(), alt.ravel(),
+                              nmax, ghv)
+
+# The same special cases as IGRF.dihf
+        sn = 0.0001
+        h = np.sqrt(x*x+y*y)
+        f = np.sqrt(x*x+y*y+z*z)
+        inc = np.where(f < sn, np.nan, np.arctan2(z, h))
+        dec = np.where(h+x < sn, np.pi, 2.0*np.arctan2(y, h+x))
+        dec[(f < sn) | (h < sn)] = np.nan
+
+        return (f.reshape(shape), np.rad2deg(inc).reshape(shape),
+                np.rad2deg(dec).reshape(shape))
+
+
+def get_model(cofile=None):
+    """
+    Returns a FieldModel. Models are only read once, and are shared.
+
+    Parameters
+    ----------
+    cofile : str
+        coefficient file name. Defaults to the newest supplied file.
+
+    Returns
+    -------
+    FieldModel
+        field model
+    """
+    if cofile is None:
+        cofile = cofiles()[-1]
+    key = (os.path.abspath(cofile), os.path.getmtime(cofile))
+    if key not in _MODELS:
+        _MODELS[key] = FieldModel(cofile)
+    return _MODELS[key]
+
+
+def field(lat, lon, alt, date, cofile=None):
+    """
+    Magnetic field at points, from the newest IGRF model.
+
+    Parameters
+    ----------
+    lat : float or numpy array
+        north latitude, in degrees
+    lon : float or numpy array
+        east longitude, in degrees
+    alt : float or numpy array
+        WGS84 altitude above the ellipsoid, in km
+    date : float or datetime.date
+        date, as a decimal year or a date
+    cofile : str
+        coefficient file name. Defaults to the newest supplied file.
+
+    Returns
+    -------
+    f : numpy array
+        total intensity in nT
+    inc : numpy array
+        inclination in degrees
+    dec : numpy array
+        declination in degrees
+    """
+    return get_model(cofile).field(lat, lon, alt, date)
+
+
+def data_field(data, date=None, alt=0.):
+    """
+    Magnetic field at the centre of a raster, from the newest IGRF model.
+
+    Parameters
+    ----------
+    data : Data
+        PyGMI raster dataset, with a projection
+    date : float or datetime.date
+        date. Defaults to today.
+    alt : float
+        altitude in km
+
+    Returns
+    -------
+    tuple
+        total intensity (nT), inclination and declination (degrees), or
+        None if the raster has no projection.
+    """
+    if not data.wkt:
+        return None
+    if date is None:
+        date = datetime.date.today()
+
+    orig = osr.SpatialReference()
+    if orig.ImportFromWkt(data.wkt) != 0:
+        return None
+    targ = osr.SpatialReference()
+    targ.SetWellKnownGeogCS('WGS84')
+    if hasattr(targ, 'SetAxisMappingStrategy'):
+        targ.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    ctrans = osr.CoordinateTransformation(orig, targ)
+
+    lon, lat, _ = ctrans.TransformPoint(data.tlx+data.xdim*data.cols/2.,
+                                        data.tly-data.ydim*data.rows/2.)
+    f, inc, dec = field(lat, lon, alt, date)
+    return float(f), float(inc), float(dec)
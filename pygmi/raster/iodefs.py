@@ -27,13 +27,20 @@
 import os
 import glob
 import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5 import QtWidgets
 import numpy as np
+from numba import jit
 from osgeo import gdal, osr
 from pygmi.raster.datatypes import Data
 from pygmi.clust.datatypes import Clust
 from pygmi.raster.dataprep import merge
-from pygmi.raster.dataprep import quickgrid
+from pygmi.raster.gridding import quickgrid
+import pygmi.raster.tiles as tiles
+import pygmi.raster.asciigrid as asciigrid
+import pygmi.raster.gxf as gxf
+from pygmi.misc import INSTR
 
 
 class ImportData(object):
@@ -82,35 +89,30 @@ class ImportData(object):
             "Surfer grid (v.6) (*.grd);;" + \
             "GeoPak grid (*.grd);;" + \
             "ASCII with .hdr header (*.asc);;" + \
+            "ESRI ASCII grid (*.asc);;" + \
             "ASCII XYZ (*.xyz);;" + \
             "Arcinfo Binary Grid (hdr.adf);;" + \
             "ArcGIS BIL (*.bil)"
 
-        filename, filt = QtWidgets.QFileDialog.getOpenFileName(
+        filenames, filt = QtWidgets.QFileDialog.getOpenFileNames(
             self.parent, 'Open File', '.', ext)
-        if filename == '':
+        if not filenames:
             return False
-        os.chdir(filename.rpartition('/')[0])
-        self.ifile = str(filename)
-        self.ext = filename[-3:]
+        os.chdir(filenames[0].rpartition('/')[0])
+        self.ifile = str(filenames[0])
+        self.ext = self.ifile[-3:]
         self.ext = self.ext.lower()
 
-        if filt == 'GeoPak grid (*.grd)':
-            dat = get_geopak(self.ifile)
-        elif filt == 'Geosoft UNCOMPRESSED grid (*.grd)':
-            dat = get_geosoft(self.ifile)
-        elif filt == 'hdf (*.hdf)':
-            dat = get_hdf(self.ifile)
-        elif filt == "hdf (*.h5)":
-            dat = get_hdf(self.ifile)
-        elif filt == 'ASCII with .hdr header (*.asc)':
-            dat = get_ascii(self.ifile)
-        elif filt == 'ASTER GED (*.bin)':
-            dat = get_aster_ged_bin(self.ifile)
+# Several files, for example a season of scenes, are read concurrently.
+        if len(filenames) > 1:
+            showtext = print
+            if self.parent is not None:
+                showtext = self.parent.showprocesslog
+            dat = get_files(filenames, filt, showtext=showtext)
         else:
-            dat = get_raster(self.ifile)
+            dat = import_file(self.ifile, filt)
 
-        if dat is None:
+        if not dat:
             if filt == 'Surfer grid (v.6) (*.grd)':
                 QtWidgets.QMessageBox.warning(self.parent, 'Error',
                                               'Could not import the surfer 6 '
@@ -168,14 +170,8 @@ def get_ascii(ifile):
         dataset imported
     """
 
-    afile = open(ifile, 'r')
-    adata = afile.read()
-
-    adata = adata.split()
-    adata = np.array(adata, dtype=float)
-
-    hfile = open(ifile[:-3]+'hdr', 'r')
-    tmp = hfile.readlines()
+    with open(ifile[:-3]+'hdr', 'r') as hfile:
+        tmp = hfile.readlines()
 
     xdim = float(tmp[0].split()[-1])
     ydim = float(tmp[1].split()[-1])
@@ -186,6 +182,8 @@ def get_ascii(ifile):
     ulymap = float(tmp[6].split()[-1])
     bandid = ifile[:-4].rsplit('/')[-1]
 
+    with open(ifile, 'r') as afile:
+        adata = asciigrid.read_values(afile, nrows*ncols)
     adata.shape = (nrows, ncols)
 
     if nbands > 1:
@@ -194,14 +192,9 @@ def get_ascii(ifile):
     dat = [Data()]
     i = 0
 
-    dat[i].data = adata
-
     nval = -9999.0
 
-    dat[i].data = np.ma.masked_equal(dat[i].data, nval)
-    if dat[i].data.mask.size == 1:
-        dat[i].data.mask = (np.ma.make_mask_none(dat[i].data.shape) +
-                            dat[i].data.mask)
+    dat[i].data = np.ma.array(adata, mask=(adata == nval), copy=False)
 
     dat[i].nrofbands = nbands
     dat[i].tlx = ulxmap
@@ -278,29 +271,13 @@ def get_raster(ifile):
             dat.append(Clust())
         else:
             dat.append(Data())
-        dat[i].data = rtmp.ReadAsArray()
-        if dat[i].data.dtype.kind == 'i':
-            if nval is None:
-                nval = 999999
-            nval = int(nval)
-        elif dat[i].data.dtype.kind == 'u':
-            if nval is None:
-                nval = 0
-            nval = int(nval)
-        else:
-            if nval is None:
-                nval = 1e+20
-            nval = float(nval)
-        if ext == 'ers' and nval == -1.0e+32:
-            dat[i].data[np.ma.less_equal(dat[i].data, nval)] = -1.0e+32
 
-# Note that because the data is stored in a masked array, the array ends up
-# being double the size that it was on the disk.
-        dat[i].data = np.ma.masked_invalid(dat[i].data)
-        dat[i].data.mask = np.ma.getmaskarray(dat[i].data) | (dat[i].data == nval)
-        if dat[i].data.mask.size == 1:
-            dat[i].data.mask = (np.ma.make_mask_none(dat[i].data.shape) +
-                                np.ma.getmaskarray(dat[i].data))
+# Only the data type is read here. The band is read when it is first used.
+        nval = nodata_value(rtmp.ReadAsArray(0, 0, 1, 1).dtype, nval)
+        source = tiles.GDALBand(ifile, i+1, nval, dataset)
+        if ext == 'ers' and nval == -1.0e+32:
+            source.maskbelow = True
+        dat[i].source = source
 
         dat[i].nrofbands = dataset.RasterCount
         dat[i].tlx = gtr[0]
@@ -332,7 +309,229 @@ def get_raster(ifile):
     return dat
 
 
-def get_hdf(ifile):
+def nodata_value(dtype, nval=None):
+    """
+    Nodata value for a band, with a default for each data type.
+
+    Parameters
+    ----------
+    dtype : numpy dtype
+        data type of the band
+    nval : float
+        nodata value from the file, or None
+
+    Returns
+    -------
+    nval : int or float
+        nodata value
+    """
+    kind = np.dtype(dtype).kind
+    if kind == 'i':
+        if nval is None:
+            nval = 999999
+        nval = int(nval)
+    elif kind == 'u':
+        if nval is None:
+            nval = 0
+        nval = int(nval)
+    else:
+        if nval is None:
+            nval = 1e+20
+        nval = float(nval)
+    return nval
+
+
+def mask_nodata(data, nval, scale=None):
+    """
+    Masks nodata and invalid values and applies a scale factor. The mask and
+    the scaled data are each made in one pass, without intermediate copies.
+
+    Parameters
+    ----------
+    data : numpy array or masked array
+        band data
+    nval : float
+        nodata value, in unscaled units
+    scale : float
+        scale factor, or None
+
+    Returns
+    -------
+    numpy masked array
+        masked and scaled data
+    """
+    mask = np.ma.getmaskarray(data) | (np.ma.getdata(data) == nval)
+    data = np.ma.getdata(data)
+    if scale is not None:
+        data = np.multiply(data, scale, dtype=np.float64)
+    if data.dtype.kind == 'f':
+        mask |= ~np.isfinite(data)
+    return np.ma.array(data, mask=mask, copy=False)
+
+
+def read_subdatasets(names, warp=False, nthreads=None):
+    """
+    Reads GDAL datasets or subdatasets concurrently. GDAL releases the GIL
+    while reading, so the reads overlap.
+
+    Parameters
+    ----------
+    names : list
+        list of dataset or subdataset names
+    warp : bool
+        if True, each dataset is read through gdal.AutoCreateWarpedVRT.
+    nthreads : int
+        number of threads. None uses the number of processors.
+
+    Returns
+    -------
+    subs : list
+        list of dictionaries, one for each name, with the data array, gtr,
+        wkt, nrofbands and bands, a list of (description, nodata value)
+        tuples.
+    """
+    def read(name):
+        """ Reads one dataset """
+        with INSTR.span('read subdataset', dataset=name):
+            dataset = gdal.Open(name, gdal.GA_ReadOnly)
+
+            sub = {'nrofbands': dataset.RasterCount, 'bands': []}
+            for i in range(dataset.RasterCount):
+                rtmp = dataset.GetRasterBand(i+1)
+                sub['bands'].append((rtmp.GetDescription(),
+                                     rtmp.GetNoDataValue()))
+
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(dataset.GetProjection())
+            srs.AutoIdentifyEPSG()
+            sub['wkt'] = srs.ExportToWkt()
+
+            if warp:
+                dataset = gdal.AutoCreateWarpedVRT(dataset)
+            sub['gtr'] = dataset.GetGeoTransform()
+            sub['data'] = dataset.ReadAsArray()
+            INSTR.count('bytes read', sub['data'].nbytes)
+        return sub
+
+    tstart = time.perf_counter()
+    if nthreads == 1 or len(names) < 2:
+        subs = [read(i) for i in names]
+    else:
+        with ThreadPoolExecutor(nthreads) as pool:
+            subs = list(pool.map(INSTR.bind(read), names))
+
+    nbytes = sum(i['data'].nbytes for i in subs)
+    INSTR.event('read subdatasets', datasets=len(names),
+                mbps=throughput(nbytes, time.perf_counter()-tstart))
+    return subs
+
+
+def throughput(nbytes, seconds):
+    """ Throughput in MB/s """
+    return nbytes/max(seconds, 1e-9)/2**20
+
+
+def import_file(ifile, filt='', nthreads=None):
+    """
+    Imports a file with the reader for a file dialog filter.
+
+    Parameters
+    ----------
+    ifile : str
+        filename to import
+    filt : str
+        filter chosen in the ImportData file dialog. For other filters, HDF
+        (*.hdf, *.h5), ASTER GED (*.bin), GXF (*.gxf) and XYZ (*.xyz) files
+        use their own readers, and all others are read with GDAL.
+    nthreads : int
+        number of threads used to read HDF subdatasets. None uses the number
+        of processors.
+
+    Returns
+    -------
+    dat : list
+        list of PyGMI raster Data, or None if the file could not be read.
+    """
+    ext = ifile.lower().rpartition('.')[-1]
+
+    if filt == 'GeoPak grid (*.grd)':
+        dat = get_geopak(ifile)
+    elif filt == 'Geosoft UNCOMPRESSED grid (*.grd)':
+        dat = get_geosoft(ifile)
+    elif filt == 'ASCII with .hdr header (*.asc)':
+        dat = get_ascii(ifile)
+    elif filt == 'ESRI ASCII grid (*.asc)':
+        dat = asciigrid.get_esri_ascii(ifile)
+    elif filt.startswith('hdf') or ext in ('hdf', 'h5'):
+        dat = get_hdf(ifile, nthreads)
+    elif filt == 'Geosoft (*.gxf)' or ext == 'gxf':
+        dat = gxf.get_gxf(ifile)
+    elif filt == 'ASCII XYZ (*.xyz)' or ext == 'xyz':
+        dat = asciigrid.get_xyz(ifile)
+    elif filt == 'ASTER GED (*.bin)' or ext == 'bin':
+        dat = get_aster_ged_bin(ifile)
+    else:
+        dat = get_raster(ifile)
+    return dat
+
+
+def get_files(ifiles, filt='', nthreads=None, showtext=None):
+    """
+    Imports many files concurrently, for example a season of scenes. Files
+    are read in a thread pool, and all bands are loaded.
+
+    Parameters
+    ----------
+    ifiles : list
+        list of filenames
+    filt : str
+        file dialog filter, used to choose the reader (see import_file)
+    nthreads : int
+        number of threads. None uses the number of processors.
+    showtext : function
+        routine used to report progress and throughput, e.g. print.
+
+    Returns
+    -------
+    dat : list
+        list of PyGMI raster Data from all files, in the order of ifiles.
+    """
+    if showtext is None:
+        showtext = print
+
+    def load(ifile):
+        """ Imports and loads one file """
+        with INSTR.span('import file', filename=ifile):
+            dat = import_file(ifile, filt, 1)
+            if dat is None:
+                return ifile, []
+
+# Bands from get_raster are read when they are first used, so read them here.
+            nbytes = 0
+            for i in dat:
+                nbytes += i.data.nbytes
+            INSTR.count('bytes loaded', nbytes)
+        return ifile, dat
+
+    tstart = time.perf_counter()
+    with ThreadPoolExecutor(nthreads) as pool:
+        results = list(pool.map(INSTR.bind(load), ifiles))
+    seconds = time.perf_counter()-tstart
+
+    dat = []
+    for ifile, dat2 in results:
+        if not dat2:
+            showtext('Could not import '+ifile)
+        dat += dat2
+
+    nbytes = sum(i.data.nbytes for i in dat)
+    showtext('Imported {0} files, {1:.1f} MB in {2:.2f} s ({3:.1f} MB/s)'
+             ''.format(len(ifiles), nbytes/2**20, seconds,
+                       throughput(nbytes, seconds)))
+    return dat
+
+
+def get_hdf(ifile, nthreads=None):
     """
     This function loads a raster dataset off the disk using the GDAL
     libraries. It returns the data in a PyGMI data object.
@@ -341,6 +540,9 @@ def get_hdf(ifile):
     ----------
     ifile : str
         filename to import
+    nthreads : int
+        number of threads used to read subdatasets. None uses the number of
+        processors.
 
     Returns
     -------
@@ -357,18 +559,18 @@ def get_hdf(ifile):
     metadata = dataset.GetMetadata()
 
     if 'Moderate Resolution Imaging Spectroradiometer' in metadata.values():
-        dat = get_modis(ifile)
+        dat = get_modis(ifile, nthreads)
     elif 'ASTER' in metadata.values():
-        dat = get_aster(ifile)
+        dat = get_aster(ifile, nthreads)
     elif 'ASTER_GDEM_ASTGDEM_Description' in metadata:
-        dat = get_aster_ged(ifile)
+        dat = get_aster_ged(ifile, nthreads)
     else:
         dat = None
 
     return dat
 
 
-def get_modis(ifile):
+def get_modis(ifile, nthreads=None):
     """
     Gets MODIS data
 
@@ -376,6 +578,9 @@ def get_modis(ifile):
     ----------
     ifile : str
         filename to import
+    nthreads : int
+        number of threads used to read subdatasets. None uses the number of
+        processors.
 
     Returns
     -------
@@ -419,12 +624,12 @@ def get_modis(ifile):
             tmp.append(i)
     subdata = tmp
 
-    i = -1
-    for ifile2, bandid2 in subdata:
-        dataset = gdal.Open(ifile2, gdal.GA_ReadOnly)
+    subs = read_subdatasets([j[0] for j in subdata], nthreads=nthreads)
 
-        gtr = dataset.GetGeoTransform()
-        rtmp2 = dataset.ReadAsArray()
+    i = -1
+    for sub, (_, bandid2) in zip(subs, subdata):
+        gtr = sub['gtr']
+        rtmp2 = sub['data']
 
         if rtmp2.shape[-1] == min(rtmp2.shape) and rtmp2.ndim == 3:
             rtmp2 = np.transpose(rtmp2, (2, 0, 1))
@@ -434,9 +639,7 @@ def get_modis(ifile):
             nbands = rtmp2.shape[0]
 
         for i2 in range(nbands):
-            rtmp = dataset.GetRasterBand(i2+1)
-            bandid = rtmp.GetDescription()
-            nval = rtmp.GetNoDataValue()
+            bandid, nval = sub['bands'][i2]
             i += 1
 
             dat.append(Data())
@@ -455,29 +658,12 @@ def get_modis(ifile):
                 tmp = quickgrid(newx, newy, newz, latsdim)
                 mask = np.ma.getmaskarray(tmp)
                 gdat = tmp.data
-                dat[i].data = np.ma.masked_invalid(gdat[::-1])
-                dat[i].data.mask = mask[::-1]
-
-            if dat[i].data.dtype.kind == 'i':
-                if nval is None:
-                    nval = 999999
-                nval = int(nval)
-            elif dat[i].data.dtype.kind == 'u':
-                if nval is None:
-                    nval = 0
-                nval = int(nval)
-            else:
-                if nval is None:
-                    nval = 1e+20
-                nval = float(nval)
+                dat[i].data = np.ma.array(gdat[::-1], mask=mask[::-1])
 
-            dat[i].data = np.ma.masked_invalid(dat[i].data)
-            dat[i].data.mask = np.ma.getmaskarray(dat[i].data) | (dat[i].data == nval)
-            if dat[i].data.mask.size == 1:
-                dat[i].data.mask = (np.ma.make_mask_none(dat[i].data.shape) +
-                                    np.ma.getmaskarray(dat[i].data))
+            nval = nodata_value(dat[i].data.dtype, nval)
+            dat[i].data = mask_nodata(dat[i].data, nval)
 
-            dat[i].nrofbands = dataset.RasterCount
+            dat[i].nrofbands = sub['nrofbands']
             dat[i].tlx = tlx
             dat[i].tly = tly
             dat[i].dataid = bandid2+' '+bandid
@@ -487,17 +673,12 @@ def get_modis(ifile):
             dat[i].xdim = abs(lonsdim)
             dat[i].ydim = abs(latsdim)
             dat[i].gtr = gtr
-
-            srs = osr.SpatialReference()
-            srs.ImportFromWkt(dataset.GetProjection())
-            srs.AutoIdentifyEPSG()
-
-            dat[i].wkt = srs.ExportToWkt()
+            dat[i].wkt = sub['wkt']
 
     return dat
 
 
-def get_aster(ifile):
+def get_aster(ifile, nthreads=None):
     """
     Gets ASTER Data
 
@@ -505,6 +686,9 @@ def get_aster(ifile):
     ----------
     ifile : str
         filename to import
+    nthreads : int
+        number of threads used to read subdatasets. None uses the number of
+        processors.
 
     Returns
     -------
@@ -545,44 +729,21 @@ def get_aster(ifile):
 
     subdata = [i for i in subdata if 'ImageData' in i[0]]
 
-    i = -1
-    for ifile2, bandid2 in subdata:
-        dataset = gdal.Open(ifile2, gdal.GA_ReadOnly)
-
-        rtmp2 = dataset.ReadAsArray()
+    subs = read_subdatasets([j[0] for j in subdata], True, nthreads)
 
-        tmpds = gdal.AutoCreateWarpedVRT(dataset)
-        rtmp2 = tmpds.ReadAsArray()
-        gtr = tmpds.GetGeoTransform()
+    i = -1
+    for sub, (_, bandid2) in zip(subs, subdata):
+        rtmp2 = sub['data']
+        gtr = sub['gtr']
         tlx, lonsdim, _, tly, _, latsdim = gtr
 
-        nval = 0
-
         i += 1
 
         dat.append(Data())
-        dat[i].data = rtmp2
-
-        if dat[i].data.dtype.kind == 'i':
-            if nval is None:
-                nval = 999999
-            nval = int(nval)
-        elif dat[i].data.dtype.kind == 'u':
-            if nval is None:
-                nval = 0
-            nval = int(nval)
-        else:
-            if nval is None:
-                nval = 1e+20
-            nval = float(nval)
-
-        dat[i].data = np.ma.masked_invalid(dat[i].data)
-        dat[i].data.mask = dat[i].data.mask | (dat[i].data == nval)
-        if dat[i].data.mask.size == 1:
-            dat[i].data.mask = (np.ma.make_mask_none(dat[i].data.shape) +
-                                dat[i].data.mask)
+        nval = nodata_value(rtmp2.dtype, 0)
+        dat[i].data = mask_nodata(rtmp2, nval)
 
-        dat[i].nrofbands = dataset.RasterCount
+        dat[i].nrofbands = sub['nrofbands']
         dat[i].tlx = tlx
         dat[i].tly = tly
         dat[i].dataid = bandid2
@@ -592,19 +753,14 @@ def get_aster(ifile):
         dat[i].xdim = abs(lonsdim)
         dat[i].ydim = abs(latsdim)
         dat[i].gtr = gtr
-
-        srs = osr.SpatialReference()
-        srs.ImportFromWkt(dataset.GetProjection())
-        srs.AutoIdentifyEPSG()
-
-        dat[i].wkt = srs.ExportToWkt()
+        dat[i].wkt = sub['wkt']
 
     if dat == []:
         dat = None
     return dat
 
 
-def get_aster_ged(ifile):
+def get_aster_ged(ifile, nthreads=None):
     """
     Gets ASTER GED data
 
@@ -612,6 +768,9 @@ def get_aster_ged(ifile):
     ----------
     ifile : str
         filename to import
+    nthreads : int
+        number of threads used to read subdatasets. None uses the number of
+        processors.
 
     Returns
     -------
@@ -642,9 +801,10 @@ def get_aster_ged(ifile):
     tlx = lons.min()-abs(lonsdim/2)
     tly = lats.max()+abs(latsdim/2)
 
+    subs = read_subdatasets([j[0] for j in subdata], nthreads=nthreads)
+
     i = -1
-    for ifile2, bandid2 in subdata:
-        dataset = gdal.Open(ifile2, gdal.GA_ReadOnly)
+    for sub, (_, bandid2) in zip(subs, subdata):
         bandid = bandid2
         units = ''
 
@@ -657,8 +817,8 @@ def get_aster_ged(ifile):
             bandid = 'Observations'
             units = 'number per pixel'
 
-        gtr = dataset.GetGeoTransform()
-        rtmp2 = dataset.ReadAsArray()
+        gtr = sub['gtr']
+        rtmp2 = sub['data']
 
         if rtmp2.shape[-1] == min(rtmp2.shape) and rtmp2.ndim == 3:
             rtmp2 = np.transpose(rtmp2, (2, 0, 1))
@@ -672,40 +832,35 @@ def get_aster_ged(ifile):
             i += 1
 
             dat.append(Data())
-            if rtmp2.ndim == 3:
-                dat[i].data = rtmp2[i2]
-            else:
-                dat[i].data = rtmp2
 
-            dat[i].data = np.ma.masked_invalid(dat[i].data)
-            dat[i].data.mask = np.ma.getmaskarray(dat[i].data) | (dat[i].data == nval)
-            if dat[i].data.mask.size == 1:
-                dat[i].data.mask = (np.ma.make_mask_none(dat[i].data.shape) +
-                                    np.ma.getmaskarray(dat[i].data))
-
-            dat[i].data = dat[i].data * 1.0
+            scale = 1.
             if 'Emissivity/Mean' in bandid2:
                 bandid = 'Emissivity_mean_band_'+str(10+i2)
-                dat[i].data = dat[i].data * 0.001
+                scale = 0.001
             if 'Emissivity/SDev' in bandid2:
                 bandid = 'Emissivity_std_dev_band_'+str(10+i2)
-                dat[i].data = dat[i].data * 0.0001
+                scale = 0.0001
             if 'NDVI/Mean' in bandid2:
                 bandid = 'NDVI_mean'
-                dat[i].data = dat[i].data * 0.01
+                scale = 0.01
             if 'NDVI/SDev' in bandid2:
                 bandid = 'NDVI_std_dev'
-                dat[i].data = dat[i].data * 0.01
+                scale = 0.01
             if 'Temperature/Mean' in bandid2:
                 bandid = 'Temperature_mean'
                 units = 'Kelvin'
-                dat[i].data = dat[i].data * 0.01
+                scale = 0.01
             if 'Temperature/SDev' in bandid2:
                 bandid = 'Temperature_std_dev'
                 units = 'Kelvin'
-                dat[i].data = dat[i].data * 0.01
+                scale = 0.01
 
-            dat[i].nrofbands = dataset.RasterCount
+            if rtmp2.ndim == 3:
+                dat[i].data = mask_nodata(rtmp2[i2], nval, scale)
+            else:
+                dat[i].data = mask_nodata(rtmp2, nval, scale)
+
+            dat[i].nrofbands = sub['nrofbands']
             dat[i].tlx = tlx
             dat[i].tly = tly
             dat[i].dataid = bandid
@@ -716,12 +871,7 @@ def get_aster_ged(ifile):
             dat[i].ydim = abs(latsdim)
             dat[i].gtr = gtr
             dat[i].units = units
-
-            srs = osr.SpatialReference()
-            srs.ImportFromWkt(dataset.GetProjection())
-            srs.AutoIdentifyEPSG()
-
-            dat[i].wkt = srs.ExportToWkt()
+            dat[i].wkt = sub['wkt']
 
     return dat
 
@@ -808,7 +958,7 @@ def get_aster_ged_bin(ifile):
     for i in range(19):
         dat.append(Data())
 
-        dat[i].data = data[i]*scale[i]
+        dat[i].data = mask_nodata(data[i], nval, scale[i])
 
         dat[i].nrofbands = 1
         dat[i].tlx = tlx
@@ -1024,45 +1174,7 @@ class ExportData(object):
         """
         for k in data:
             file_out = self.get_filename(k, 'gxf')
-            fno = open(file_out, 'w')
-
-            xmin = k.tlx
-            ymin = k.tly - k.rows*k.ydim
-
-            fno.write("#TITLE\n")
-            fno.write(self.name)
-            fno.write("\n#POINTS\n")
-            fno.write(str(k.cols))
-            fno.write("\n#ROWS\n")
-            fno.write(str(k.rows))
-            fno.write("\n#PTSEPARATION\n")
-            fno.write(str(k.xdim))
-            fno.write("\n#RWSEPARATION\n")
-            fno.write(str(k.ydim))
-            fno.write("\n#XORIGIN\n")
-            fno.write(str(xmin))
-            fno.write("\n#YORIGIN\n")
-            fno.write(str(ymin))
-            fno.write("\n#SENSE\n")
-            fno.write("1")
-            fno.write("\n#DUMMY\n")
-            fno.write(str(k.nullvalue))
-            fno.write("\n#GRID\n")
-            tmp = k.data.filled(k.nullvalue)
-
-            for i in range(k.data.shape[0]-1, -1, -1):
-                kkk = 0
-# write only 5 numbers in a row
-                for j in range(k.data.shape[1]):
-                    if kkk == 5:
-                        kkk = 0
-                    if kkk == 0:
-                        fno.write("\n")
-
-                    fno.write(str(tmp[i, j]) + "  ")
-                    kkk += 1
-
-            fno.close()
+            gxf.export_gxf(file_out, k, self.name)
 
     def export_surfer(self, data):
         """
@@ -1109,26 +1221,7 @@ class ExportData(object):
         """
         for k in data:
             file_out = self.get_filename(k, 'asc')
-            fno = open(file_out, 'w')
-
-            xmin = k.tlx
-            ymin = k.tly - k.rows*k.ydim
-
-            fno.write("ncols \t\t\t" + str(k.cols))
-            fno.write("\nnrows \t\t\t" + str(k.rows))
-            fno.write("\nxllcorner \t\t\t" + str(xmin))
-            fno.write("\nyllcorner \t\t\t" + str(ymin))
-            fno.write("\ncellsize \t\t\t" + str(k.xdim))
-            fno.write("\nnodata_value \t\t" + str(k.nullvalue))
-
-            tmp = k.data.filled(k.nullvalue)
-
-            for j in range(k.rows):
-                fno.write("\n")
-                for i in range(k.cols):
-                    fno.write(str(tmp[j, i]) + " ")
-
-            fno.close()
+            asciigrid.export_esri_ascii(file_out, k)
 
     def export_ascii_xyz(self, data):
         """
@@ -1141,19 +1234,7 @@ class ExportData(object):
         """
         for k in data:
             file_out = self.get_filename(k, 'xyz')
-            fno = open(file_out, 'w')
-
-            tmp = k.data.filled(k.nullvalue)
-
-            xmin = k.tlx
-            ymax = k.tly
-
-            for j in range(k.rows):
-                for i in range(k.cols):
-                    fno.write(str(xmin+i*k.xdim) + " " +
-                              str(ymax-j*k.ydim) + " " +
-                              str(tmp[j, i]) + "\n")
-            fno.close()
+            asciigrid.export_xyz(file_out, k)
 
     def get_filename(self, data, ext):
         """
@@ -1189,31 +1270,14 @@ def get_geopak(hfile):
         dataset imported
     """
 
-    fin = open(hfile, 'rb')
-    fall = fin.read()
-    fin.close()
+# The file is memory mapped, and the records are copied out in one pass.
+    fall = np.memmap(hfile, dtype=np.uint8, mode='r')
+    fnew = np.empty(fall.size, dtype=np.uint8)
+    nbytes = _geopak_unpack(fall, fnew)
+    fnew = fnew[:nbytes]
+    del fall
 
-    off = 0
-    fnew = []
-    while off < len(fall):
-        off += 1
-        breclen = np.frombuffer(fall, dtype=np.uint8, count=1, offset=off)[0]
-
-        if breclen == 130:
-            break
-
-        reclen = breclen
-
-        if breclen == 129:
-            reclen = 128
-
-        off += 1
-
-        fnew.append(fall[off:off+reclen])
-        off += reclen
-
-    fnew = b''.join(fnew)
-    header = np.frombuffer(fnew, dtype=np.float32, count=32, offset=0)
+    header = fnew[:128].view(np.float32)
 
 #     Lines in grid      1
 #     Points per line    2
@@ -1258,7 +1322,7 @@ def get_geopak(hfile):
 #    zmax = header[22]
 #    zmin = header[23]
 
-    data = np.frombuffer(fnew, dtype=np.int16, count=(nrows*ncols), offset=128)
+    data = fnew[128:128+2*nrows*ncols].view(np.int16)
 
     data = np.ma.masked_equal(data, nval)
     data = data/gfactor+gbase
@@ -1284,6 +1348,112 @@ def get_geopak(hfile):
     return dat
 
 
+@jit(nopython=True)
+def _geopak_unpack(fall, fnew):
+    """
+    Copies the data out of the records of a GeoPak file. Each record is a
+    length byte, up to 128 bytes of data and the length byte again. A
+    length of 129 is a full record of 128 bytes, and 130 ends the file.
+
+    Parameters
+    ----------
+    fall : numpy array
+        uint8 array of the file contents
+    fnew : numpy array
+        uint8 output array, at least as long as fall
+
+    Returns
+    -------
+    nbytes : int
+        number of bytes of data
+    """
+    off = 0
+    nbytes = 0
+    nfall = fall.size
+    while off < nfall-1:
+        off += 1
+        reclen = fall[off]
+        if reclen == 130:
+            break
+        if reclen == 129:
+            reclen = 128
+        off += 1
+
+        reclen = min(reclen, nfall-off)
+        fnew[nbytes:nbytes+reclen] = fall[off:off+reclen]
+        nbytes += reclen
+        off += reclen
+    return nbytes
+
+
+def export_geopak(ofile, dat, chunkbytes=None):
+    """
+    Exports a GeoPak grid. Values are stored as 16 bit integers, scaled
+    between the minimum and maximum, and rows are written a block at a time.
+
+    Parameters
+    ----------
+    ofile : str
+        output filename
+    dat : PyGMI raster Data
+        dataset to export
+    chunkbytes : int
+        approximate size of the blocks written at a time
+    """
+    if chunkbytes is None:
+        chunkbytes = asciigrid.CHUNKBYTES
+    source = tiles.band_source(dat)
+    rows, cols = source.shape
+
+    stats = tiles.tile_stats(source)
+    nval = -32767
+    gbase = 0.
+    gfactor = 1.
+    if stats['count'] > 0:
+        gbase = (stats['max']+stats['min'])/2
+        if stats['max'] > stats['min']:
+            gfactor = 64000./(stats['max']-stats['min'])
+
+    header = np.zeros(32, dtype=np.float32)
+    header[[0, 16]] = rows
+    header[[1, 17]] = cols
+    header[[2, 20]] = gfactor
+    header[[3, 21]] = gbase
+    header[4] = dat.tlx
+    header[5] = dat.tly - rows*dat.ydim
+    header[[7, 25]] = nval
+    header[9] = dat.xdim
+    header[10] = dat.ydim
+    header[22] = stats['max']
+    header[23] = stats['min']
+
+    with open(ofile, 'wb') as fno:
+        fno.write(b'K')
+        rest = header.tobytes()
+
+# Rows are written from the bottom, in records of 128 bytes
+        nrows = max(1, chunkbytes//(cols*2))
+        for row1 in range(rows, 0, -nrows):
+            row0 = max(0, row1-nrows)
+            block = source.read(row0, row1)[::-1]
+            vals = np.rint((np.ma.getdata(block)-gbase)*gfactor)
+            vals[np.ma.getmaskarray(block) | ~np.isfinite(vals)] = nval
+            rest += vals.astype(np.int16).tobytes()
+
+            nrec = len(rest)//128
+            recs = np.empty((nrec, 130), dtype=np.uint8)
+            recs[:, 0] = 129
+            recs[:, -1] = 129
+            recs[:, 1:-1] = np.frombuffer(rest[:nrec*128], dtype=np.uint8
+                                          ).reshape(nrec, 128)
+            fno.write(recs.tobytes())
+            rest = rest[nrec*128:]
+
+        if rest:
+            fno.write(bytes([len(rest)]) + rest + bytes([len(rest)]))
+        fno.write(bytes([130]))
+
+
 def get_geosoft(hfile):
     """
     Get geosoft file
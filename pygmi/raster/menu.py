@@ -121,6 +121,11 @@ class MenuWidget(object):
         self.menu.addAction(self.action_merge)
         self.action_merge.triggered.connect(self.merge)
 
+        self.action_mosaic = QtWidgets.QAction(self.parent)
+        self.action_mosaic.setText("Mosaic")
+        self.menu.addAction(self.action_mosaic)
+        self.action_mosaic.triggered.connect(self.mosaic)
+
         self.action_reproj = QtWidgets.QAction(self.parent)
         self.action_reproj.setText("Reprojection")
         self.menu.addAction(self.action_reproj)
@@ -311,6 +316,11 @@ class MenuWidget(object):
         fnc = dataprep.DataMerge(self.parent)
         self.parent.item_insert("Step", "Data\nMerge", fnc)
 
+    def mosaic(self):
+        """ Mosaic datasets """
+        fnc = dataprep.DataMosaic(self.parent)
+        self.parent.item_insert("Step", "Data\nMosaic", fnc)
+
     def grid(self):
         """ Grid datasets """
         fnc = dataprep.DataGrid(self.parent)
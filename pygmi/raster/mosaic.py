@@ -0,0 +1,295 @@
+# -----------------------------------------------------------------------------
+# Name:        mosaic.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2018 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+""" Virtual mosaics of raster tiles.
+
+A Mosaic is an index of tiles (for example adjacent survey blocks) on a
+common output grid, much like a GDAL VRT. No pixels are merged when it is
+made. It is a band source (see pygmi.raster.tiles), so rows of the mosaic are
+only made when they are read, by run_tiles or when the Data is used. Only
+the rows of each tile that are needed are read, and tiles which have not been
+loaded are read from their files.
+
+Rows are made in blocks, and recently used blocks are kept in a cache which
+drops the least recently used block when it is full.
+
+Where tiles overlap, the value is chosen with one of these rules:
+
+ * 'first' : the first tile in the list with a value
+ * 'last' : the last tile in the list with a value
+ * 'mean' : the mean of all tiles with a value
+ * 'feather' : a weighted mean, where the weight of a tile falls off
+   towards its edges, so that there are no steps at tile boundaries
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+from pygmi.misc import INSTR
+from pygmi.raster.datatypes import Data
+import pygmi.raster.tiles as tiles
+
+RULES = ['first', 'last', 'mean', 'feather']
+
+# Approximate size of a block, and of all the cached blocks
+BLOCKBYTES = 2**22
+CACHEBYTES = 2**28
+
+
+class Mosaic(object):
+    """
+    Virtual mosaic of raster tiles.
+
+    Tiles are sampled at the output cell centres (nearest neighbour). All
+    tiles are assumed to have the same projection.
+
+    Attributes
+    ----------
+    tiles : list
+        list of PyGMI Data tiles
+    rule : str
+        overlap rule, one of RULES
+    tlx : float
+        top left x coordinate of the mosaic
+    tly : float
+        top left y coordinate of the mosaic
+    dxy : float
+        cell size of the mosaic
+    shape : tuple
+        rows and columns of the mosaic
+    blockrows : int
+        number of rows in a cached block
+    maxblocks : int
+        maximum number of cached blocks
+    """
+    def __init__(self, tiles_in, dxy=None, rule='first', blockrows=None,
+                 cachebytes=None):
+        if rule not in RULES:
+            raise ValueError('Unknown overlap rule: '+str(rule))
+        if not tiles_in:
+            raise ValueError('A mosaic needs at least one tile')
+
+        self.tiles = list(tiles_in)
+        self.rule = rule
+
+        if dxy is None:
+            dxy = min(min(i.xdim, i.ydim) for i in self.tiles)
+        xmin = min(i.tlx for i in self.tiles)
+        xmax = max(i.tlx+i.xdim*i.cols for i in self.tiles)
+        ymin = min(i.tly-i.ydim*i.rows for i in self.tiles)
+        ymax = max(i.tly for i in self.tiles)
+
+        rows = max(1, int(np.ceil((ymax-ymin)/dxy-1e-6)))
+        cols = max(1, int(np.ceil((xmax-xmin)/dxy-1e-6)))
+
+        self.tlx = xmin
+        self.tly = ymax
+        self.dxy = dxy
+        self.shape = (rows, cols)
+
+# Index of the mosaic rows and columns each tile covers
+        self.index = np.zeros((len(self.tiles), 4), dtype=int)
+        for i, tile in enumerate(self.tiles):
+            self.index[i] = [(self.tly-tile.tly)/dxy,
+                             np.ceil((self.tly-tile.tly+tile.ydim*tile.rows) /
+                                     dxy),
+                             (tile.tlx-self.tlx)/dxy,
+                             np.ceil((tile.tlx+tile.xdim*tile.cols-self.tlx) /
+                                     dxy)]
+
+        if blockrows is None:
+            blockrows = max(1, BLOCKBYTES//(cols*8))
+        if cachebytes is None:
+            cachebytes = CACHEBYTES
+        self.blockrows = blockrows
+        self.maxblocks = max(1, cachebytes//(blockrows*cols*9))
+
+        self.lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def read(self, row0, row1):
+        """
+        Reads rows from the mosaic.
+
+        Parameters
+        ----------
+        row0 : int
+            first row
+        row1 : int
+            last row (exclusive)
+
+        Returns
+        -------
+        numpy masked array
+            block of data
+        """
+        brows = self.blockrows
+        out = []
+        for iblock in range(row0//brows, (row1-1)//brows+1):
+            block = self.block(iblock)
+            start = max(row0-iblock*brows, 0)
+            end = min(row1-iblock*brows, block.shape[0])
+            out.append(block[start:end])
+
+        return np.ma.concatenate(out)
+
+    def block(self, iblock):
+        """
+        Returns a block of rows, from the cache if possible.
+
+        Parameters
+        ----------
+        iblock : int
+            block number
+
+        Returns
+        -------
+        numpy masked array
+            block of data. It is shared with the cache, so it should not be
+            changed.
+        """
+        with self.lock:
+            if iblock in self._cache:
+                INSTR.count('mosaic cache hits')
+                self._cache.move_to_end(iblock)
+                return self._cache[iblock]
+
+        with INSTR.span('mosaic block', block=iblock):
+            block = self._make_block(iblock)
+
+        with self.lock:
+            self._cache[iblock] = block
+            while len(self._cache) > self.maxblocks:
+                self._cache.popitem(last=False)
+
+        return block
+
+    def _make_block(self, iblock):
+        """ Merges the tiles for one block of rows """
+        row0 = iblock*self.blockrows
+        row1 = min(self.shape[0], row0+self.blockrows)
+        cols = self.shape[1]
+
+        vsum = np.zeros((row1-row0, cols))
+        wsum = np.zeros((row1-row0, cols))
+
+        ycen = self.tly-(np.arange(row0, row1)+0.5)*self.dxy
+        xcen = self.tlx+(np.arange(cols)+0.5)*self.dxy
+
+        order = range(len(self.tiles))
+        if self.rule == 'last':
+            order = reversed(order)
+
+        for itile in order:
+            trow0, trow1, tcol0, tcol1 = self.index[itile]
+            if trow1 <= row0 or trow0 >= row1:
+                continue
+            tile = self.tiles[itile]
+
+            tr = np.floor((tile.tly-ycen)/tile.ydim).astype(int)
+            tc = np.floor((xcen-tile.tlx)/tile.xdim).astype(int)
+            rfilt = (tr >= 0) & (tr < tile.rows)
+            cfilt = (tc >= 0) & (tc < tile.cols)
+            if not rfilt.any() or not cfilt.any():
+                continue
+            tr = tr[rfilt]
+            tc = tc[cfilt]
+
+            source = tiles.band_source(tile)
+            tdat = source.read(tr.min(), tr.max()+1)
+            tdat = tdat[tr-tr.min()][:, tc]
+            valid = ~np.ma.getmaskarray(tdat)
+            tdat = np.ma.getdata(tdat).astype(np.float64)
+
+            if self.rule == 'feather':
+                wrow = np.minimum(tr+0.5, tile.rows-tr-0.5)
+                wcol = np.minimum(tc+0.5, tile.cols-tc-0.5)
+                wgt = np.minimum.outer(wrow, wcol)*valid
+            else:
+                wgt = valid.astype(np.float64)
+
+            ix = np.ix_(np.nonzero(rfilt)[0], np.nonzero(cfilt)[0])
+            if self.rule in ('first', 'last'):
+                wgt = wgt*(wsum[ix] == 0.)
+
+            vsum[ix] += np.where(wgt > 0., tdat*wgt, 0.)
+            wsum[ix] += wgt
+            INSTR.count('tile cells read', tdat.size)
+
+        mask = wsum == 0.
+        wsum[mask] = 1.
+        return np.ma.array(vsum/wsum, mask=mask)
+
+    def clear_cache(self):
+        """ Empties the block cache """
+        with self.lock:
+            self._cache.clear()
+
+
+def mosaic(bands, dxy=None, rule='first', dataid='Mosaic'):
+    """
+    Makes a virtual mosaic of raster tiles.
+
+    Parameters
+    ----------
+    bands : list
+        list of PyGMI Data tiles
+    dxy : float
+        cell size of the mosaic. Defaults to the smallest tile cell size.
+    rule : str
+        overlap rule, one of 'first', 'last', 'mean' or 'feather'
+    dataid : str
+        band name of the mosaic
+
+    Returns
+    -------
+    dat : Data
+        PyGMI raster dataset. Its data is made from the tiles when used.
+    """
+    source = Mosaic(bands, dxy, rule)
+
+    dat = Data()
+    dat.source = source
+    dat.dataid = dataid
+    dat.tlx = source.tlx
+    dat.tly = source.tly
+    dat.xdim = source.dxy
+    dat.ydim = source.dxy
+    dat.rows, dat.cols = source.shape
+    dat.nullvalue = bands[0].nullvalue
+    dat.wkt = bands[0].wkt
+    dat.units = bands[0].units
+    dat.gtr = (dat.tlx, dat.xdim, 0.0, dat.tly, 0.0, -dat.ydim)
+
+    return dat
@@ -29,6 +29,7 @@ import warnings
 from PyQt5 import QtWidgets, QtCore
 import numpy as np
 import pygmi.menu_default as menu_default
+import pygmi.raster.tiles as tiles
 
 
 warnings.simplefilter('always', RuntimeWarning)
@@ -99,24 +100,32 @@ class Normalisation(QtWidgets.QDialog):
         if temp == 0:
             return
 
-        data = copy.deepcopy(self.indata['Raster'])
+        data = []
+        for i in self.indata['Raster']:
+            data.append(copy.copy(i))
+            data[-1].norm = copy.deepcopy(i.norm)
+
+# Statistics and results are calculated one strip of rows at a time (see
+# pygmi.raster.tiles). The histogram equalisation still works in memory.
         transform = np.zeros((2, 2))
         if self.radiobutton_interval.isChecked():
             for i in data:
-                tmp1 = i.data.min()
-                tmp2 = i.data.max() - i.data.min()
+                stats = tiles.tile_stats(i)
+                tmp1 = stats['min']
+                tmp2 = stats['max'] - stats['min']
                 tmp3 = 'minmax'
                 i, transform = datacommon(i, tmp1, tmp2, tmp3)
         elif self.radiobutton_mean.isChecked():
             for i in data:
-                tmp1 = i.data.mean()
-                tmp2 = i.data.std()
+                stats = tiles.tile_stats(i)
+                tmp1 = stats['mean']
+                tmp2 = stats['std']
                 tmp3 = 'meanstd'
                 i, transform = datacommon(i, tmp1, tmp2, tmp3)
         elif self.radiobutton_median.isChecked():
             for i in data:
-                tmp1 = np.median(i.data.compressed())
-                tmp2 = np.median(abs(i.data.compressed() - tmp1))
+                tmp1 = tiles.tile_quantile(i, 50.)
+                tmp2 = tiles.tile_quantile(i, 50., lambda x: abs(x-tmp1))
                 tmp3 = 'medmad'
                 i, transform = datacommon(i, tmp1, tmp2, tmp3)
         elif self.radiobutton_8bit.isChecked():
@@ -148,7 +157,7 @@ class Normalisation(QtWidgets.QDialog):
 
         # Correct the null value
         for i in data:
-            i.data.data[i.data.mask] = i.nullvalue
+            i.data.data[np.ma.getmaskarray(i.data)] = i.nullvalue
 
         self.outdata['Raster'] = data
         self.pbar.to_max()
@@ -162,12 +171,14 @@ def datacommon(data, tmp1, tmp2, tmp3):
         transform[0:2, 0] = [0, 1]
         transform[0:2, 1] = [tmp1, tmp2]
 
-        dtmp = data.data.data
-        mtmp = data.data.mask
-        dtmp -= tmp1
-        dtmp /= tmp2
+        def func(blk):
+            """ Normalise a strip """
+            return (blk-tmp1)/tmp2
 
-        data.data = np.ma.array(dtmp, mask=mtmp)
+        dtype = data.data.dtype
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.float64
+        data.data = tiles.run_tiles(func, [data], dtype=dtype, nthreads=None)
         n_norms = len(data.norm)
         data.norm[n_norms] = {'type': tmp3, 'transform': transform}
     return data, transform
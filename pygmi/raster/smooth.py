@@ -28,7 +28,11 @@ import copy
 from PyQt5 import QtWidgets
 import numpy as np
 import scipy.signal as ssig
+import scipy.ndimage as sndi
+from numba import jit, prange
 import pygmi.menu_default as menu_default
+from pygmi.misc import INSTR
+import pygmi.raster.tiles as tiles
 
 
 class Smooth(QtWidgets.QDialog):
@@ -151,7 +155,7 @@ class Smooth(QtWidgets.QDialog):
 
         self.parent.process_is_active(True)
         self.parent.showprocesslog('Smoothing ')
-        data = copy.deepcopy(self.indata['Raster'])
+        data = [copy.copy(i) for i in self.indata['Raster']]
         if self.radiobutton_2dmean.isChecked():
             for i, _ in enumerate(data):
                 data[i].data = self.mov_win_filt(data[i].data, self.fmat,
@@ -263,46 +267,34 @@ class Smooth(QtWidgets.QDialog):
                                       QtWidgets.QMessageBox.Ok,
                                       QtWidgets.QMessageBox.Ok)
 
+    @INSTR.span('mov_win_filt')
     def mov_win_filt(self, dat, fmat, itype, title):
-        """ move win filt function """
-        out = dat.tolist()
+        """ move win filt function
 
+        The filter is run over strips of rows (see pygmi.raster.tiles), so
+        dat may be a masked array or any band source. """
         rowf = fmat.shape[0]
         colf = fmat.shape[1]
-        rowd = dat.shape[0]
-        cold = dat.shape[1]
-        drr = round(rowf/2.0)
-        dcc = round(colf/2.0)
-
-        dummy = np.zeros((rowd+rowf-1, cold+colf-1))*np.nan
-        dummy[drr-1:drr-1+rowd, dcc-1:dcc-1+cold] = dat
-        dummy = np.ma.masked_invalid(dummy)
-        dummy.mask[drr-1:drr-1+rowd, dcc-1:dcc-1+cold] = dat.mask
-
-        dummy.data[dummy.mask] = np.nan
-        dat.data[dat.mask] = np.nan
+        rowd, cold = dat.shape
+        INSTR.count('pixels', rowd*cold)
 
+# The median filter is already parallel, so it uses a single thread here.
         if itype == '2D Mean':
-            out = ssig.correlate(dat, fmat, 'same', method='direct')
-            self.pbar.to_max()
+            def func(blk):
+                """ Filter a strip """
+                return np.ma.masked_invalid(mean_filter(blk, fmat))
+            nthreads = None
 
         elif itype == '2D Median':
             self.parent.showprocesslog('Calculating Median...')
-            out = np.ma.zeros([rowd, cold])*np.nan
-            out.mask = np.ma.getmaskarray(dat)
-            fmat = fmat.astype(bool)
-            dummy = dummy.data
-
-            for i in self.pbar.iter(range(rowd)):
-                self.parent.showprocesslog(title+' Progress: ' +
-                                           str(round(100*i/rowd))+'%', True)
-                for j in range(cold):
-                    tmp1 = dummy[i:i+rowf, j:j+colf][fmat]
-                    if np.isnan(tmp1).min() == False:
-                        out[i, j] = np.nanmedian(tmp1)
-
-        out = np.ma.masked_invalid(out)
-        out.shape = out.shape[0:2]
+
+            def func(blk):
+                """ Filter a strip """
+                return np.ma.masked_invalid(rank_filter(blk, fmat, 'median'))
+            nthreads = 1
+
+        out = tiles.run_tiles(func, [dat], rowf//2, nthreads=nthreads,
+                              piter=self.pbar.iter)
         out.mask[:rowf//2] = True
         out.mask[-rowf//2:] = True
         out.mask[:, :colf//2] = True
@@ -310,6 +302,229 @@ class Smooth(QtWidgets.QDialog):
         return out
 
 
+def filter_method(fmat):
+    """
+    Chooses the fastest way to apply a filter.
+
+    Parameters
+    ----------
+    fmat : numpy array
+        filter
+
+    Returns
+    -------
+    method : str
+        'separable' if the filter is the outer product of two vectors (box
+        and gaussian filters), 'fft' for other large filters, otherwize
+        'direct'.
+    """
+    sval = np.linalg.svd(fmat, compute_uv=False)
+    if sval.size == 1 or sval[1:].max() <= 1e-10*sval[0]:
+        return 'separable'
+    if fmat.size > 121:
+        return 'fft'
+    return 'direct'
+
+
+def mean_filter(dat, fmat, method='auto'):
+    """
+    Masked moving window weighted mean, using normalised convolution.
+
+    Masked and NaN cells get zero weight, and the result is divided by the
+    sum of the filter weights of the valid cells in each window, so nodata
+    does not spread to its neighbours. Cells which are masked in the input
+    stay masked.
+
+    Parameters
+    ----------
+    dat : numpy masked array
+        input data
+    fmat : numpy array
+        filter weights, e.g. from filters2d
+    method : str
+        'auto', 'separable', 'fft' or 'direct'. 'auto' uses filter_method.
+
+    Returns
+    -------
+    out : numpy masked array
+        filtered data
+    """
+    fmat = np.asarray(fmat, dtype=np.float64)
+# filled returns the input itself when it is unmasked float64, so a copy is
+# made before nodata cells are zeroed.
+    data = np.ma.filled(np.ma.array(dat, dtype=np.float64, copy=True), np.nan)
+    mask = ~np.isfinite(data)
+    data[mask] = 0.
+    wgt = (~mask).astype(np.float64)
+
+    if method == 'auto':
+        method = filter_method(fmat)
+    elif method == 'separable' and filter_method(fmat) != 'separable':
+        raise ValueError('Filter is not separable')
+
+    if method == 'separable':
+        uuu, sval, vvv = np.linalg.svd(fmat)
+        fcol = uuu[:, 0]*sval[0]
+        frow = vvv[0]
+
+        def corr(arr):
+            """ Separable correlation """
+            arr = sndi.correlate1d(arr, fcol, 0, mode='constant')
+            return sndi.correlate1d(arr, frow, 1, mode='constant')
+    elif method in ('fft', 'direct'):
+        def corr(arr):
+            """ Correlation """
+            return ssig.correlate(arr, fmat, 'same', method=method)
+    else:
+        raise ValueError('Unknown filter method: '+str(method))
+
+    num = corr(data)
+    den = corr(wgt)
+
+# FFT round off leaves small values where there is no valid data.
+    tol = 1e-8*np.abs(fmat).sum()
+    bad = mask | (np.abs(den) <= tol)
+    den[bad] = 1.
+    out = num/den
+
+    return np.ma.array(out, mask=bad)
+
+
+def rank_filter(dat, fmat, rank='median', perc=50.):
+    """
+    Masked moving window rank filter.
+
+    Masked and NaN values are ignored. Output pixels with no valid values
+    in their window are masked. The window is centred on the output pixel.
+
+    Parameters
+    ----------
+    dat : numpy masked array
+        input data
+    fmat : numpy array
+        filter footprint. Nonzero values are part of the window, so the
+        'average' and 'disc' filters from filters2d can be used directly.
+    rank : str
+        'median', 'percentile', 'min', 'max' or 'mode'
+    perc : float
+        percentile (0 to 100), used when rank is 'percentile'
+
+    Returns
+    -------
+    out : numpy masked array
+        filtered data
+    """
+    ranks = {'median': 50., 'percentile': perc, 'min': 0., 'max': 100.,
+             'mode': 0.}
+    if rank not in ranks:
+        raise ValueError('Unknown rank filter: '+str(rank))
+    if not 0. <= ranks[rank] <= 100.:
+        raise ValueError('Percentile must be between 0 and 100')
+
+    data = np.ma.array(dat, dtype=np.float64).filled(np.nan)
+    fmat = np.asarray(fmat) != 0
+
+    rowf, colf = fmat.shape
+    di, dj = np.nonzero(fmat)
+    di = (di - (rowf-1)//2).astype(np.int64)
+    dj = (dj - (colf-1)//2).astype(np.int64)
+
+    out = _rank_filt(data, di, dj, ranks[rank], rank == 'mode')
+
+    return np.ma.masked_invalid(out)
+
+
+@jit(nopython=True, parallel=True)
+def _rank_filt(data, di, dj, perc, ismode, strip=16):
+    """ Rank filter, calculated in parallel over strips of rows """
+    rows, cols = data.shape
+    out = np.empty((rows, cols))
+    nstrips = (rows+strip-1)//strip
+
+    for istrip in prange(nstrips):
+        buf = np.empty(di.size)
+        for i in range(istrip*strip, min(rows, (istrip+1)*strip)):
+            for j in range(cols):
+                n = 0
+                for k in range(di.size):
+                    i2 = i+di[k]
+                    j2 = j+dj[k]
+                    if i2 < 0 or j2 < 0 or i2 >= rows or j2 >= cols:
+                        continue
+                    val = data[i2, j2]
+                    if np.isnan(val):
+                        continue
+                    buf[n] = val
+                    n += 1
+
+                if n == 0:
+                    out[i, j] = np.nan
+                    continue
+
+                if ismode:
+                    tmp = buf[:n]
+                    tmp.sort()
+                    # Most frequent value. Ties go to the smallest value.
+                    best = tmp[0]
+                    bcnt = 0
+                    cnt = 0
+                    for k in range(n):
+                        if k > 0 and tmp[k] == tmp[k-1]:
+                            cnt += 1
+                        else:
+                            cnt = 1
+                        if cnt > bcnt:
+                            bcnt = cnt
+                            best = tmp[k]
+                    out[i, j] = best
+                else:
+                    # Linear interpolation, the same as np.percentile
+                    pos = perc/100.*(n-1)
+                    lo = int(np.floor(pos))
+                    vlo = _select(buf, n, lo)
+                    vhi = vlo
+                    if lo+1 < n:
+                        # After _select, buf[lo+1:n] holds the larger values
+                        vhi = buf[lo+1]
+                        for k in range(lo+2, n):
+                            if buf[k] < vhi:
+                                vhi = buf[k]
+                    out[i, j] = vlo+(vhi-vlo)*(pos-lo)
+
+    return out
+
+
+@jit(nopython=True)
+def _select(buf, n, kth):
+    """
+    Returns the kth smallest of the first n values of buf (Wirth's
+    algorithm). buf is partially reordered in place, so that buf[kth] is the
+    result and the values after it are not smaller.
+    """
+    left = 0
+    right = n-1
+    while left < right:
+        pivot = buf[kth]
+        i = left
+        j = right
+        while i <= j:
+            while buf[i] < pivot:
+                i += 1
+            while pivot < buf[j]:
+                j -= 1
+            if i <= j:
+                tmp = buf[i]
+                buf[i] = buf[j]
+                buf[j] = tmp
+                i += 1
+                j -= 1
+        if j < kth:
+            left = i
+        if kth < i:
+            right = j
+    return buf[kth]
+
+
 def filters2d(filtertype, sze, *sigma):
     """ Filters 2D
 
@@ -0,0 +1,346 @@
+# -----------------------------------------------------------------------------
+# Name:        spectral.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2018 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+""" Frequency domain filters.
+
+A grid is padded, tapered and transformed once into a Spectrum, which also
+holds the wavenumber grids. Filters (reduction to the pole, vertical and
+directional derivatives, upward continuation) are arrays in the frequency
+domain. They are multiplied together and each output needs only one inverse
+transform.
+
+Recently used spectra are cached, up to CACHEBYTES of transforms, so routines
+which transform the same grid more than once reuse the forward transform.
+"""
+
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from pygmi.misc import INSTR
+
+CACHEBYTES = 2**28
+_CACHE = OrderedDict()
+
+
+class Spectrum(object):
+    """
+    Padded and tapered forward FFT of a grid.
+
+    Attributes
+    ----------
+    fft : numpy array
+        forward FFT of the padded grid
+    kx : numpy array
+        wavenumbers in the x (east) direction, in radians per unit distance,
+        as a single row
+    ky : numpy array
+        wavenumbers in the y (north) direction, in radians per unit distance,
+        as a single column
+    k : numpy array
+        radial wavenumber, calculated from kx and ky when used
+    mean : float
+        mean of the grid, which is removed before the transform
+    shape : tuple
+        shape of the original grid
+    """
+    def __init__(self, data, xdim=1., ydim=None, npts=None):
+        if ydim is None:
+            ydim = xdim
+
+        data = np.ma.masked_invalid(np.ma.array(data, dtype=np.float64))
+        nr, nc = data.shape
+        prows, pcols = padsize(nr, nc, npts)
+
+        self.shape = (nr, nc)
+        self.rdiff = (prows-nr)//2
+        self.cdiff = (pcols-nc)//2
+        self.mean = float(data.mean())
+
+        gdat = data.filled(self.mean)
+        gpad = taper2d(gdat, prows, pcols)
+        self.fft = np.fft.fft2(gpad)
+
+# Rows run from north to south, so ky is negated to point north. kx and ky
+# broadcast against each other, so only the transform is a full size grid.
+        self.kx = 2*np.pi*np.fft.fftfreq(pcols, xdim)[np.newaxis]
+        self.ky = -2*np.pi*np.fft.fftfreq(prows, ydim)[:, np.newaxis]
+
+    @property
+    def k(self):
+        """ Radial wavenumber """
+        return np.hypot(self.kx, self.ky)
+
+    @property
+    def nbytes(self):
+        """ Memory used by the spectrum, in bytes """
+        return self.fft.nbytes+self.kx.nbytes+self.ky.nbytes
+
+    def calc(self, *filts):
+        """
+        Applies one or more filters and returns the filtered grid.
+
+        Parameters
+        ----------
+        *filts : numpy arrays
+            frequency domain filters. They are multiplied together.
+
+        Returns
+        -------
+        out : numpy array
+            filtered grid, with the same shape as the original grid
+        """
+        filt = 1.
+        for i in filts:
+            filt = filt*i
+        filt = np.broadcast_to(filt, self.fft.shape)
+
+        out = np.fft.ifft2(self.fft*filt).real
+        out = out[self.rdiff:self.rdiff+self.shape[0],
+                  self.cdiff:self.cdiff+self.shape[1]]
+
+# The mean is removed before the transform, so the filtered mean is added.
+        return out + self.mean*np.real(filt[0, 0])
+
+    def vertical(self, order=1):
+        """
+        Vertical derivative filter.
+
+        Parameters
+        ----------
+        order : float
+            order of the derivative
+
+        Returns
+        -------
+        numpy array
+            filter
+        """
+        return self.k**order
+
+    def upward(self, height):
+        """
+        Upward continuation filter.
+
+        Parameters
+        ----------
+        height : float
+            height to continue to, in the same units as the grid spacing.
+            Negative heights continue downward.
+
+        Returns
+        -------
+        numpy array
+            filter
+        """
+        return np.exp(-height*self.k)
+
+    def directional(self, azi, order=1):
+        """
+        Horizontal directional derivative filter.
+
+        Parameters
+        ----------
+        azi : float
+            direction in degrees from east, counter clockwise
+        order : int
+            order of the derivative
+
+        Returns
+        -------
+        numpy array
+            filter
+        """
+        azi = np.deg2rad(azi)
+        kdir = self.kx*np.cos(azi)+self.ky*np.sin(azi)
+        return (1j*kdir)**order
+
+    def rtp(self, inc, dec):
+        """
+        Reduction to the pole filter.
+
+        Parameters
+        ----------
+        inc : float
+            inclination of the magnetic field in degrees
+        dec : float
+            declination of the magnetic field in degrees
+
+        Returns
+        -------
+        numpy array
+            filter
+        """
+        inc = np.deg2rad(inc)
+        dec = np.deg2rad(dec)
+        alpha = np.arctan2(self.ky, self.kx)
+
+        filt = 1/(np.sin(inc)+1j*np.cos(inc)*np.cos(dec-alpha))**2
+        filt[0, 0] = 1.
+        return filt
+
+
+def spectrum(data, xdim=1., ydim=None, npts=None):
+    """
+    Returns the Spectrum of a grid. Recently used spectra are cached, up to
+    CACHEBYTES in total. Larger spectra are not cached.
+
+    Parameters
+    ----------
+    data : numpy masked array
+        input grid
+    xdim : float
+        grid spacing in the x direction
+    ydim : float
+        grid spacing in the y direction. Defaults to xdim.
+    npts : int
+        size of a square padded grid. By default each dimension is padded
+        to a fast FFT length (see padsize).
+
+    Returns
+    -------
+    Spectrum
+        spectrum of the grid
+    """
+    data = np.ma.array(data, dtype=np.float64)
+    sha = hashlib.sha1(np.ascontiguousarray(data.data).view(np.uint8))
+    sha.update(np.ascontiguousarray(np.ma.getmaskarray(data)).view(np.uint8))
+    key = (sha.hexdigest(), data.shape, xdim, ydim, npts)
+
+    if key in _CACHE:
+        INSTR.count('spectrum cache hits')
+        _CACHE.move_to_end(key)
+        return _CACHE[key]
+
+    with INSTR.span('forward fft', shape=data.shape):
+        spec = Spectrum(data, xdim, ydim, npts)
+    if spec.nbytes > CACHEBYTES:
+        return spec
+
+    _CACHE[key] = spec
+    while sum(i.nbytes for i in _CACHE.values()) > CACHEBYTES:
+        _CACHE.popitem(last=False)
+
+    return spec
+
+
+def fftsize(num):
+    """
+    Smallest number not less than num with no prime factors other than 2, 3
+    and 5. FFTs of these lengths are fast.
+
+    Parameters
+    ----------
+    num : int
+        minimum length
+
+    Returns
+    -------
+    int
+        FFT length
+    """
+    best = 2**int(np.ceil(np.log2(max(num, 1))))
+    pow5 = 1
+    while pow5 < best:
+        pow35 = pow5
+        while pow35 < best:
+            # smallest pow35*2**k >= num
+            size = pow35
+            while size < num:
+                size *= 2
+            best = min(best, size)
+            pow35 *= 3
+        pow5 *= 5
+    return best
+
+
+def padsize(nrows, ncols, npts=None):
+    """
+    Size of the padded grid. At least 5% (minimum 8 cells) is added on each
+    side, for the taper.
+
+    Parameters
+    ----------
+    nrows : int
+        number of rows
+    ncols : int
+        number of columns
+    npts : int
+        if given, a square grid of this size is used.
+
+    Returns
+    -------
+    tuple
+        rows and columns of the padded grid
+    """
+    if npts is not None:
+        return npts, npts
+    return (fftsize(nrows+2*max(nrows//20, 8)),
+            fftsize(ncols+2*max(ncols//20, 8)))
+
+
+def taper2d(g, nrows, ncols):
+    """
+    Pads a grid and tapers the padding to zero with a cosine taper.
+
+    The grid mean is removed and the grid is placed in the centre of the
+    padded grid. The padding is filled with the median and tapered to zero
+    at the edges, so that the padded grid is continuous when it wraps
+    around. Corners use the product of the row and column tapers.
+
+    Parameters
+    ----------
+    g : numpy array
+        input grid
+    nrows : int
+        number of rows of the padded grid
+    ncols : int
+        number of columns of the padded grid
+
+    Returns
+    -------
+    gf : numpy array
+        padded grid
+    """
+    m, n = g.shape
+    mdiff = (nrows-m)//2
+    ndiff = (ncols-n)//2
+
+    g = g - g.mean()
+    gf = np.full([nrows, ncols], np.median(g))
+    wrow = _taper1d(nrows, mdiff, m)
+    wcol = _taper1d(ncols, ndiff, n)
+    gf *= np.outer(wrow, wcol)
+    gf[mdiff:mdiff+m, ndiff:ndiff+n] = g
+
+    return gf
+
+
+def _taper1d(npts, diff, num):
+    """ Cosine taper weights, 1 over the data and 0 at the edges """
+    wgt = np.ones(npts)
+    pad1 = np.arange(diff)
+    wgt[:diff] = 0.5*(1-np.cos(pad1*np.pi/max(diff, 1)))
+    pad2 = np.arange(npts-diff-num)
+    wgt[npts-1-pad2] = 0.5*(1-np.cos(pad2*np.pi/max(pad2.size, 1)))
+    return wgt
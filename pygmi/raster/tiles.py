@@ -0,0 +1,548 @@
+# -----------------------------------------------------------------------------
+# Name:        tiles.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2018 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+""" Tiled raster processing.
+
+Raster operations are run over strips of rows, so that only one strip (plus
+a halo of extra rows needed by the operation) is in memory at a time.
+
+ * Bands are read through sources. ArrayBand wraps a masked array and
+   GDALBand reads windows from a file only when they are needed.
+ * Results are written to a TileOutput. Large outputs are memory mapped to
+   a temporary file, so they do not need to fit in RAM.
+ * run_tiles applies a function to every strip, optionally with a thread
+   pool.
+ * tile_stats, tile_quantile and tile_histogram calculate statistics of a
+   band one strip at a time. band_histogram keeps the histogram in the
+   Data object.
+"""
+
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from osgeo import gdal
+from pygmi.misc import INSTR
+
+# Approximate size of a strip, and the size above which outputs go to disk
+TILEBYTES = 2**26
+DISKBYTES = 2**28
+
+# Number of bins in cached band histograms
+HISTBINS = 32768
+
+
+class ArrayBand(object):
+    """
+    Band source for data which is already in memory.
+
+    Attributes
+    ----------
+    data : numpy masked array
+        band data
+    shape : tuple
+        rows and columns
+    """
+    def __init__(self, data):
+        self.data = np.ma.asarray(data)
+        self.shape = self.data.shape
+
+    def read(self, row0, row1):
+        """
+        Reads rows from the band.
+
+        Parameters
+        ----------
+        row0 : int
+            first row
+        row1 : int
+            last row (exclusive)
+
+        Returns
+        -------
+        numpy masked array
+            block of data
+        """
+        return self.data[row0:row1]
+
+
+class GDALBand(object):
+    """
+    Band source which reads windows from a GDAL file.
+
+    Each source opens its own handle to the file when it is first read, so
+    sources can be copied and pickled along with the Data they belong to.
+
+    Attributes
+    ----------
+    filename : str
+        file name
+    band : int
+        band number, starting at 1
+    shape : tuple
+        rows and columns
+    nullvalue : float
+        nodata value of the band, or None
+    maskbelow : bool
+        if True, values below the nodata value are also masked.
+    """
+    def __init__(self, filename, band=1, nullvalue=None, dataset=None):
+        self.filename = filename
+        self.band = band
+        self.lock = threading.Lock()
+        self.dataset = None
+        self.maskbelow = False
+
+        if dataset is None:
+            dataset = gdal.Open(filename, gdal.GA_ReadOnly)
+        rtmp = dataset.GetRasterBand(band)
+        self.shape = (dataset.RasterYSize, dataset.RasterXSize)
+        if nullvalue is None:
+            nullvalue = rtmp.GetNoDataValue()
+        self.nullvalue = nullvalue
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['dataset'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def open(self):
+        """ Returns the GDAL dataset, opening it if needed """
+        if self.dataset is None:
+            self.dataset = gdal.Open(self.filename, gdal.GA_ReadOnly)
+        return self.dataset
+
+    def read(self, row0, row1):
+        """
+        Reads rows from the file.
+
+        Parameters
+        ----------
+        row0 : int
+            first row
+        row1 : int
+            last row (exclusive)
+
+        Returns
+        -------
+        numpy masked array
+            block of data
+        """
+# GDAL datasets may not be used from more than one thread at once.
+        with self.lock:
+            rtmp = self.open().GetRasterBand(self.band)
+            dat = rtmp.ReadAsArray(0, row0, self.shape[1], row1-row0)
+
+        INSTR.count('bytes read', dat.nbytes)
+
+# The mask is made in place, without copying the data.
+        if dat.dtype.kind == 'f':
+            mask = np.isnan(dat)
+        else:
+            mask = np.zeros(dat.shape, dtype=bool)
+        if self.nullvalue is not None:
+            if self.maskbelow:
+                dat[dat < self.nullvalue] = self.nullvalue
+            mask |= (dat == self.nullvalue)
+        return np.ma.array(dat, mask=mask, copy=False)
+
+
+def band_source(dat):
+    """
+    Returns a source for a band.
+
+    Parameters
+    ----------
+    dat : Data, numpy array, tuple or source
+        a PyGMI raster dataset, an array, a (filename, band) tuple or an
+        existing source. Data which has not been loaded yet is read from
+        its file.
+
+    Returns
+    -------
+    ArrayBand or GDALBand
+        band source
+    """
+    if hasattr(dat, 'read') and hasattr(dat, 'shape'):
+        return dat
+    if isinstance(dat, tuple):
+        return GDALBand(*dat)
+    if getattr(dat, 'source', None) is not None:
+        return dat.source
+    if hasattr(dat, 'data') and not isinstance(dat, np.ndarray):
+        return ArrayBand(dat.data)
+    return ArrayBand(dat)
+
+
+class TileOutput(object):
+    """
+    Output of a tiled operation. Large outputs are memory mapped to a
+    temporary file, which is removed when the output is no longer used.
+    The shape is (rows, cols) or (bands, rows, cols).
+
+    Attributes
+    ----------
+    data : numpy array or memmap
+        output data
+    mask : numpy array or memmap
+        output mask
+    """
+    def __init__(self, shape, dtype=np.float64, disk=None):
+        dtype = np.dtype(dtype)
+        if disk is None:
+            disk = np.prod(shape)*dtype.itemsize > DISKBYTES
+
+        if disk:
+            self.data = np.memmap(tempfile.TemporaryFile(), dtype=dtype,
+                                  mode='w+', shape=shape)
+            self.mask = np.memmap(tempfile.TemporaryFile(), dtype=bool,
+                                  mode='w+', shape=shape)
+        else:
+            self.data = np.zeros(shape, dtype=dtype)
+            self.mask = np.zeros(shape, dtype=bool)
+
+    def write(self, row0, block):
+        """
+        Writes a block of rows.
+
+        Parameters
+        ----------
+        row0 : int
+            first row of the block
+        block : numpy masked array
+            data to write
+        """
+        row1 = row0+block.shape[-2]
+        self.data[..., row0:row1, :] = np.ma.getdata(block)
+        self.mask[..., row0:row1, :] = np.ma.getmaskarray(block)
+
+    def result(self):
+        """ Returns the output as a masked array """
+        return np.ma.array(self.data, mask=self.mask, copy=False)
+
+
+def strips(rows, cols, halo=0, itemsize=8, nbytes=None):
+    """
+    Divides a raster into strips of rows.
+
+    Parameters
+    ----------
+    rows : int
+        number of rows
+    cols : int
+        number of columns
+    halo : int
+        number of extra rows needed on each side of a strip
+    itemsize : int
+        bytes per cell, used to choose the strip size
+    nbytes : int
+        approximate bytes per strip. Defaults to TILEBYTES.
+
+    Returns
+    -------
+    list
+        list of (row0, row1, halo0, halo1) tuples. Rows row0 to row1 are
+        written, and rows halo0 to halo1 are read.
+    """
+    if nbytes is None:
+        nbytes = TILEBYTES
+    nrows = max(1, nbytes//max(1, cols*itemsize), 2*halo)
+
+    out = []
+    for row0 in range(0, rows, nrows):
+        row1 = min(rows, row0+nrows)
+        out.append((row0, row1, max(0, row0-halo), min(rows, row1+halo)))
+    return out
+
+
+def run_tiles(func, sources, halo=0, dtype=np.float64, nthreads=1,
+              piter=iter, disk=None, nbytes=None, bands=None):
+    """
+    Applies a function to a raster, one strip at a time.
+
+    Parameters
+    ----------
+    func : function
+        function which takes one block (masked array) for each source and
+        returns a masked array with the same shape as the blocks, or with
+        shape (bands, rows, cols) if bands is given.
+    sources : list
+        list of sources, or anything band_source accepts
+    halo : int
+        number of extra rows func needs on each side to give the same result
+        as on the whole raster
+    dtype : numpy dtype
+        output data type
+    nthreads : int
+        number of threads. None uses the number of processors.
+    piter : function
+        progress bar iterable
+    disk : bool
+        True to write the output to disk, False to keep it in memory. The
+        default depends on the output size.
+    nbytes : int
+        approximate bytes per strip
+    bands : int
+        number of output bands, if func returns more than one band
+
+    Returns
+    -------
+    numpy masked array
+        result
+    """
+    sources = [band_source(i) for i in sources]
+    rows, cols = sources[0].shape
+    for i in sources:
+        if i.shape != (rows, cols):
+            raise ValueError('All bands must be the same size')
+
+    if bands is None:
+        out = TileOutput((rows, cols), dtype, disk)
+        itemsize = np.dtype(dtype).itemsize
+    else:
+        out = TileOutput((bands, rows, cols), dtype, disk)
+        itemsize = np.dtype(dtype).itemsize*bands
+    itemsize += sum(np.dtype(i.read(0, 1).dtype).itemsize for i in sources)
+    windows = strips(rows, cols, halo, itemsize, nbytes)
+
+    def work(window):
+        """ Processes one strip """
+        row0, row1, halo0, halo1 = window
+        with INSTR.span('tile', rows=(row0, row1)):
+            blocks = [i.read(halo0, halo1) for i in sources]
+            res = func(*blocks)
+            out.write(row0, res[..., row0-halo0:row1-halo0, :])
+
+    if nthreads == 1 or len(windows) == 1:
+        for i in piter(windows):
+            work(i)
+    else:
+        with ThreadPoolExecutor(nthreads) as pool:
+            bwork = INSTR.bind(work)
+            futures = [pool.submit(bwork, i) for i in windows]
+            for i in piter(futures):
+                i.result()
+
+    return out.result()
+
+
+def tile_stats(source, nbytes=None):
+    """
+    Calculates statistics of a band, one strip at a time.
+
+    Parameters
+    ----------
+    source : source
+        band source, or anything band_source accepts
+
+    Returns
+    -------
+    stats : dictionary
+        count, min, max, mean and std (population) of the unmasked values
+    """
+    source = band_source(source)
+    rows, cols = source.shape
+
+    count = 0
+    dmin = np.inf
+    dmax = -np.inf
+    mean = 0.
+    msq = 0.
+    for row0, row1, _, _ in strips(rows, cols, 0, 8, nbytes):
+        block = source.read(row0, row1).compressed().astype(np.float64)
+        if block.size == 0:
+            continue
+        dmin = min(dmin, block.min())
+        dmax = max(dmax, block.max())
+
+# Combine the mean and sum of squares of this strip with the previous ones
+        bmean = block.mean()
+        bmsq = ((block-bmean)**2).sum()
+        total = count+block.size
+        delta = bmean-mean
+        mean += delta*block.size/total
+        msq += bmsq + delta**2*count*block.size/total
+        count = total
+
+    std = np.sqrt(msq/count) if count > 0 else np.nan
+    return {'count': count, 'min': dmin, 'max': dmax, 'mean': mean,
+            'std': std}
+
+
+def tile_quantile(source, perc, func=None, nbytes=None, nbins=4096):
+    """
+    Exact quantile of a band, calculated one strip at a time.
+
+    A histogram finds the bin containing the quantile, and only values in
+    that bin are kept to find the exact value. The result is the same as
+    np.percentile with linear interpolation.
+
+    Parameters
+    ----------
+    source : source
+        band source, or anything band_source accepts
+    perc : float
+        percentile, from 0 to 100
+    func : function
+        optional function applied to the values first, e.g. for the median
+        absolute deviation.
+    nbins : int
+        number of histogram bins
+
+    Returns
+    -------
+    float
+        quantile
+    """
+    source = band_source(source)
+    rows, cols = source.shape
+    windows = strips(rows, cols, 0, 8, nbytes)
+
+    def values(window):
+        """ Unmasked values of a strip """
+        block = source.read(window[0], window[1]).compressed()
+        block = block.astype(np.float64)
+        if func is not None:
+            block = func(block)
+        return block
+
+    count = 0
+    dmin = np.inf
+    dmax = -np.inf
+    for i in windows:
+        block = values(i)
+        if block.size > 0:
+            count += block.size
+            dmin = min(dmin, block.min())
+            dmax = max(dmax, block.max())
+
+    if count == 0:
+        return np.nan
+    if dmin == dmax:
+        return dmin
+
+    pos = perc/100.*(count-1)
+    klo = int(np.floor(pos))
+    khi = min(klo+1, count-1)
+
+    edges = np.linspace(dmin, dmax, nbins+1)
+    hist = np.zeros(nbins, dtype=np.int64)
+    for i in windows:
+        hist += np.histogram(values(i), edges)[0]
+    chist = np.cumsum(hist)
+
+# Bins holding the two order statistics, and the number of values before them
+    blo = np.searchsorted(chist, klo+1)
+    bhi = np.searchsorted(chist, khi+1)
+    before = chist[blo-1] if blo > 0 else 0
+
+    lower = edges[blo]
+    upper = edges[bhi+1]
+    keep = []
+    for i in windows:
+        block = values(i)
+        if bhi == nbins-1:
+            block = block[(block >= lower) & (block <= upper)]
+        else:
+            block = block[(block >= lower) & (block < upper)]
+        keep.append(block)
+    keep = np.sort(np.concatenate(keep))
+
+    vlo = keep[klo-before]
+    vhi = keep[khi-before]
+    return vlo + (vhi-vlo)*(pos-klo)
+
+
+def tile_histogram(source, nbins=HISTBINS, nbytes=None):
+    """
+    Histogram of a band, calculated one strip at a time. The result is the
+    same as np.histogram(values, nbins) of all the unmasked values.
+
+    Parameters
+    ----------
+    source : source
+        band source, or anything band_source accepts
+    nbins : int
+        number of bins
+
+    Returns
+    -------
+    hist : numpy array
+        counts in each bin
+    edges : numpy array
+        bin edges
+    """
+    stats = tile_stats(source, nbytes)
+    source = band_source(source)
+    rows, cols = source.shape
+
+    if stats['count'] == 0:
+        return np.histogram([], nbins)
+
+    hist = np.zeros(nbins, dtype=np.int64)
+    for row0, row1, _, _ in strips(rows, cols, 0, 8, nbytes):
+        block = source.read(row0, row1).compressed()
+        tmp, edges = np.histogram(block, nbins, (stats['min'], stats['max']))
+        hist += tmp
+
+    return hist, edges
+
+
+def band_histogram(dat, nbins=HISTBINS):
+    """
+    Histogram of a PyGMI raster dataset. It is calculated once on the full
+    resolution band and kept in dat.hist, so display stretches can be
+    looked up instead of being recalculated.
+
+    Setting dat.data clears dat.hist. The cache is not checked against the
+    data, so code which changes dat.data in place must reset it with
+    dat.hist = {}.
+
+    Parameters
+    ----------
+    dat : Data
+        PyGMI raster dataset
+    nbins : int
+        number of bins
+
+    Returns
+    -------
+    hist : numpy array
+        counts in each bin
+    edges : numpy array
+        bin edges
+    """
+    if nbins in dat.hist:
+        INSTR.count('histogram cache hits')
+        return dat.hist[nbins]
+
+    with INSTR.span('band histogram', band=dat.dataid):
+        hist, edges = tile_histogram(dat, nbins)
+    dat.hist[nbins] = (hist, edges)
+    return hist, edges
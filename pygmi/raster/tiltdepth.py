@@ -39,11 +39,13 @@ from matplotlib.figure import Figure
 import matplotlib.cm as cm
 from matplotlib.backends.backend_qt5agg import FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT
-from numba import jit
-import pygmi.raster.cooper as cooper
+from numba import jit, prange
+from scipy.spatial import cKDTree
 import pygmi.raster.dataprep as dataprep
+import pygmi.raster.spectral as spectral
 import pygmi.menu_default as menu_default
 import pygmi.misc as misc
+from pygmi.misc import INSTR
 
 
 class TiltDepth(QtWidgets.QDialog):
@@ -191,7 +193,7 @@ class TiltDepth(QtWidgets.QDialog):
         ims = self.axes.imshow(self.Z, extent=dataprep.dat_extent(zout),
                                cmap=cmap3)
 
-        if self.x0 is not None:
+        if self.x0 is not None and self.x0.size > 0:
             i = 0
             self.axes.plot(self.x1[i], self.y1[i], 'oy')
             self.axes.plot(self.x0[i], self.y0[i], 'sy')
@@ -245,111 +247,333 @@ class TiltDepth(QtWidgets.QDialog):
     def tiltdepth(self, data):
         """ Calculate tilt depth """
         self.pbar.setValue(0)
-        self.pbar.setMaximum(4)
+        self.pbar.setMaximum(2)
 
-    # RTP
         inc = self.dsb_inc.value()
         dec = self.dsb_dec.value()
 
-        zout = dataprep.rtp(data, inc, dec)
+        self.Z = tilt_angle(data, inc, dec)
+        nr, nc = self.Z.shape
+        x = data.tlx + np.arange(nc)*data.xdim+data.xdim/2
+        y = data.tly - np.arange(nr)*data.ydim-data.ydim/2
+        self.X, self.Y = np.meshgrid(x, y)
 
-    # Tilt
         self.pbar.setValue(1)
 
-        nr, nc = zout.data.shape
-        dy, dx = np.gradient(zout.data)
-        dxtot = np.sqrt(dx**2+dy**2)
-        dz = cooper.vertical(zout.data)
-        t1 = np.arctan(dz/dxtot)
+        self.depths, ends = tilt_depth(data, self.Z)
+        self.x0, self.y0 = self.depths[:, 0], self.depths[:, 1]
+        self.x1, self.y1, self.x2, self.y2 = ends.T
 
         self.pbar.setValue(2)
-        # A negative number implies we are straddling 0
 
-    # Contour tilt
-        x = zout.tlx + np.arange(nc)*zout.xdim+zout.xdim/2
-        y = zout.tly - np.arange(nr)*zout.ydim-zout.ydim/2
-        X, Y = np.meshgrid(x, y)
-        Z = np.rad2deg(t1)
-        self.X = X
-        self.Y = Y
-        self.Z = Z
 
-        cnt0 = self.axes.contour(X, Y, Z, [0])
-        cnt45 = self.axes.contour(X, Y, Z, [45], alpha=0)
-        cntm45 = self.axes.contour(X, Y, Z, [-45], alpha=0)
+def tilt_angle(data, inc, dec):
+    """
+    Tilt angle of the reduced to the pole data.
+
+    Parameters
+    ----------
+    data : Data
+        PyGMI raster dataset of magnetic data
+    inc : float
+        inclination of the magnetic field in degrees
+    dec : float
+        declination of the magnetic field in degrees
+
+    Returns
+    -------
+    numpy masked array
+        tilt angle in degrees
+    """
+    zout = dataprep.rtp(data, inc, dec)
+
+# The vertical derivative uses the cached spectrum from the RTP. It is scaled
+# to be per cell, like np.gradient.
+    spec = spectral.spectrum(data.data, data.xdim, data.ydim)
+    dy, dx = np.gradient(zout.data)
+    dxtot = np.sqrt(dx**2+dy**2)
+    dz = spec.calc(spec.rtp(inc, dec), spec.vertical())*data.xdim
+    t1 = np.arctan(dz/dxtot)
+
+    return np.rad2deg(t1)
+
+
+def tilt_depth(data, tilt, maxangle=10.):
+    """
+    Tilt depth. Depths are half the distance between the -45 and 45 degree
+    contours of the tilt angle, measured through each segment of the 0
+    degree contour. The nearest -45 and 45 degree contour points are found
+    with KD-trees. This needs no plotting, so it can be used in batch.
+
+    Parameters
+    ----------
+    data : Data
+        PyGMI raster dataset, used for the grid geometry
+    tilt : numpy array
+        tilt angle in degrees (see tilt_angle)
+    maxangle : float
+        largest difference in degrees between the direction to a -45 or 45
+        degree contour and the normal of the 0 degree contour. Points
+        outside this are not used.
+
+    Returns
+    -------
+    depths : numpy array
+        x, y, contour id and depth of each 0 degree contour point
+    ends : numpy array
+        x and y of the nearest 45 degree point, and x and y of the nearest
+        -45 degree point, for each depth
+    """
+    geom = (data.tlx, data.tly, data.xdim, data.ydim)
+    gx0, gy0, cgrad0, cntid0 = contour_segments(tilt, 0., *geom)
+    gx45, gy45, _, _ = contour_segments(tilt, 45., *geom)
+    gxm45, gym45, _, _ = contour_segments(tilt, -45., *geom)
+
+    if gx0.size == 0 or gx45.size == 0 or gxm45.size == 0:
+        return np.zeros((0, 4)), np.zeros((0, 4))
+
+    g0 = np.transpose([gx0, gy0])
+    with INSTR.span('tilt depth nearest contours', points=gx0.size):
+        _, dmin1 = cKDTree(np.transpose([gx45, gy45])).query(g0)
+        _, dmin2 = cKDTree(np.transpose([gxm45, gym45])).query(g0)
+
+    dx1 = gx45[dmin1] - gx0
+    dy1 = gy45[dmin1] - gy0
+
+    dx2 = gxm45[dmin2] - gx0
+    dy2 = gym45[dmin2] - gy0
+
+    grad = np.arctan2(dy1, dx1)*180/pi
+    grad[grad > 90] -= 180
+    grad[grad < -90] += 180
+    gtmp1 = np.abs(90-np.abs(grad-cgrad0))
 
-        self.pbar.setValue(3)
+    grad = np.arctan2(dy2, dx2)*180/pi
+    grad[grad > 90] -= 180
+    grad[grad < -90] += 180
+    gtmp2 = np.abs(90-np.abs(grad-cgrad0))
 
-        gx0, gy0, cgrad0, cntid0 = vgrad(cnt0)
-        gx45, gy45, _, _ = vgrad(cnt45)
-        gxm45, gym45, _, _ = vgrad(cntm45)
+    gtmp = np.logical_and(gtmp1 <= maxangle, gtmp2 <= maxangle)
 
-        g0 = np.transpose([gx0, gy0])
+    gx0 = gx0[gtmp]
+    gy0 = gy0[gtmp]
+    cntid0 = cntid0[gtmp]
+    dx1 = dx1[gtmp]
+    dy1 = dy1[gtmp]
+    dx2 = dx2[gtmp]
+    dy2 = dy2[gtmp]
 
-        self.pbar.setValue(4)
+    dist1 = np.sqrt(dx1**2+dy1**2)
+    dist2 = np.sqrt(dx2**2+dy2**2)
 
-        dmin1 = []
-        dmin2 = []
+    dist = np.min([dist1, dist2], 0)
 
-        for i, j in self.pbar.iter(g0):
-            dmin1.append(distpc(gx45, gy45, i, j, 0))
-            dmin2.append(distpc(gxm45, gym45, i, j, 0))
+    depths = np.transpose([gx0, gy0, cntid0.astype(int), dist])
+    ends = np.transpose([dx1+gx0, dy1+gy0, dx2+gx0, dy2+gy0])
 
-        dx1 = gx45[dmin1] - gx0
-        dy1 = gy45[dmin1] - gy0
+    return depths, ends
 
-        dx2 = gxm45[dmin2] - gx0
-        dy2 = gym45[dmin2] - gy0
 
-        grad = np.arctan2(dy1, dx1)*180/pi
-        grad[grad > 90] -= 180
-        grad[grad < -90] += 180
-        gtmp1 = np.abs(90-np.abs(grad-cgrad0))
+def contour_segments(zgrid, level, tlx=0., tly=0., xdim=1., ydim=1.):
+    """
+    Contours a grid with marching squares, and returns the midpoints and
+    directions of the contour segments. Each segment crosses one cell of
+    the grid of cell centres. Masked and nan cells are not contoured.
 
-        grad = np.arctan2(dy2, dx2)*180/pi
-        grad[grad > 90] -= 180
-        grad[grad < -90] += 180
-        gtmp2 = np.abs(90-np.abs(grad-cgrad0))
+    Parameters
+    ----------
+    zgrid : numpy array
+        grid to contour
+    level : float
+        contour level
+    tlx : float
+        top left x coordinate of the grid
+    tly : float
+        top left y coordinate of the grid
+    xdim : float
+        cell size in the x direction
+    ydim : float
+        cell size in the y direction
+
+    Returns
+    -------
+    gx : numpy array
+        x coordinates of the segment midpoints
+    gy : numpy array
+        y coordinates of the segment midpoints
+    cgrad : numpy array
+        direction of each segment in degrees, between -90 and 90
+    cntid : numpy array
+        id of the contour line each segment belongs to, from 1
+    """
+    zgrid = np.ma.filled(np.ma.masked_invalid(zgrid).astype(np.float64),
+                         np.nan)
+
+    with INSTR.span('marching squares', shape=zgrid.shape):
+        nseg = _ms_count(zgrid, level)
+        start = np.zeros(nseg.size+1, dtype=np.int64)
+        start[1:] = np.cumsum(nseg)
+        seg, edges = _ms_segments(zgrid, level, start)
+        cntid = _link_segments(edges, 2*zgrid.size)
+
+# Cell centres, with rows running from north to south
+    x0 = tlx+(seg[:, 0]+0.5)*xdim
+    y0 = tly-(seg[:, 1]+0.5)*ydim
+    x1 = tlx+(seg[:, 2]+0.5)*xdim
+    y1 = tly-(seg[:, 3]+0.5)*ydim
+
+    cgrad = np.rad2deg(np.arctan2(y1-y0, x1-x0))
+    cgrad[cgrad > 90] -= 180.
+    cgrad[cgrad < -90] += 180.
 
-        gtmp = np.logical_and(gtmp1 <= 10, gtmp2 <= 10)
+    return (x0+x1)/2, (y0+y1)/2, cgrad, cntid
 
-        gx0 = gx0[gtmp]
-        gy0 = gy0[gtmp]
-        cntid0 = cntid0[gtmp]
-        dx1 = dx1[gtmp]
-        dy1 = dy1[gtmp]
-        dx2 = dx2[gtmp]
-        dy2 = dy2[gtmp]
 
-        dist1 = np.sqrt(dx1**2+dy1**2)
-        dist2 = np.sqrt(dx2**2+dy2**2)
+@jit(nopython=True, nogil=True)
+def _ms_case(zgrid, level, i, j):
+    """
+    Marching squares for a cell. Returns the edges joined by up to two
+    segments, -1 where there is no segment. Edges are 0 top, 1 right,
+    2 bottom and 3 left.
+    """
+    z00 = zgrid[i, j]
+    z01 = zgrid[i, j+1]
+    z10 = zgrid[i+1, j]
+    z11 = zgrid[i+1, j+1]
+
+    if np.isnan(z00+z01+z10+z11):
+        return -1, -1, -1, -1
+
+    a00 = z00 > level
+    a01 = z01 > level
+    a10 = z10 > level
+    a11 = z11 > level
+
+    if a00 == a01 == a10 == a11:
+        return -1, -1, -1, -1
+
+    if a00 != a01 and a01 != a11 and a10 != a11 and a00 != a10:
+# Saddles are resolved with the mean of the corners. Segments cut off the
+# corners which are on the other side of the level to the centre.
+        if ((z00+z01+z10+z11)/4 > level) == a00:
+            return 0, 1, 2, 3
+        return 0, 3, 1, 2
+
+    e0 = -1
+    e1 = -1
+    for edge, cut in enumerate((a00 != a01, a01 != a11, a10 != a11,
+                                a00 != a10)):
+        if cut:
+            if e0 < 0:
+                e0 = edge
+            else:
+                e1 = edge
+    return e0, e1, -1, -1
+
+
+@jit(nopython=True, parallel=True)
+def _ms_count(zgrid, level):
+    """ Number of contour segments in each row of cells """
+    rows, cols = zgrid.shape
+    nseg = np.zeros(max(rows-1, 0), dtype=np.int64)
+
+    for i in prange(rows-1):
+        for j in range(cols-1):
+            pairs = _ms_case(zgrid, level, i, j)
+            nseg[i] += (pairs[0] >= 0) + (pairs[2] >= 0)
+    return nseg
 
-        dist = np.min([dist1, dist2], 0)
 
-        self.x0 = gx0
-        self.x1 = dx1+gx0
-        self.x2 = dx2+gx0
-        self.y0 = gy0
-        self.y1 = dy1+gy0
-        self.y2 = dy2+gy0
+@jit(nopython=True, nogil=True)
+def _ms_point(zgrid, level, i, j, edge):
+    """ Column, row and edge number of a contour crossing on a cell edge """
+    cols = zgrid.shape[1]
+    if edge == 0 or edge == 2:
+        i2 = i + edge//2
+        t = (level-zgrid[i2, j])/(zgrid[i2, j+1]-zgrid[i2, j])
+        return j+t, float(i2), i2*cols+j
+    j2 = j + int(edge == 1)
+    t = (level-zgrid[i, j2])/(zgrid[i+1, j2]-zgrid[i, j2])
+    return float(j2), i+t, zgrid.size+i*cols+j2
+
+
+@jit(nopython=True, parallel=True)
+def _ms_segments(zgrid, level, start):
+    """ Contour segment end points (column, row) and their edge numbers """
+    rows, cols = zgrid.shape
+    seg = np.zeros((start[-1], 4))
+    edges = np.zeros((start[-1], 2), dtype=np.int64)
+
+    for i in prange(rows-1):
+        k = start[i]
+        for j in range(cols-1):
+            pairs = _ms_case(zgrid, level, i, j)
+            for p in range(2):
+                if pairs[2*p] < 0:
+                    continue
+                c0, r0, e0 = _ms_point(zgrid, level, i, j, pairs[2*p])
+                c1, r1, e1 = _ms_point(zgrid, level, i, j, pairs[2*p+1])
+                seg[k, 0] = c0
+                seg[k, 1] = r0
+                seg[k, 2] = c1
+                seg[k, 3] = r1
+                edges[k, 0] = e0
+                edges[k, 1] = e1
+                k += 1
+    return seg, edges
 
-        self.depths = np.transpose([gx0, gy0, cntid0.astype(int), dist])
+
+@jit(nopython=True, nogil=True)
+def _link_segments(edges, nedges):
+    """
+    Contour line ids of segments. Segments which share a crossing point on
+    a cell edge are on the same line.
+    """
+    parent = np.arange(nedges)
+
+    for k in range(edges.shape[0]):
+        a = edges[k, 0]
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        b = edges[k, 1]
+        while parent[b] != b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+        if a != b:
+            parent[b] = a
+
+# Number the lines from 1, in the order they are first found
+    lineid = np.zeros(nedges, dtype=np.int64)
+    cntid = np.zeros(edges.shape[0], dtype=np.int64)
+    nline = 0
+    for k in range(edges.shape[0]):
+        a = edges[k, 0]
+        while parent[a] != a:
+            a = parent[a]
+        if lineid[a] == 0:
+            nline += 1
+            lineid[a] = nline
+        cntid[k] = lineid[a]
+    return cntid
 
 
 @jit(nopython=True, nogil=True)
 def distpc2(dx, dy, dx0, dy0, dmin):
-    """ Find closest distances """
+    """
+    Find closest distances. This is a brute force search, kept for
+    checking tilt_depth.
+    """
 
     num = dx.size
     num2 = dx0.size
 
-    dmin2 = (dx0[0]-dx[0])**2+(dy0[0]-dy[0])**2
-    dcnt = 0
-
     for j in range(num2):
+        dcnt = 0
+        dmin2 = (dx0[j]-dx[0])**2+(dy0[j]-dy[0])**2
         for i in range(num):
             dist = (dx0[j]-dx[i])**2+(dy0[j]-dy[i])**2
-            if dmin2 < dist:
+            if dmin2 > dist:
                 dcnt = i
                 dmin2 = dist
         dmin[j] = dcnt
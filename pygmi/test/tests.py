@@ -64,6 +64,92 @@ def tests():
     plt.show()
 
 
+def tests_instrument(nworkers=8, ncounts=1000):
+    """ Counters and spans recorded in a thread pool reach the outer span """
+    from concurrent.futures import ThreadPoolExecutor
+    from pygmi.misc import INSTR
+
+    class ListSink(object):
+        """ Keeps the records in a list """
+        def __init__(self):
+            self.records = []
+
+        def emit(self, record):
+            """ Stores a record """
+            self.records.append(record)
+
+        def close(self):
+            """ Nothing to close """
+
+    def work(i):
+        """ Counts in a worker span and directly in the outer span """
+        with INSTR.span('worker', number=i):
+            for _ in range(ncounts):
+                INSTR.count('items')
+        INSTR.count('workers')
+
+    sink = INSTR.add_sink(ListSink())
+    with INSTR.span('outer') as outer:
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(INSTR.bind(work), range(nworkers)))
+    INSTR.remove_sink(sink)
+
+    workers = [i for i in sink.records if i['name'] == 'worker']
+    print('Worker spans nested:', len(workers) == nworkers and
+          all(i['path'] == 'outer/worker' for i in workers))
+    print('Counters reached the outer span:',
+          outer['counters'] == {'items': nworkers*ncounts,
+                                'workers': nworkers})
+
+
+def tests_chunkstore(numx=300, numy=250, numz=100):
+    """ Chunked model container round trips and incremental saves """
+    import os
+    import shutil
+    import tempfile
+    from pygmi.pfmod.datatypes import LithModel
+    from pygmi.pfmod.chunkstore import ModelStore
+
+    lmod = LithModel()
+    lmod.update(numx, numy, numz, 0., 0., 0., 10., 10.)
+    lmod.lith_index[:] = np.random.randint(-1, 6, lmod.lith_index.shape)
+
+    tmpdir = tempfile.mkdtemp()
+    ofile = os.path.join(tmpdir, 'model.p3d')
+    store = ModelStore(ofile, chunkz=8)
+    nbytes = store.save(lmod)
+    print('First save (MB):', nbytes/2**20)
+
+    ttt = PTime()
+    indict = ModelStore(ofile).to_dict()
+    ttt.since_last_call('open model')
+    lith = indict['lith_index']
+    base = lith
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    print('Index is memory mapped:', base is not None, lith.dtype)
+    print('Round trip identical:', np.array_equal(lith, lmod.lith_index),
+          np.array_equal(store.layer(13), lmod.lith_index[:, :, 13]))
+
+    print('Unchanged save writes nothing:', store.save(lmod) == 0)
+
+    lmod.lith_index[:, :, 20] = 3
+    chunk = numx*numy*8*2
+    print('One layer changed, one chunk written:', store.save(lmod) == chunk)
+    lith = ModelStore(ofile).lith_index()
+    print('Changed model identical:', np.array_equal(lith, lmod.lith_index))
+
+    lmod.lith_index[:, :, :70] = 1
+    oldbase = store.header['lith_index']['base']
+    store.save(lmod)
+    print('Base rewritten:', store.header['lith_index']['base'] != oldbase,
+          not os.path.exists(os.path.join(store.datadir, oldbase)),
+          np.array_equal(ModelStore(ofile).lith_index(), lmod.lith_index))
+
+    del lith, indict, base
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
 def tests_rtp():
     """ Tests to debug RTP """
     import matplotlib.pyplot as plt
@@ -86,6 +172,339 @@ def tests_rtp():
     plt.show()
 
 
+def median_loop(dat, fmat):
+    """ Median filter as it was calculated before rank_filter """
+    rowf, colf = fmat.shape
+    rowd, cold = dat.shape
+    drr = (rowf-1)//2
+    dcc = (colf-1)//2
+
+    dummy = np.zeros((rowd+rowf-1, cold+colf-1))*np.nan
+    dummy[drr:drr+rowd, dcc:dcc+cold] = dat.filled(np.nan)
+    fmat = fmat.astype(bool)
+
+    out = np.zeros([rowd, cold])*np.nan
+    for i in range(rowd):
+        for j in range(cold):
+            tmp1 = dummy[i:i+rowf, j:j+colf][fmat]
+            if np.isnan(tmp1).min() == False:
+                out[i, j] = np.nanmedian(tmp1)
+    return np.ma.masked_invalid(out)
+
+
+def tests_median(rows=200, cols=200, radius=4):
+    """ Benchmark of the median filter against the old python loop """
+    from pygmi.raster.smooth import rank_filter, filters2d
+
+    dat = np.ma.array(np.random.rand(rows, cols))
+    dat[np.random.rand(rows, cols) > 0.9] = np.ma.masked
+    fmat = filters2d('disc', radius)
+
+    rank_filter(dat[:10, :10], fmat)  # compile
+
+    ttt = PTime()
+    out1 = median_loop(dat, fmat)
+    tloop = ttt.since_last_call('python loop')
+    out2 = rank_filter(dat, fmat)
+    tfast = ttt.since_last_call('rank_filter')
+
+    print('Speedup:', tloop/tfast)
+    print('Max difference:', np.abs(out1-out2).max())
+    print('Same mask:', (out1.mask == out2.mask).all())
+
+    big = np.ma.array(np.random.rand(5000, 5000))
+    ttt.since_last_call(show=False)
+    rank_filter(big, filters2d('disc', 4))
+    ttt.since_last_call('rank_filter 5000x5000, 9x9 disc')
+
+
+def tests_mean(rows=500, cols=500):
+    """ Checks the mean filter against a direct convolution """
+    import scipy.signal as ssig
+    from pygmi.raster.smooth import mean_filter, filters2d
+
+    dat = np.random.rand(rows, cols)
+    dat[np.random.rand(rows, cols) > 0.95] = np.nan
+    orig = dat.copy()
+    fmat = filters2d('gaussian', [15, 15], 3.)
+
+    ttt = PTime()
+    out = mean_filter(dat, fmat)
+    ttt.since_last_call('mean_filter')
+
+    wgt = np.isfinite(dat).astype(float)
+    num = ssig.correlate(np.nan_to_num(dat), fmat, 'same', method='direct')
+    den = ssig.correlate(wgt, fmat, 'same', method='direct')
+    ref = np.ma.array(num/den, mask=~np.isfinite(dat))
+
+    print('Max difference:', np.abs(out-ref).max())
+    print('Input unchanged:', np.array_equal(dat, orig, equal_nan=True))
+
+
+def visibility_loop(data, wsize, dh):
+    """ Visibility as it was calculated before the compiled version """
+    import pygmi.raster.cooper as cooper
+    visible1 = getattr(cooper, '__visible1').py_func
+    visible2 = getattr(cooper, '__visible2').py_func
+
+    nr, nc = np.shape(data)
+    w2 = int(np.floor(wsize/2))
+    vdir = np.zeros([8, nr, nc])
+    mask = np.ma.getmaskarray(data)
+    mean = data.mean()
+    data = data.data.copy()
+    data[mask] = mean
+
+    for j in range(nc):
+        for i in range(w2, nr-w2):
+            dtmp = data[i-w2:i+w2+1, j]
+            vdir[0, i, j] = visible1(dtmp, wsize, w2+1, dh)
+            vdir[1, i, j] = visible2(dtmp, wsize, w2+1, dh)
+
+    for j in range(w2, nc-w2):
+        for i in range(nr):
+            dtmp = data[i, j-w2:j+w2+1]
+            vdir[2, i, j] = visible1(dtmp, wsize, w2+1, dh)
+            vdir[3, i, j] = visible2(dtmp, wsize, w2+1, dh)
+
+    for j in range(w2, nc-w2):
+        for i in range(w2, nr-w2):
+            dtmp = np.array([data[i-w2+k, j-w2+k] for k in range(wsize)])
+            vdir[4, i, j] = visible1(dtmp, wsize, w2+1, dh)
+            vdir[5, i, j] = visible2(dtmp, wsize, w2+1, dh)
+            dtmp = np.array([data[i+w2-k, j-w2+k] for k in range(wsize)])
+            vdir[6, i, j] = visible1(dtmp, wsize, w2+1, dh)
+            vdir[7, i, j] = visible2(dtmp, wsize, w2+1, dh)
+
+    vn, vs, ve, vw, vd1, vd2, vd3, vd4 = vdir
+    vtot = vdir.sum(0)[w2:nr-w2, w2:nc-w2]
+    vstd = np.std(vdir, 0, ddof=1)[w2:nr-w2, w2:nc-w2]
+
+    c45 = np.cos(45*np.pi/180)
+    s45 = np.sin(45*np.pi/180)
+    vsumx = ve-vw+vd1*c45-vd2*c45+vd3*c45-vd4*c45
+    vsumy = vn-vs+vd1*s45-vd2*s45-vd3*s45+vd4*s45
+    vsum = np.sqrt(vsumx*vsumx+vsumy*vsumy)[w2:nr-w2, w2:nc-w2]
+
+    return vtot, vstd, vsum
+
+
+def tests_visibility(rows=150, cols=150, wsize=11):
+    """ Benchmark of visibility2d against the old python loops """
+    from pygmi.raster.cooper import visibility2d
+
+    xxx, yyy = np.meshgrid(np.arange(cols), np.arange(rows))
+    data = np.ma.array(np.sin(xxx/7.)*np.cos(yyy/5.) +
+                       np.random.rand(rows, cols))
+    dh = data.std()/10.
+
+    visibility2d(data[:20, :20], wsize, dh)  # compile
+
+    ttt = PTime()
+    out1 = visibility_loop(data, wsize, dh)
+    tloop = ttt.since_last_call('python loops')
+    out2 = visibility2d(data, wsize, dh)
+    tfast = ttt.since_last_call('visibility2d')
+
+    print('Speedup:', tloop/tfast)
+    for i, j, k in zip(['vtot', 'vstd', 'vsum'], out1, out2):
+        print(i, 'identical:', np.array_equal(j, k.data))
+
+    big = np.ma.array(np.random.rand(2000, 2000))
+    ttt.since_last_call(show=False)
+    visibility2d(big, wsize, dh)
+    ttt.since_last_call('visibility2d 2000x2000')
+
+
+def tests_ascii(rows=1000, cols=1000):
+    """ Throughput of the ASCII grid reader and writer """
+    import os
+    import tempfile
+    from pygmi.raster.datatypes import Data
+    import pygmi.raster.asciigrid as asciigrid
+
+    dat = Data()
+    dat.data = np.ma.array(np.random.randn(rows, cols))
+    dat.data[::7, ::5] = np.ma.masked
+    dat.rows, dat.cols = dat.data.shape
+    dat.nullvalue = -9999.
+
+    tmpdir = tempfile.mkdtemp()
+    ttt = PTime()
+    for ext, write, read in [
+            ('asc', asciigrid.export_esri_ascii, asciigrid.get_esri_ascii),
+            ('xyz', asciigrid.export_xyz,
+             lambda ifile: asciigrid.get_xyz(ifile, dat.nullvalue))]:
+        ofile = os.path.join(tmpdir, 'test.'+ext)
+
+        ttt.since_last_call(show=False)
+        write(ofile, dat)
+        twrite = ttt.since_last_call(show=False)
+        mbytes = os.path.getsize(ofile)/2**20
+        out = read(ofile)[0]
+        tread = ttt.since_last_call(show=False)
+
+        print(ext, '{0:.1f} MB, write {1:.1f} MB/s, read {2:.1f} MB/s'.format(
+            mbytes, mbytes/twrite, mbytes/tread))
+        print(ext, 'identical:', np.array_equal(out.data.data[~dat.data.mask],
+                                                dat.data.compressed()),
+              np.array_equal(out.data.mask, dat.data.mask))
+
+        os.remove(ofile)
+    os.rmdir(tmpdir)
+
+
+def gxf_loop(fno, tmp):
+    """ The previous GXF grid writer, one value at a time """
+    for i in range(tmp.shape[0]-1, -1, -1):
+        kkk = 0
+        for j in range(tmp.shape[1]):
+            if kkk == 5:
+                kkk = 0
+            if kkk == 0:
+                fno.write("\n")
+
+            fno.write(str(tmp[i, j]) + "  ")
+            kkk += 1
+
+
+def tests_gxf(rows=500, cols=400):
+    """ GXF and GeoPak round trips, and GXF against the previous writer """
+    import os
+    import io
+    import tempfile
+    from pygmi.raster.datatypes import Data
+    from pygmi.raster.iodefs import export_geopak, get_geopak
+    import pygmi.raster.gxf as gxf
+
+    dat = Data()
+    dat.data = np.ma.array(np.random.randn(rows, cols)*100)
+    dat.data[::7, ::5] = np.ma.masked
+    dat.rows, dat.cols = dat.data.shape
+    dat.tlx, dat.tly = 1000., 5000.
+    dat.xdim = dat.ydim = 10.
+
+    tmpdir = tempfile.mkdtemp()
+    ofile = os.path.join(tmpdir, 'test.gxf')
+
+    ttt = PTime()
+    fno = io.StringIO()
+    gxf_loop(fno, dat.data.filled(dat.nullvalue))
+    tloop = ttt.since_last_call('previous gxf writer')
+    gxf.export_gxf(ofile, dat)
+    tfast = ttt.since_last_call('export_gxf')
+    print('Speedup:', tloop/tfast)
+
+    with open(ofile) as fno2:
+        text = fno2.read()
+    print('gxf grid identical:', text.endswith('#GRID\n'+fno.getvalue()))
+
+    out = gxf.get_gxf(ofile)[0]
+    print('gxf read identical:',
+          np.array_equal(out.data.filled(0), dat.data.filled(0)),
+          np.array_equal(out.data.mask, dat.data.mask))
+    print('gxf position identical:', np.isclose(out.tlx, dat.tlx),
+          np.isclose(out.tly, dat.tly))
+
+    vrange = dat.data.max()-dat.data.min()
+    for gtype in [3, 5]:
+        gxf.export_gxf(ofile, dat, gtype=gtype)
+        out = gxf.get_gxf(ofile)[0]
+        err = np.abs(out.data-dat.data).max()/vrange
+        print('gxf gtype', gtype, 'relative error:', err,
+              np.array_equal(out.data.mask, dat.data.mask))
+    os.remove(ofile)
+
+    ofile = os.path.join(tmpdir, 'test.grd')
+    export_geopak(ofile, dat)
+    out = get_geopak(ofile)[0]
+    print('geopak relative error:', np.abs(out.data-dat.data).max()/vrange,
+          np.array_equal(out.data.mask, dat.data.mask))
+    os.remove(ofile)
+    os.rmdir(tmpdir)
+
+
+def tests_get_files(nfiles=4, rows=1000, cols=1000):
+    """ Imports several files concurrently with get_files """
+    import os
+    import tempfile
+    from pygmi.raster.datatypes import Data
+    from pygmi.raster.iodefs import get_files
+    import pygmi.raster.gxf as gxf
+
+    tmpdir = tempfile.mkdtemp()
+    ifiles = []
+    dats = []
+    for i in range(nfiles):
+        dat = Data()
+        dat.data = np.ma.array(np.random.randn(rows, cols)*100)
+        dat.data[::7, ::5] = np.ma.masked
+        dat.rows, dat.cols = dat.data.shape
+        ifiles.append(os.path.join(tmpdir, 'scene{0}.gxf'.format(i)))
+        gxf.export_gxf(ifiles[-1], dat)
+        dats.append(dat)
+
+    out = get_files(ifiles)
+    print('Files read:', len(out) == nfiles)
+    print('Data identical:', all(
+        np.array_equal(i.data.filled(0), j.data.filled(0)) and
+        np.array_equal(i.data.mask, j.data.mask) for i, j in zip(out, dats)))
+
+    for i in ifiles:
+        os.remove(i)
+    os.rmdir(tmpdir)
+
+
+def tests_gridding(npts=1000000, dxy=.001):
+    """ Times the gridding methods on a known function """
+    import pygmi.raster.gridding as gridding
+
+    points = np.random.rand(npts, 2)
+    values = dp.func(points[:, 0], points[:, 1])
+    xmin, ymin, rows, cols = gridding.grid_extent(points[:, 0],
+                                                  points[:, 1], dxy)
+    xcen = xmin+(np.arange(cols)+0.5)*dxy
+    ycen = ymin+(np.arange(rows)+0.5)*dxy
+    truth = dp.func(*np.meshgrid(xcen, ycen))
+
+    ttt = PTime()
+    for method in ['quickgrid', 'idw', 'mincurv']:
+        dat = getattr(gridding, method)(points[:, 0], points[:, 1], values,
+                                        dxy, showtext=lambda *args: None)
+        ttt.since_last_call(method)
+        print('Mean error:', np.abs(dat-truth).mean())
+
+
+def tests_tiltdepth(rows=400, cols=500, nsrc=30):
+    """ Times tilt depth on random sources, against a brute force search """
+    import pygmi.raster.tiltdepth as td
+    from pygmi.raster.datatypes import Data
+
+    yy, xx = np.mgrid[:rows, :cols]
+    dat = Data()
+    dat.data = np.ma.zeros((rows, cols))
+    for _ in range(nsrc):
+        xcen, ycen = np.random.rand()*cols, np.random.rand()*rows
+        width = 5+np.random.rand()*20
+        dat.data += np.random.randn()*100*np.exp(-((xx-xcen)**2 +
+                                                   (yy-ycen)**2)/width**2)
+    dat.rows, dat.cols = rows, cols
+
+    ttt = PTime()
+    tilt = td.tilt_angle(dat, -67., -17.)
+    ttt.since_last_call('Tilt angle')
+    depths, ends = td.tilt_depth(dat, tilt)
+    ttt.since_last_call('Tilt depth')
+
+    gx0, gy0, _, _ = td.contour_segments(tilt, 0.)
+    gx45, gy45, _, _ = td.contour_segments(tilt, 45.)
+    dmin = np.zeros(gx0.size, dtype=np.int64)
+    td.distpc2(gx45, gy45, gx0, gy0, dmin)
+    ttt.since_last_call('Brute force search')
+    print('Depths:', depths.shape[0], 'Ends checked:',
+          np.isin(ends[:, 0], gx45[dmin]).all())
+
+
 if __name__ == "__main__":
     # doctest.testmod(pygmi.raster)
     nose.run()
@@ -0,0 +1,266 @@
+# -----------------------------------------------------------------------------
+# Name:        clip.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2018 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+""" Clipping of raster and point data with polygons.
+
+All polygons in a shapefile are used, including every part of multipolygons
+and their holes.
+
+ * Raster masks are made with GDAL's rasteriser. A mask is made once for
+   each grid geometry and reused for every band on that grid.
+ * Points are tested against the polygon edges with an even-odd rule. The
+   edges are put into horizontal buckets, so each point is only tested
+   against the edges in its bucket.
+"""
+
+import numpy as np
+from numba import jit, prange
+from osgeo import gdal, ogr
+from pygmi.misc import INSTR
+from pygmi.raster.tiles import band_source
+
+POLYTYPES = [ogr.wkbPolygon, ogr.wkbMultiPolygon, ogr.wkbPolygon25D,
+             ogr.wkbMultiPolygon25D]
+
+
+class Clipper(object):
+    """
+    Clips raster and point data with the polygons in a shapefile.
+
+    Attributes
+    ----------
+    ifile : str
+        shapefile name
+    extent : tuple
+        minimum x, maximum x, minimum y and maximum y of the polygons
+    rings : list
+        list of numpy arrays with the x and y coordinates of every polygon
+        ring (outer rings and holes)
+    """
+    def __init__(self, ifile):
+        self.ifile = ifile
+        self.shapef = ogr.Open(ifile)
+        if self.shapef is None:
+            raise IOError('Could not open '+str(ifile))
+
+        lyr = self.shapef.GetLayer()
+        if lyr.GetGeomType() not in POLYTYPES or lyr.GetFeatureCount() == 0:
+            raise ValueError(str(ifile)+' has no polygons')
+
+        self.extent = lyr.GetExtent()
+        self.rings = []
+        lyr.ResetReading()
+        for feat in lyr:
+            geom = feat.GetGeometryRef()
+            if geom is None:
+                continue
+            parts = [geom]
+            if geom.GetGeometryName() == 'MULTIPOLYGON':
+                parts = [geom.GetGeometryRef(i)
+                         for i in range(geom.GetGeometryCount())]
+            for part in parts:
+                for i in range(part.GetGeometryCount()):
+                    ring = part.GetGeometryRef(i)
+                    ring = np.array(ring.GetPoints())[:, :2]
+                    if (ring[0] != ring[-1]).any():
+                        ring = np.vstack([ring, ring[:1]])
+                    self.rings.append(ring)
+        lyr.ResetReading()
+
+        self._masks = {}
+        self._index = None
+
+    def window(self, data):
+        """
+        Rows and columns of a raster which contain the polygons.
+
+        Parameters
+        ----------
+        data : Data
+            PyGMI raster dataset
+
+        Returns
+        -------
+        tuple
+            first row, last row (exclusive), first column and last column
+            (exclusive)
+        """
+        minx, maxx, miny, maxy = self.extent
+        col0 = max(0, int((minx-data.tlx)/data.xdim))
+        row0 = max(0, int((data.tly-maxy)/data.ydim))
+        col1 = min(data.cols, int(np.ceil((maxx-data.tlx)/data.xdim)))
+        row1 = min(data.rows, int(np.ceil((data.tly-miny)/data.ydim)))
+        return row0, max(row0, row1), col0, max(col0, col1)
+
+    def raster_mask(self, data):
+        """
+        Mask of the raster cells outside the polygons, for the window
+        returned by window(). Masks are cached for each grid geometry.
+
+        Parameters
+        ----------
+        data : Data
+            PyGMI raster dataset
+
+        Returns
+        -------
+        numpy array
+            boolean mask, True outside the polygons
+        """
+        row0, row1, col0, col1 = self.window(data)
+        key = (data.tlx, data.tly, data.xdim, data.ydim, row0, row1, col0,
+               col1)
+        if key in self._masks:
+            INSTR.count('clip mask cache hits')
+            return self._masks[key]
+
+        rows = row1-row0
+        cols = col1-col0
+        with INSTR.span('rasterise polygons', shape=(rows, cols)):
+            driver = gdal.GetDriverByName('MEM')
+            dest = driver.Create('', max(cols, 1), max(rows, 1), 1,
+                                 gdal.GDT_Byte)
+            dest.SetGeoTransform((data.tlx+col0*data.xdim, data.xdim, 0.,
+                                  data.tly-row0*data.ydim, 0., -data.ydim))
+            gdal.RasterizeLayer(dest, [1], self.shapef.GetLayer(),
+                                burn_values=[1])
+            mask = dest.GetRasterBand(1).ReadAsArray()[:rows, :cols] == 0
+
+        self._masks[key] = mask
+        return mask
+
+    def cut_raster(self, idata):
+        """
+        Cuts a raster dataset in place. Only the window containing the
+        polygons is read.
+
+        Parameters
+        ----------
+        idata : Data
+            PyGMI raster dataset
+        """
+        row0, row1, col0, col1 = self.window(idata)
+        mask = self.raster_mask(idata)
+
+        tmp = band_source(idata).read(row0, row1)[:, col0:col1]
+        idata.data = np.ma.array(tmp, mask=(np.ma.getmaskarray(tmp) | mask))
+        idata.rows, idata.cols = mask.shape
+        idata.tlx = idata.tlx + col0*idata.xdim
+        idata.tly = idata.tly - row0*idata.ydim
+
+    def edge_index(self):
+        """
+        Returns the bucketed edge index used for points, making it the first
+        time.
+
+        Returns
+        -------
+        tuple
+            edge array, bucket start indices, bucket edge indices, minimum
+            y and bucket height
+        """
+        if self._index is not None:
+            return self._index
+
+        edges = np.concatenate([np.hstack([i[:-1], i[1:]])
+                                for i in self.rings if len(i) > 1])
+# Horizontal edges never cross a horizontal ray
+        edges = edges[edges[:, 1] != edges[:, 3]]
+
+        ymin = self.extent[2]
+        ymax = self.extent[3]
+        nbuckets = max(1, int(np.sqrt(edges.shape[0])))
+        height = max((ymax-ymin)/nbuckets, np.finfo(float).tiny)
+
+        bot = np.minimum(edges[:, 1], edges[:, 3])
+        top = np.maximum(edges[:, 1], edges[:, 3])
+        b0 = np.clip(((bot-ymin)/height).astype(int), 0, nbuckets-1)
+        b1 = np.clip(((top-ymin)/height).astype(int), 0, nbuckets-1)
+
+# Compressed list of the edges in each bucket
+        nper = b1-b0+1
+        eidx = np.repeat(np.arange(edges.shape[0]), nper)
+        bidx = np.repeat(b0, nper) + (np.arange(nper.sum()) -
+                                      np.repeat(np.cumsum(nper)-nper, nper))
+        order = np.argsort(bidx, kind='stable')
+        bedges = eidx[order]
+        bstart = np.zeros(nbuckets+1, dtype=np.int64)
+        bstart[1:] = np.cumsum(np.bincount(bidx, minlength=nbuckets))
+
+        self._index = (edges, bstart, bedges, ymin, height)
+        return self._index
+
+    def contains(self, x, y):
+        """
+        Tests which points are inside the polygons.
+
+        Parameters
+        ----------
+        x : numpy array
+            x coordinates
+        y : numpy array
+            y coordinates
+
+        Returns
+        -------
+        numpy array
+            boolean array, True for points inside the polygons
+        """
+        edges, bstart, bedges, ymin, height = self.edge_index()
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        y = np.ascontiguousarray(y, dtype=np.float64)
+
+        with INSTR.span('points in polygons', points=x.size):
+            out = _contains(x, y, edges, bstart, bedges, ymin, height,
+                            np.array(self.extent, dtype=np.float64))
+        return out
+
+
+@jit(nopython=True, parallel=True)
+def _contains(x, y, edges, bstart, bedges, ymin, height, extent):
+    """ Even-odd point in polygon test, using the bucketed edges """
+    out = np.zeros(x.size, dtype=np.bool_)
+    nbuckets = bstart.size-1
+
+    for i in prange(x.size):
+        px = x[i]
+        py = y[i]
+        if (px < extent[0] or px > extent[1] or py < extent[2] or
+                py > extent[3]):
+            continue
+
+        ibucket = min(int((py-ymin)/height), nbuckets-1)
+        inside = False
+        for k in range(bstart[ibucket], bstart[ibucket+1]):
+            e = bedges[k]
+            x0 = edges[e, 0]
+            y0 = edges[e, 1]
+            x1 = edges[e, 2]
+            y1 = edges[e, 3]
+            if (y0 > py) != (y1 > py):
+                if px < x0+(py-y0)*(x1-x0)/(y1-y0):
+                    inside = not inside
+        out[i] = inside
+
+    return out
@@ -30,10 +30,10 @@ import copy
 from PyQt5 import QtWidgets, QtCore
 import numpy as np
 from osgeo import ogr
-import matplotlib.path as mplPath
 import pandas as pd
 from pygmi.vector.datatypes import PData
 from pygmi.vector.datatypes import VData
+from pygmi.vector.clip import Clipper
 import pygmi.menu_default as menu_default
 import pandas as pd
 
@@ -440,7 +440,8 @@ class ImportShapeData(object):
 def cut_point(data, ifile):
     """Cuts a point dataset
 
-    Cut a point dataset using a shapefile
+    Cut a point dataset using a shapefile. All polygons in the shapefile
+    are used, including holes.
 
     Parameters
     ----------
@@ -454,36 +455,12 @@ def cut_point(data, ifile):
     Data
         PyGMI Dataset
     """
-    shapef = ogr.Open(ifile)
-    if shapef is None:
+    try:
+        clip = Clipper(ifile)
+    except (IOError, ValueError):
         return None
-    lyr = shapef.GetLayer()
-    poly = lyr.GetNextFeature()
-    if lyr.GetGeomType() is not ogr.wkbPolygon or poly is None:
-        return
-
-    points = []
-    geom = poly.GetGeometryRef()
-
-    ifin = 0
-    imax = 0
-    if geom.GetGeometryName() == 'MULTIPOLYGON':
-        for i in range(geom.GetGeometryCount()):
-            geom.GetGeometryRef(i)
-            itmp = geom.GetGeometryRef(i)
-            itmp = itmp.GetGeometryRef(0).GetPointCount()
-            if itmp > imax:
-                imax = itmp
-                ifin = i
-        geom = geom.GetGeometryRef(ifin)
-
-    pts = geom.GetGeometryRef(0)
-    for p in range(pts.GetPointCount()):
-        points.append((pts.GetX(p), pts.GetY(p)))
-
-    bbpath = mplPath.Path(points)
-
-    chk = bbpath.contains_points(np.transpose([data[0].xdata, data[0].ydata]))
+
+    chk = clip.contains(data[0].xdata, data[0].ydata)
 
     for idata in data:
         idata.xdata = idata.xdata[chk]
@@ -91,7 +91,8 @@ setup(name='pygmi',
                         'sip',
                         'six'],
 
-      package_data={'pygmi': ['raster/*.cof', 'helpdocs/*.html',
+      package_data={'pygmi': ['raster/*.cof', 'raster/*.COF',
+                              'helpdocs/*.html',
                               'helpdocs/*.png', 'images/*.png',
                               'images/*.emf', 'images/*.ico']},
 